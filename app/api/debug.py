@@ -0,0 +1,124 @@
+"""
+调试路由
+"""
+
+import asyncio
+import hmac
+import json
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from starlette.responses import JSONResponse, Response
+
+from app import config
+from app.utils import profiling
+from app.utils.tracing import trace_store
+
+# 创建路由器
+router = APIRouter(prefix="/api/debug", tags=["debug"])
+
+
+def _check_token(authorization: Optional[str], x_debug_token: Optional[str]) -> None:
+    """校验调试令牌，未配置令牌时接口视为不存在"""
+    if not config.DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="调试接口未启用")
+    token = x_debug_token
+    if token is None and authorization and authorization.startswith("Bearer "):
+        token = authorization[len("Bearer "):]
+    if token is None or not hmac.compare_digest(token.encode(), config.DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="调试令牌无效", headers={"WWW-Authenticate": "Bearer"})
+
+
+@router.get("/traces")
+async def list_traces(
+    authorization: Optional[str] = Header(None),
+    x_debug_token: Optional[str] = Header(None),
+):
+    """
+    列出最近保存的慢请求追踪，需要调试令牌
+
+    返回:
+        追踪摘要列表，按时间倒序
+    """
+    _check_token(authorization, x_debug_token)
+    return {
+        "slow_threshold": trace_store.slow_threshold,
+        "traces": trace_store.list(),
+    }
+
+
+@router.get("/traces/{trace_id}")
+async def export_trace(
+    trace_id: str,
+    authorization: Optional[str] = Header(None),
+    x_debug_token: Optional[str] = Header(None),
+):
+    """
+    以Chrome Trace Event格式导出单条追踪，可用 chrome://tracing 或 Perfetto 打开，需要调试令牌
+
+    参数:
+        trace_id: 追踪ID
+
+    返回:
+        追踪事件JSON文件
+    """
+    _check_token(authorization, x_debug_token)
+    trace = trace_store.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="追踪不存在或已被淘汰")
+
+    return JSONResponse(
+        trace.to_chrome_trace(),
+        headers={"Content-Disposition": f'attachment; filename="trace-{trace_id}.json"'},
+    )
+
+
+@router.post("/profile")
+async def capture_profile(
+    seconds: float = Query(10.0, gt=0, description="采集时长(秒)"),
+    mode: str = Query("sample", pattern="^(sample|cprofile)$", description="sample(折叠栈)或cprofile(pstats)"),
+    interval_ms: Optional[float] = Query(None, gt=0, le=1000, description="采样间隔(毫秒)"),
+    route: Optional[str] = Query(None, description="只采集该路由，例如 /api/remove-background-base64"),
+    include_idle: bool = Query(False, description="采样时是否包含处于等待状态的线程"),
+    authorization: Optional[str] = Header(None),
+    x_debug_token: Optional[str] = Header(None),
+):
+    """
+    在线上流量下采集若干秒的性能数据
+
+    需要在 Authorization: Bearer <令牌> 或 X-Debug-Token 请求头中提供 DEBUG_TOKEN
+
+    参数:
+        seconds: 采集时长，不超过 PROFILE_MAX_SECONDS
+        mode: sample 返回以路由开头的折叠栈文本，cprofile 返回pstats文件
+        interval_ms: 采样模式的采样间隔，默认 PROFILE_SAMPLE_INTERVAL_MS
+        route: 只采集该路由的调用
+        include_idle: 采样时是否包含处于等待状态的线程
+
+    返回:
+        折叠栈文本或pstats文件，X-Profile-Summary 响应头包含采集概况
+    """
+    _check_token(authorization, x_debug_token)
+    if seconds > config.PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"采集时长不能超过{config.PROFILE_MAX_SECONDS:g}秒")
+
+    interval = (interval_ms or config.PROFILE_SAMPLE_INTERVAL_MS) / 1000.0
+    capture = profiling.Capture(mode, interval, route=route, include_idle=include_idle)
+    try:
+        capture.start()
+    except profiling.CaptureBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        # 采样线程的停止需要等待一个采样间隔，不阻塞事件循环
+        await asyncio.get_running_loop().run_in_executor(None, capture.stop)
+
+    filename = f"profile-{time.strftime('%Y%m%d-%H%M%S')}"
+    headers = {"X-Profile-Summary": json.dumps(capture.summary())}
+    if mode == "sample":
+        headers["Content-Disposition"] = f'attachment; filename="{filename}.folded"'
+        return Response(capture.collapsed(), media_type="text/plain; charset=utf-8", headers=headers)
+    headers["Content-Disposition"] = f'attachment; filename="{filename}.pstats"'
+    return Response(capture.pstats_bytes(), media_type="application/octet-stream", headers=headers)
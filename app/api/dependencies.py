@@ -2,7 +2,11 @@
 API依赖项，用于FastAPI依赖注入
 """
 
+from typing import Optional
+
 from fastapi import Depends, HTTPException, status
+
+from app import config
 from app.services.segmentation import SegmentationService
 from app.models.model_manager import ModelManager
 
@@ -16,8 +20,10 @@ def get_segmentation_service() -> SegmentationService:
             detail=f"分割服务不可用: {str(e)}",
         )
 
-def get_model_manager() -> ModelManager:
-    """提供模型管理器的依赖项"""
+def get_model_manager() -> Optional[ModelManager]:
+    """提供模型管理器的依赖项，模型由独立推理进程或推理服务持有时返回None"""
+    if config.INFERENCE_BACKEND != "local":
+        return None
     try:
         return ModelManager()
     except Exception as e:
@@ -21,6 +21,14 @@ class ModelInfo(BaseModel):
     model_path: Optional[str] = Field(None, description="模型路径")
     input_size: Optional[List[int]] = Field(None, description="输入尺寸")
     model_name: Optional[str] = Field(None, description="模型名称")
+    shared_weights: Optional[bool] = Field(None, description="是否使用跨进程共享的权重")
+    session_profile: Optional[Dict[str, Any]] = Field(None, description="ONNX Runtime会话配置")
+    iobinding: Optional[bool] = Field(None, description="是否使用IOBinding")
+    cpu_topology: Optional[Dict[str, Any]] = Field(None, description="CPU拓扑、绑核槽位和当前进程的绑核信息")
+    dynamic_input: Optional[bool] = Field(None, description="模型输入尺寸是否为动态维度")
+    model_variants: Optional[List[str]] = Field(None, description="可用的模型变体")
+    backend: Optional[str] = Field(None, description="推理后端 (shm 或 remote，本进程推理时为空)")
+    backends: Optional[List[Dict[str, Any]]] = Field(None, description="各TCP推理服务的健康状态和负载")
     inputs: Optional[List[Dict[str, Any]]] = Field(None, description="输入信息")
     outputs: Optional[List[Dict[str, Any]]] = Field(None, description="输出信息")
     error: Optional[str] = Field(None, description="错误信息")
\ No newline at end of file
@@ -1,21 +1,39 @@
 """
 API路由
 """
+import asyncio
 import base64
 import io
+import json
 import logging
 import binascii
+import time
+from typing import AsyncIterator, Iterator, List, Optional
+
+import anyio
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, Request
 from fastapi.templating import Jinja2Templates
 from PIL import Image
-from starlette.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 
 from app import config
 from app.api.dependencies import get_segmentation_service, get_model_manager
 from app.services.segmentation import SegmentationService
 from app.models.model_manager import ModelManager
-from app.utils.image_utils import image_to_base64, process_image
+from app.models.backends import create_backend
+from app.utils import profiling, tracing
+from app.services import coalescing, degradation, pipeline
+from app.services.backgrounds import BackgroundAssetCache, parse_backgrounds
+from app.services.degradation import DegradationController, RequestCancelled
+from app.services.progressive import render_final, render_preview
+from app.utils.archive_utils import build_multipart, build_zip
+from app.utils.image_utils import (decode_image, encode_outputs, image_to_base64_bytes, image_to_bytes, parse_roi,
+                                   parse_sizes)
+from app.utils.memory_utils import PeakMemoryTracker
+from app.utils.metrics import registry
+from app.utils.stream_encoder import TransferTimer, iter_base64, iter_png, iter_webp
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -32,6 +50,10 @@ async def remove_background(
     file: UploadFile = File(...),
     bg_type: str = Form("transparent"),
     bg_color: str = Form("#00000000"),
+    crop: bool = Form(False),
+    crop_padding: int = Form(0, ge=0, le=1000),
+    allow_degraded: bool = Form(True),
+    roi: str = Form("", description="主体在原图中的边界框 左,上,右,下，只对其周围区域推理"),
     segmentation_service: SegmentationService = Depends(get_segmentation_service),
 ):
     """
@@ -41,6 +63,10 @@ async def remove_background(
         file: 上传的图像文件
         bg_type: 背景类型 (transparent 或 color)
         bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        allow_degraded: 负载过高时是否允许降级处理
+        roi: 主体在原图中的边界框，模型只对扩展后的区域推理，区域外视为背景
         segmentation_service: 分割服务依赖
 
     返回:
@@ -49,38 +75,105 @@ async def remove_background(
     # 检查文件是否为图片
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="上传的文件必须是图片")
+    roi_box = _parse_roi(roi)
 
     try:
-        # 读取上传的图片
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-
-        # 处理图像并移除背景
-        result = process_image(image, bg_type, bg_color, segmentation_service)
+        await file.seek(0)
+        # 排队前对上传的字节计算哈希，相同上传的请求只有第一个占用处理名额
+        digest = await run_in_threadpool(coalescing.hash_stream, file.file) if config.COALESCING_ENABLED else None
+        # 在事件循环中排队，获得处理名额后再交给线程池处理，不阻塞事件循环
+        async with coalescing.reserve(digest) as queue_wait:
+            result = await run_in_threadpool(_remove_background, file, bg_type, bg_color, crop, crop_padding,
+                                             allow_degraded, segmentation_service, roi_box, queue_wait, digest)
 
         # 返回结果页面
-        return templates.TemplateResponse(
-            "result.html",
-            {
-                "request": request,
-                "result_image": result["result_image"],
-                "original_image": result["original_image"],
-                "metrics": result["metrics"],
-                "bg_color_info": result["bg_color_info"],
-                "config": config
-            },
-        )
+        with tracing.span("render_template"):
+            return templates.TemplateResponse(
+                "result.html",
+                {
+                    "request": request,
+                    "result_image": result["result_image"],
+                    "original_image": result["original_image"],
+                    "metrics": result["metrics"],
+                    "bg_color_info": result["bg_color_info"],
+                    "config": config
+                },
+            )
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         logger.error(f"处理图片时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"处理图片时出错: {str(e)}")
 
+@profiling.profiled("/api/remove-background")
+def _remove_background(file: UploadFile, bg_type: str, bg_color: str, crop: bool, crop_padding: int,
+                       allow_degraded: bool, segmentation_service: SegmentationService,
+                       roi: Optional[tuple] = None, reserved_wait: Optional[float] = None,
+                       digest: Optional[str] = None) -> dict:
+    """解码并处理上传的图片；reserved_wait 为None时先排队等待处理名额，digest 为上传字节的内容哈希"""
+    controller = DegradationController()
+    with controller.admit(allow_degraded, segmentation_service.degradation_support(),
+                          reserved_wait=reserved_wait) as admission, \
+            pipeline.track_request() as timings:
+        with PeakMemoryTracker() as memory:
+            # 直接从上传的临时文件解码，不把整个文件读入内存
+            image = pipeline.stage("decode", _decode_upload, file, digest)
+            _check_roi(roi, image)
+
+            # 处理图像并移除背景
+            outputs = pipeline.render(image, bg_type, bg_color, segmentation_service,
+                                      crop=crop, crop_padding=crop_padding, roi=roi)
+            del image
+            result = pipeline.stage("encode", encode_outputs, outputs)
+        _record(admission, result["metrics"], timings)
+    _with_memory(result["metrics"], memory)
+    return result
+
+def _decode_upload(file: UploadFile, digest: Optional[str] = None) -> Image.Image:
+    # 带上原始字节的内容哈希，相同上传的推理可以合并
+    with tracing.span("decode_image", bytes=file.size):
+        image = decode_image(file.file)
+    if digest is not None:
+        image.info["content_hash"] = digest
+    return image
+
+def _parse_roi(roi: str) -> Optional[tuple]:
+    """解析边界框参数，格式无效时抛出400错误"""
+    try:
+        return parse_roi(roi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _check_roi(roi: Optional[tuple], image: Image.Image) -> None:
+    """检查原图坐标的边界框与图像有重叠，否则抛出400错误"""
+    if roi is None:
+        return
+    width, height = image.info.get("original_size", image.size)
+    if roi[0] >= width or roi[1] >= height:
+        raise HTTPException(status_code=400, detail=f"边界框超出图像范围 {width}x{height}")
+
+def _record(admission: degradation.Admission, metrics: dict, timings: dict) -> None:
+    """记录请求的处理耗时；流水线各阶段的排队耗时计入排队耗时，阶段拥堵时降级控制器同样能感知"""
+    if timings:
+        admission.queue_wait += pipeline.total_queue_wait(timings)
+        metrics["pipeline"] = timings
+    admission.record(metrics)
+
 @router.post("/remove-background-base64")
 async def remove_background_base64(
-    bg_type: str = Form("transparent", regex="^(transparent|color)$", description="背景类型，必须是transparent或color"),
+    bg_type: str = Form("transparent", pattern="^(transparent|color)$", description="背景类型，必须是transparent或color"),
     bg_color: str = Form("#00000000"),
     image_base64: str = Form(...),
-    output_type: str = Form("file", regex="^(file|base64)$", description="输入类型，必须是file或base64"),
+    output_type: str = Form("file", pattern="^(file|base64|zip|multipart)$",
+                            description="输出类型，必须是file、base64、zip或multipart"),
+    crop: bool = Form(False, description="是否裁剪到主体的边界框"),
+    crop_padding: int = Form(0, ge=0, le=1000, description="裁剪时边界框四周保留的像素"),
+    sizes: str = Form("", description="逗号分隔的额外输出尺寸(最长边像素数)，例如256,512,1024"),
+    backgrounds: str = Form("", description="逗号分隔的背景列表，例如transparent,#FFFFFF,image:studio,blur:20"),
+    allow_degraded: bool = Form(True, description="负载过高时是否允许降级处理"),
+    roi: str = Form("", description="主体在原图中的边界框 左,上,右,下，只对其周围区域推理"),
+    output_format: str = Form("png", pattern="^(png|webp)$", description="output_type=file时的图片格式，png或webp"),
     segmentation_service: SegmentationService = Depends(get_segmentation_service),
 ):
     """
@@ -90,50 +183,42 @@ async def remove_background_base64(
         image_base64: Base64编码的图像
         bg_type: 背景类型 (transparent 或 color)
         bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        output_type: 输出类型 (file、base64、zip 或 multipart)
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        sizes: 额外输出的尺寸，一次推理、一次合成后缩放得到；output_type=file 时不支持
+        backgrounds: 多个背景，一次推理后分别合成，指定时忽略bg_type和bg_color
+        allow_degraded: 负载过高时是否允许降级处理，降级级别记录在 metrics.degradation_level
+        roi: 主体在原图中的边界框，模型只对扩展后的区域推理，区域外视为背景
+        output_format: output_type=file 时结果图的格式 (png 或 webp)
         segmentation_service: 分割服务依赖
 
     返回:
-        处理后的图像文件
+        处理后的图像文件；zip和multipart包含结果图、各尺寸结果和metrics.json
     """
     try:
-        # 验证Base64字符串是否有效
-        try:
-            if "base64," in image_base64:
-                image_base64 = image_base64.split("base64,")[1]
-
-            image_data = io.BytesIO(base64.b64decode(image_base64))
-        except (binascii.Error, ValueError):
-            raise HTTPException(status_code=400, detail="无效的Base64编码")
-
-        # 验证解码后的数据是否为有效图片
         try:
-            image = Image.open(image_data)
-            image.verify()  # 验证图片完整性
-            image = Image.open(image_data)  # 重新加载图片
-        except Exception:
-            raise HTTPException(status_code=400, detail="Base64解码后不是有效的图片")
-
-        # 调用封装的公共方法处理图像
-        result = process_image(image, bg_type, bg_color, segmentation_service)
-
-        if output_type == "base64":
-            # 将处理后的图像转换为Base64字符串
-            image_base64 = image_to_base64(result["result_image"])
-            return {
-                "result_image": image_base64,
-                "original_image": result["original_image"],
-                "metrics": result["metrics"],
-                "bg_color_info": result["bg_color_info"]
-            }
-        else:
-            # 将处理后的图像转换为二进制流
-            result_image = Image.open(io.BytesIO(base64.b64decode(result["result_image"])))
-            image_stream = io.BytesIO()
-            result_image.save(image_stream, format="PNG")
-            image_stream.seek(0)
+            output_sizes = parse_sizes(sizes)
+            if output_sizes and output_type == "file":
+                raise ValueError("output_type=file 只返回结果图，额外尺寸需使用base64、zip或multipart")
+            background_list = parse_backgrounds(backgrounds)
+            for background in background_list:
+                if background["type"] == "image" and not BackgroundAssetCache().has_asset(background["name"]):
+                    raise ValueError(f"背景图不存在: {background['name']}")
+            roi_box = parse_roi(roi)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-            # 返回文件响应
-            return StreamingResponse(image_stream, media_type="image/png")
+        # 排队前对Base64文本计算哈希，相同上传的请求只有第一个占用处理名额
+        digest = (await run_in_threadpool(coalescing.content_hash, image_base64)
+                  if config.COALESCING_ENABLED else None)
+        # 在事件循环中排队，获得处理名额后再交给线程池处理，不阻塞事件循环
+        async with coalescing.reserve(digest) as queue_wait:
+            return await run_in_threadpool(
+                _remove_background_base64, image_base64, bg_type, bg_color, output_type, crop, crop_padding,
+                output_sizes, background_list, allow_degraded, segmentation_service, roi_box, output_format,
+                queue_wait, digest,
+            )
 
     except HTTPException as e:
         raise e
@@ -141,8 +226,335 @@ async def remove_background_base64(
         logger.error(f"处理Base64图片时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"处理图片时出错: {str(e)}")
 
+@profiling.profiled("/api/remove-background-base64")
+def _remove_background_base64(image_base64: str, bg_type: str, bg_color: str, output_type: str,
+                              crop: bool, crop_padding: int, output_sizes: List[int],
+                              background_list: List[dict], allow_degraded: bool,
+                              segmentation_service: SegmentationService, roi: Optional[tuple] = None,
+                              output_format: str = "png", reserved_wait: Optional[float] = None,
+                              digest: Optional[str] = None):
+    """处理Base64图片，按输出类型生成响应；reserved_wait 为None时先排队等待处理名额，digest 为Base64文本的内容哈希"""
+    start_time = time.perf_counter()
+    controller = DegradationController()
+    with controller.admit(allow_degraded, segmentation_service.degradation_support(),
+                          reserved_wait=reserved_wait) as admission, \
+            pipeline.track_request() as timings:
+        # 统计请求处理期间的峰值内存
+        with PeakMemoryTracker() as memory:
+            image = pipeline.stage("decode", _decode_base64_image, image_base64, digest)
+            _check_roi(roi, image)
+
+            if output_type in ("zip", "multipart"):
+                # 多个输出一次返回，不经过Base64
+                outputs = pipeline.render(image, bg_type, bg_color, segmentation_service,
+                                          crop=crop, crop_padding=crop_padding, sizes=output_sizes,
+                                          backgrounds=background_list, roi=roi)
+                del image
+                _record(admission, outputs["metrics"], timings)
+                return pipeline.stage("encode", _build_archive_response, outputs, output_type, memory)
+
+            if output_type == "file":
+                # 直接编码结果图，不生成原图和Base64
+                outputs = pipeline.render(image, bg_type, bg_color, segmentation_service,
+                                          crop=crop, crop_padding=crop_padding, backgrounds=background_list,
+                                          roi=roi)
+                del image
+                _record(admission, outputs["metrics"], timings)
+                result_image = outputs.pop("result_image")
+                headers = {"X-Degradation-Level": str(admission.level["level"])}
+                if config.STREAM_ENCODING:
+                    # 边编码边发送，不等整张图编码完成
+                    timer = TransferTimer(start_time, output_format)
+                    return StreamingResponse(timer.wrap(_iter_encoded(result_image, output_format, admission.level)),
+                                             media_type=f"image/{output_format}", headers=headers)
+                image_bytes = pipeline.stage("encode", _encode_file_response, result_image, output_format)
+
+                # 返回文件响应；StreamingResponse会按换行符把PNG切成大量小块发送
+                return Response(image_bytes, media_type=f"image/{output_format}", headers=headers)
+
+            if config.LOW_MEMORY_MODE or config.STREAM_ENCODING:
+                # 流式返回JSON，每张图在发送时才编码，同一时间只保留一张图的编码结果
+                outputs = pipeline.render(image, bg_type, bg_color, segmentation_service,
+                                          crop=crop, crop_padding=crop_padding, sizes=output_sizes,
+                                          backgrounds=background_list, roi=roi)
+                del image
+                _record(admission, outputs["metrics"], timings)
+                timer = TransferTimer(start_time, "json")
+                return StreamingResponse(timer.wrap(_iter_base64_json(outputs, memory, admission.level, timer)),
+                                         media_type="application/json")
+
+            # 生成所有输出并编码为Base64
+            outputs = pipeline.render(image, bg_type, bg_color, segmentation_service,
+                                      crop=crop, crop_padding=crop_padding, sizes=output_sizes,
+                                      backgrounds=background_list, roi=roi)
+            del image
+            result = pipeline.stage("encode", encode_outputs, outputs)
+        _record(admission, result["metrics"], timings)
+
+    # encode_outputs 已经返回Base64编码的结果
+    response = {
+        "result_image": result["result_image"],
+        "original_image": result["original_image"],
+        "metrics": _with_memory(result["metrics"], memory),
+        "bg_color_info": result["bg_color_info"]
+    }
+    for key in ("variants", "backgrounds", "background_variants"):
+        if key in result:
+            response[key] = result[key]
+    return response
+
+@router.post("/remove-background-stream")
+async def remove_background_stream(
+    request: Request,
+    file: UploadFile = File(...),
+    bg_type: str = Form("transparent", pattern="^(transparent|color)$"),
+    bg_color: str = Form("#00000000"),
+    crop: bool = Form(False),
+    crop_padding: int = Form(0, ge=0, le=1000),
+    allow_degraded: bool = Form(True),
+    roi: str = Form(""),
+    segmentation_service: SegmentationService = Depends(get_segmentation_service),
+):
+    """
+    以Server-Sent Events渐进返回抠图结果
+
+    先推送低分辨率预览(preview事件)，再推送完整分辨率的结果(final事件)，每个事件带有该阶段的耗时；
+    出错时推送error事件。客户端在预览之后断开时跳过最终阶段的剩余步骤。
+
+    参数:
+        file: 上传的图像文件
+        bg_type: 背景类型 (transparent 或 color)
+        bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        allow_degraded: 负载过高时最终阶段是否允许降级处理
+        roi: 主体在原图中的边界框 左,上,右,下，模型只对扩展后的区域推理
+        segmentation_service: 分割服务依赖
+
+    返回:
+        text/event-stream 响应
+    """
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="上传的文件必须是图片")
+    roi_box = _parse_roi(roi)
+
+    await file.seek(0)
+    try:
+        with tracing.span("decode_image", bytes=file.size):
+            image = await run_in_threadpool(decode_image, file.file)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无法解码上传的图片")
+    _check_roi(roi_box, image)
+
+    events = _iter_progressive_events(request, image, bg_type, bg_color, crop, crop_padding,
+                                      allow_degraded, segmentation_service, roi_box)
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# 渐进式返回的两个阶段在线程池中执行，性能分析时归到流式路由下
+_render_preview = profiling.profiled("/api/remove-background-stream")(render_preview)
+_render_final = profiling.profiled("/api/remove-background-stream")(render_final)
+
+def _sse_event(event: str, data: dict) -> bytes:
+    """编码一个Server-Sent Events事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+async def _iter_progressive_events(request: Request, image: Image.Image, bg_type: str, bg_color: str,
+                                   crop: bool, crop_padding: int, allow_degraded: bool,
+                                   segmentation_service: SegmentationService,
+                                   roi: Optional[tuple] = None) -> AsyncIterator[bytes]:
+    """依次生成预览和最终结果事件，客户端断开后不再继续"""
+    start_time = time.time()
+
+    def is_cancelled() -> bool:
+        # 在工作线程中调用。Starlette监听到断开时取消响应任务，但断开消息已被它取走，
+        # request.is_disconnected 不一定还能收到，所以先检查发起线程的任务是否已被取消
+        try:
+            anyio.from_thread.check_cancelled()
+            return anyio.from_thread.run(request.is_disconnected)
+        except asyncio.CancelledError:
+            return True
+
+    controller = DegradationController()
+    try:
+        # 两个阶段都在事件循环中排队，排队期间客户端断开时直接放弃
+        async with controller.reserve(request.is_disconnected) as queue_wait:
+            preview, prediction = await run_in_threadpool(_render_preview, image, bg_type, bg_color,
+                                                          segmentation_service, is_cancelled, roi, queue_wait)
+        preview["metrics"]["elapsed"] = time.time() - start_time
+        yield _sse_event("preview", preview)
+
+        async with controller.reserve(request.is_disconnected) as queue_wait:
+            final = await run_in_threadpool(_render_final, image, bg_type, bg_color, segmentation_service,
+                                            crop, crop_padding, allow_degraded, prediction, is_cancelled, roi,
+                                            queue_wait)
+        final["metrics"]["elapsed"] = time.time() - start_time
+        yield _sse_event("final", final)
+    except RequestCancelled:
+        logger.info("客户端已断开，跳过剩余的处理阶段")
+    except Exception as e:
+        logger.error(f"渐进处理图片时出错: {str(e)}")
+        yield _sse_event("error", {"detail": f"处理图片时出错: {str(e)}"})
+
+def _encode_file_response(image: Image.Image, output_format: str = "png") -> bytes:
+    with tracing.span("encode_file_response", format=output_format):
+        return image_to_bytes(image, output_format.upper())
+
+def _iter_encoded(image: Image.Image, output_format: str, level: dict) -> Iterator[bytes]:
+    """流式编码结果图；编码在路由返回后进行，压缩级别取自请求的降级级别"""
+    if output_format == "webp":
+        return iter_webp(image)
+    return iter_png(image, level.get("png_compress_level"))
+
+def _decode_base64_image(image_base64: str, digest: Optional[str] = None) -> Image.Image:
+    """解码并校验Base64图片，无效时抛出400错误；digest 为内容哈希，用于合并相同请求"""
+    # 验证Base64字符串是否有效
+    try:
+        if "base64," in image_base64:
+            image_base64 = image_base64.split("base64,")[1]
+
+        with tracing.span("decode_base64"):
+            image_data = io.BytesIO(base64.b64decode(image_base64))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="无效的Base64编码")
+
+    # 验证解码后的数据是否为有效图片
+    try:
+        with tracing.span("decode_image", bytes=len(image_data.getbuffer())):
+            Image.open(image_data).verify()  # 验证图片完整性
+            image_data.seek(0)
+            image = decode_image(image_data)  # 重新加载图片
+    except Exception:
+        raise HTTPException(status_code=400, detail="Base64解码后不是有效的图片")
+    if digest is not None:
+        image.info["content_hash"] = digest
+    return image
+
+def _iter_base64_json(outputs: dict, memory: PeakMemoryTracker, level: dict,
+                      timer: Optional[TransferTimer] = None) -> Iterator[bytes]:
+    """
+    逐段生成与 process_image 结构相同的JSON响应体
+
+    Base64字符不需要JSON转义，编码结果直接作为字节写出，不生成字符串和完整的JSON文本；
+    启用流式编码时每张图按行带编码，编码一段发送一段。timer 不为None时在metrics.stream中报告
+    到发送metrics为止的首字节时间和传输时间
+    """
+    def encode(image: Image.Image, span_name: str = "encode_image") -> Iterator[bytes]:
+        yield b'"'
+        if config.STREAM_ENCODING:
+            yield from iter_base64(iter_png(image, level.get("png_compress_level")))
+        else:
+            # 编码在路由返回后进行，需要重新设置请求的降级级别；每次next()都在新的上下文中执行，span不能跨越yield
+            with degradation.use_level(level), tracing.span(span_name):
+                encoded = image_to_base64_bytes(image)
+            yield encoded
+            del encoded
+        yield b'"'
+
+    def encode_map(images: dict) -> Iterator[bytes]:
+        yield b"{"
+        for index, key in enumerate(list(images)):
+            yield (b"," if index else b"") + json.dumps(str(key)).encode() + b":"
+            yield from encode(images.pop(key))
+        yield b"}"
+
+    with memory:
+        yield b'{"result_image":'
+        yield from encode(outputs.pop("result_image"), "encode_result")
+        yield b',"original_image":'
+        yield from encode(outputs.pop("original_image"), "encode_original")
+        if outputs["variants"]:
+            yield b',"variants":'
+            yield from encode_map(outputs["variants"])
+        if outputs["backgrounds"]:
+            yield b',"backgrounds":'
+            yield from encode_map(outputs["backgrounds"])
+        if outputs["background_variants"]:
+            yield b',"background_variants":{'
+            for index, key in enumerate(list(outputs["background_variants"])):
+                yield (b"," if index else b"") + json.dumps(key).encode() + b":"
+                yield from encode_map(outputs["background_variants"].pop(key))
+            yield b"}"
+
+    metrics = _with_memory(outputs["metrics"], memory)
+    if timer is not None:
+        metrics["stream"] = timer.to_dict()
+    yield (b',"metrics":' + json.dumps(metrics, ensure_ascii=False).encode()
+           + b',"bg_color_info":' + json.dumps(outputs["bg_color_info"], ensure_ascii=False).encode() + b"}")
+
+def _with_memory(metrics: dict, memory: PeakMemoryTracker) -> dict:
+    """把峰值内存统计加入性能指标"""
+    memory_info = memory.to_dict()
+    if memory_info is not None:
+        metrics["memory"] = memory_info
+    return metrics
+
+def _build_archive_response(outputs: dict, output_type: str, memory: PeakMemoryTracker) -> Response:
+    """把结果图和各尺寸结果打包为zip或multipart响应"""
+    with tracing.span("encode_archive", output_type=output_type):
+        files = [("result.png", image_to_bytes(outputs["result_image"]), "image/png")]
+        for size, variant in outputs["variants"].items():
+            files.append((f"result_{size}.png", image_to_bytes(variant), "image/png"))
+        for key, composite in outputs["backgrounds"].items():
+            files.append((f"result_{key}.png", image_to_bytes(composite), "image/png"))
+            for size, variant in outputs["background_variants"].get(key, {}).items():
+                files.append((f"result_{key}_{size}.png", image_to_bytes(variant), "image/png"))
+        metrics = dict(_with_memory(outputs["metrics"], memory), bg_color_info=outputs["bg_color_info"])
+        files.append(("metrics.json", json.dumps(metrics, ensure_ascii=False).encode(), "application/json"))
+
+        if output_type == "zip":
+            return Response(
+                build_zip([(name, data) for name, data, _ in files]),
+                media_type="application/zip",
+                headers={"Content-Disposition": 'attachment; filename="result.zip"'},
+            )
+
+        body, content_type = build_multipart(files)
+        return Response(body, media_type=content_type)
+
+@router.get("/backgrounds")
+async def list_backgrounds():
+    """
+    列出预注册的背景图
+
+    返回:
+        可在backgrounds参数中以 image:<名称> 引用的背景图名称和缓存统计
+    """
+    cache = BackgroundAssetCache()
+    return {"images": cache.list_assets(), "cache": cache.get_stats()}
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    以Prometheus文本格式导出进程内指标(降级级别、级别切换次数、排队情况等)
+
+    返回:
+        Prometheus文本格式的指标
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/pipeline")
+async def get_pipeline():
+    """
+    获取分阶段流水线的状态
+
+    返回:
+        是否启用，以及各阶段的线程数、忙碌线程数、队列长度、完成任务数和最近时间窗口内的占用率
+    """
+    return pipeline.get_stats()
+
+@router.get("/degradation")
+async def get_degradation():
+    """
+    获取降级控制器的状态
+
+    返回:
+        当前级别、排队请求数、SLO和最近的级别切换记录
+    """
+    return DegradationController().get_stats()
+
 @router.get("/model-info")
-async def get_model_info(model_manager: ModelManager = Depends(get_model_manager)):
+async def get_model_info(model_manager: Optional[ModelManager] = Depends(get_model_manager)):
     """
     获取模型信息
 
@@ -152,4 +564,6 @@ async def get_model_info(model_manager: ModelManager = Depends(get_model_manager
     返回:
         模型信息
     """
+    if model_manager is None:
+        return await run_in_threadpool(lambda: create_backend().get_model_info())
     return model_manager.get_model_info()
\ No newline at end of file
@@ -0,0 +1,388 @@
+"""
+离线批量抠图命令行工具
+
+直接调用 SegmentationService 处理目录或文件列表中的图片，不经过HTTP服务，
+也不导入FastAPI、模板和静态文件。进程池大小默认等于可用核心数，每个工作进程
+加载一份模型并按批次推理；输出目录中的清单(manifest.jsonl)记录已完成的文件，
+重新运行时跳过输入和输出设置都没有变化的文件。
+
+    python -m app.cli photos/ --output out/ --sizes 256,1024 --backgrounds transparent,#FFFFFF
+    python -m app.cli --file-list files.txt --output out/ --workers 4 --batch-size 4
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from PIL import Image
+
+from app import config
+from app.services.backgrounds import BackgroundAssetCache, parse_backgrounds
+from app.services.segmentation import SegmentationService
+from app.utils.color_utils import parse_color
+from app.utils.image_utils import parse_sizes, render_outputs, resize_image_to_limit
+
+logger = logging.getLogger(__name__)
+
+# 作为输入的图片扩展名
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# 需要传给工作进程的配置项，spawn方式启动的进程不会继承父进程中修改过的配置
+WORKER_CONFIG_KEYS = (
+    "MODEL_PATH",
+    "MODEL_INPUT_SIZE_LIST",
+    "MODEL_STAND_IN",
+    "MODEL_STAND_IN_DELAY_MS",
+    "MODEL_SHARED_WEIGHTS",
+    "ORT_PROFILE_PATH",
+    "ORT_INTRA_OP_THREADS",
+    "CPU_PINNING",
+    "CPU_PINNING_SLOTS",
+    "CPU_PINNING_LOCK_DIR",
+    "INFERENCE_BACKEND",
+    "REMOTE_BACKENDS",
+    "BACKGROUND_ASSETS_DIR",
+)
+
+# 工作进程内的分割服务
+_worker_service: Optional[SegmentationService] = None
+
+
+def get_available_cpus() -> int:
+    """获取当前进程可用的逻辑核数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def collect_inputs(paths: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    收集输入图片
+
+    参数:
+        paths: 文件或目录路径，目录会被递归遍历
+
+    返回:
+        (绝对路径, 输出相对路径) 列表，目录中的图片保留相对于该目录的子路径
+    """
+    inputs: List[Tuple[str, str]] = []
+    seen = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            candidates = []
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    source = os.path.join(root, filename)
+                    candidates.append((source, os.path.relpath(source, path)))
+        elif os.path.isfile(path):
+            candidates = [(path, os.path.basename(path))]
+        else:
+            raise FileNotFoundError(f"输入不存在: {path}")
+
+        for source, relative in candidates:
+            if source.lower().endswith(IMAGE_EXTENSIONS) and source not in seen:
+                seen.add(source)
+                inputs.append((source, relative))
+    return inputs
+
+
+def settings_digest(settings: Dict[str, Any]) -> str:
+    """输出设置的摘要，设置变化后清单中的记录失效"""
+    payload = dict(settings, model_path=config.MODEL_PATH, input_size=config.MODEL_INPUT_SIZE_LIST)
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    读取清单，同一文件以最后一条记录为准
+
+    参数:
+        manifest_path: 清单路径
+
+    返回:
+        源文件路径到记录的字典
+    """
+    entries: Dict[str, Dict[str, Any]] = {}
+    if not os.path.exists(manifest_path):
+        return entries
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # 中断时可能留下不完整的最后一行
+                continue
+            entries[entry["source"]] = entry
+    return entries
+
+
+def is_completed(entry: Optional[Dict[str, Any]], source: str, digest: str) -> bool:
+    """清单记录是否表示该文件已用相同设置处理完成且输出仍然存在"""
+    if entry is None or entry.get("status") != "ok" or entry.get("settings") != digest:
+        return False
+    stat = os.stat(source)
+    if entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+        return False
+    return all(os.path.exists(path) for path in entry.get("outputs", []))
+
+
+def _init_worker(config_values: Dict[str, Any]) -> None:
+    """工作进程初始化：应用配置并加载模型"""
+    global _worker_service
+    for key, value in config_values.items():
+        setattr(config, key, value)
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    _worker_service = SegmentationService()
+
+
+def _default_batch_size(service: SegmentationService) -> int:
+    return service.backend.get_batch_size()
+
+
+def _output_paths(output_dir: str, relative: str, outputs: Dict[str, Any]) -> Dict[str, Image.Image]:
+    """按API的输出内容生成输出文件路径"""
+    stem = os.path.join(output_dir, os.path.splitext(relative)[0])
+    files = {f"{stem}.png": outputs["result_image"]}
+    for size, variant in outputs["variants"].items():
+        files[f"{stem}_{size}.png"] = variant
+    for key, composite in outputs["backgrounds"].items():
+        files[f"{stem}_{key}.png"] = composite
+        for size, variant in outputs["background_variants"].get(key, {}).items():
+            files[f"{stem}_{key}_{size}.png"] = variant
+    return files
+
+
+def process_batch(tasks: List[Tuple[str, str]], output_dir: str, settings: Dict[str, Any],
+                  digest: str) -> List[Dict[str, Any]]:
+    """
+    处理一批图片：逐张解码，一次推理，再逐张合成和保存
+
+    参数:
+        tasks: (源文件路径, 输出相对路径) 列表
+        output_dir: 输出目录
+        settings: 输出设置
+        digest: 输出设置摘要
+
+    返回:
+        每张图片的清单记录
+    """
+    service = _worker_service if _worker_service is not None else SegmentationService()
+    entries: List[Dict[str, Any]] = []
+    decoded: List[Tuple[Tuple[str, str], Image.Image, Dict[str, Any]]] = []
+
+    for source, relative in tasks:
+        entry: Dict[str, Any] = {"source": source, "settings": digest}
+        try:
+            stat = os.stat(source)
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            with Image.open(source) as image:
+                image.load()
+                # 与API一致，先限制尺寸再推理
+                decoded.append(((source, relative), resize_image_to_limit(image, (3000, 3000)), entry))
+        except Exception as e:
+            entries.append(dict(entry, status="error", error=f"解码图片时出错: {str(e)}"))
+
+    if not decoded:
+        return entries
+
+    batch_size = settings["batch_size"] or _default_batch_size(service)
+    try:
+        predictions = service.predict_masks([image for _, image, _ in decoded], batch_size)
+    except Exception as e:
+        return entries + [dict(entry, status="error", error=str(e)) for _, _, entry in decoded]
+
+    for ((source, relative), image, entry), prediction in zip(decoded, predictions):
+        try:
+            outputs = render_outputs(
+                image,
+                settings["bg_type"],
+                settings["bg_color"],
+                service,
+                crop=settings["crop"],
+                crop_padding=settings["crop_padding"],
+                sizes=settings["sizes"],
+                backgrounds=settings["backgrounds"],
+                prediction=prediction,
+            )
+            files = _output_paths(output_dir, relative, outputs)
+            for path, output_image in files.items():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                output_image.save(path, format="PNG")
+            metrics = {key: value for key, value in outputs["metrics"].items() if key != "trace_id"}
+            entries.append(dict(entry, status="ok", outputs=sorted(files), metrics=metrics))
+        except Exception as e:
+            entries.append(dict(entry, status="error", error=str(e)))
+    return entries
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def run(inputs: List[Tuple[str, str]], output_dir: str, settings: Dict[str, Any],
+        workers: int, manifest_path: Optional[str] = None, force: bool = False,
+        progress: bool = True) -> Dict[str, Any]:
+    """
+    批量处理图片
+
+    参数:
+        inputs: collect_inputs 返回的输入列表
+        output_dir: 输出目录
+        settings: 输出设置(bg_type、bg_color、crop、crop_padding、sizes、backgrounds、batch_size)
+        workers: 工作进程数，1表示在当前进程内处理
+        manifest_path: 清单路径，默认为输出目录下的 manifest.jsonl
+        force: 忽略清单，重新处理所有文件
+        progress: 是否在stderr输出进度
+
+    返回:
+        处理统计
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = manifest_path or os.path.join(output_dir, MANIFEST_NAME)
+    digest = settings_digest({key: value for key, value in settings.items() if key != "batch_size"})
+
+    manifest = {} if force else load_manifest(manifest_path)
+    pending = [(source, relative) for source, relative in inputs
+               if not is_completed(manifest.get(source), source, digest)]
+    skipped = len(inputs) - len(pending)
+
+    # 每个任务是一个推理批次；批次大小未指定时取默认值，保证任务足够多以均衡负载
+    chunk_size = settings["batch_size"] or config.INFERENCE_MAX_BATCH
+    chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+
+    stats = {"total": len(inputs), "skipped": skipped, "succeeded": 0, "failed": 0}
+    start_time = time.perf_counter()
+    last_report = 0.0
+
+    def record(entries: List[Dict[str, Any]], manifest_file) -> None:
+        nonlocal last_report
+        for entry in entries:
+            manifest_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if entry["status"] == "ok":
+                stats["succeeded"] += 1
+            else:
+                stats["failed"] += 1
+                logger.warning(f"{entry['source']}: {entry.get('error')}")
+        manifest_file.flush()
+
+        now = time.perf_counter()
+        done = stats["succeeded"] + stats["failed"]
+        if progress and (now - last_report >= 1.0 or done == len(pending)):
+            last_report = now
+            elapsed = now - start_time
+            rate = done / elapsed if elapsed > 0 else 0.0
+            eta = (len(pending) - done) / rate if rate > 0 else 0.0
+            print(f"[{done}/{len(pending)}] {rate:.2f} 张/秒  失败 {stats['failed']}  "
+                  f"已用 {_format_duration(elapsed)}  剩余 {_format_duration(eta)}", file=sys.stderr)
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest_file:
+        if workers <= 1:
+            for chunk in chunks:
+                record(process_batch(chunk, output_dir, settings, digest), manifest_file)
+        else:
+            cpus = get_available_cpus()
+            config_values = {key: getattr(config, key) for key in WORKER_CONFIG_KEYS}
+            if not config.ORT_INTRA_OP_THREADS:
+                # 进程间平分核心，避免每个进程的线程池都占满所有核心
+                config_values["ORT_INTRA_OP_THREADS"] = max(1, cpus // workers)
+            with tempfile.TemporaryDirectory(prefix="rmbg-cpu-slots-") as slot_dir:
+                if config.CPU_PINNING != "off":
+                    # 每个工作进程绑定一个CPU集合，槽位只在本次运行的工作进程之间分配
+                    config_values["CPU_PINNING_SLOTS"] = min(workers, cpus)
+                    config_values["CPU_PINNING_LOCK_DIR"] = slot_dir
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(config_values,)) as executor:
+                    futures = [executor.submit(process_batch, chunk, output_dir, settings, digest)
+                               for chunk in chunks]
+                    for future in as_completed(futures):
+                        record(future.result(), manifest_file)
+
+    elapsed = time.perf_counter() - start_time
+    stats["elapsed"] = elapsed
+    stats["throughput"] = stats["succeeded"] / elapsed if elapsed > 0 else 0.0
+    stats["manifest"] = manifest_path
+    return stats
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="RMBG离线批量抠图")
+    parser.add_argument("inputs", nargs="*", help="图片文件或目录，目录会被递归遍历")
+    parser.add_argument("--file-list", help="每行一个图片路径的文件列表")
+    parser.add_argument("--output", "-o", required=True, help="输出目录")
+    parser.add_argument("--bg-type", choices=["transparent", "color"], default="transparent", help="背景类型")
+    parser.add_argument("--bg-color", default="#00000000", help="背景颜色(bg-type为color时使用)")
+    parser.add_argument("--crop", action="store_true", help="裁剪到主体的边界框")
+    parser.add_argument("--crop-padding", type=int, default=0, help="裁剪时边界框四周保留的像素")
+    parser.add_argument("--sizes", default="", help="逗号分隔的额外输出尺寸(最长边像素数)")
+    parser.add_argument("--backgrounds", default="", help="逗号分隔的背景列表，格式与API相同")
+    parser.add_argument("--workers", type=int, default=get_available_cpus(), help="工作进程数，默认等于可用核心数")
+    parser.add_argument("--batch-size", type=int, default=0, help="每次推理的图片数，默认取调优结果或INFERENCE_MAX_BATCH")
+    parser.add_argument("--manifest", help="清单路径，默认为输出目录下的 manifest.jsonl")
+    parser.add_argument("--force", action="store_true", help="忽略清单，重新处理所有文件")
+    parser.add_argument("--quiet", action="store_true", help="不输出进度")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+    # 与API相同的参数校验
+    try:
+        if args.bg_type == "color" and parse_color(args.bg_color) is None:
+            raise ValueError(f"无效的背景颜色格式: {args.bg_color}")
+        if not 0 <= args.crop_padding <= 1000:
+            raise ValueError("crop-padding必须在0到1000之间")
+        sizes = parse_sizes(args.sizes)
+        backgrounds = parse_backgrounds(args.backgrounds)
+        for background in backgrounds:
+            if background["type"] == "image" and not BackgroundAssetCache().has_asset(background["name"]):
+                raise ValueError(f"背景图不存在: {background['name']}")
+
+        paths = list(args.inputs)
+        if args.file_list:
+            with open(args.file_list, "r", encoding="utf-8") as f:
+                paths.extend(line.strip() for line in f if line.strip())
+        if not paths:
+            raise ValueError("没有指定输入图片或目录")
+        inputs = collect_inputs(paths)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+
+    settings = {
+        "bg_type": args.bg_type,
+        "bg_color": args.bg_color,
+        "crop": args.crop,
+        "crop_padding": args.crop_padding,
+        "sizes": sizes,
+        "backgrounds": backgrounds,
+        "batch_size": max(0, args.batch_size),
+    }
+    stats = run(inputs, os.path.abspath(args.output), settings, max(1, args.workers),
+                manifest_path=args.manifest, force=args.force, progress=not args.quiet)
+
+    print(f"共 {stats['total']} 张: 成功 {stats['succeeded']}，跳过 {stats['skipped']}，失败 {stats['failed']}，"
+          f"用时 {_format_duration(stats['elapsed'])}，吞吐量 {stats['throughput']:.2f} 张/秒")
+    print(f"清单: {stats['manifest']}")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -15,13 +15,6 @@ load_dotenv()
 # 当前文件是 app/config.py，所以需要往上两级才是项目根目录
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-# 打印调试信息
-print(f"配置中的BASE_DIR: {BASE_DIR}")
-print(f"models目录路径: {BASE_DIR / 'models'}")
-print(f"models目录是否存在: {(BASE_DIR / 'models').exists()}")
-print(f"模型文件路径: {BASE_DIR / 'models' / 'model.onnx'}")
-print(f"模型文件是否存在: {(BASE_DIR / 'models' / 'model.onnx').exists()}")
-
 # 应用设置
 APP_NAME = os.getenv("APP_NAME", "RMBG 抠图服务演示")
 APP_VERSION = os.getenv("APP_VERSION", "1.0.0")
@@ -39,8 +32,6 @@ MODEL_PATH = os.getenv("MODEL_PATH", str(BASE_DIR / "models" / "model.onnx"))
 if not os.path.isabs(MODEL_PATH):
     MODEL_PATH = os.path.abspath(os.path.join(str(BASE_DIR), MODEL_PATH))
 
-print(f"最终使用的MODEL_PATH: {MODEL_PATH}")
-
 MODEL_INPUT_SIZE = os.getenv("MODEL_INPUT_SIZE", "1024,1024")
 MODEL_INPUT_SIZE_LIST = [
     int(size) for size in MODEL_INPUT_SIZE.split(",") if size.strip().isdigit()
@@ -48,6 +39,165 @@ MODEL_INPUT_SIZE_LIST = [
 if len(MODEL_INPUT_SIZE_LIST) != 2:
     MODEL_INPUT_SIZE_LIST = [1024, 1024]  # 默认值
 
+# 使用替身模型代替真实模型(压测和基准测试用)，以及替身模型模拟的单张推理耗时
+MODEL_STAND_IN = os.getenv("MODEL_STAND_IN", "False").lower() in ("true", "1", "t")
+MODEL_STAND_IN_DELAY_MS = float(os.getenv("MODEL_STAND_IN_DELAY_MS", "50"))
+
+# 量化模型路径，降级时使用，文件不存在时跳过对应的降级级别
+MODEL_QUANTIZED_PATH = os.getenv("MODEL_QUANTIZED_PATH", str(BASE_DIR / "models" / "model_quantized.onnx"))
+if not os.path.isabs(MODEL_QUANTIZED_PATH):
+    MODEL_QUANTIZED_PATH = os.path.abspath(os.path.join(str(BASE_DIR), MODEL_QUANTIZED_PATH))
+
+# 推理引擎: python(在NumPy/PIL中做前后处理) 或 fused(使用 app.tools.compile_model 生成的包含前后处理的模型)
+# fused 时原模型的会话仍然加载，模型权重在内存中有两份
+MODEL_ENGINE = os.getenv("MODEL_ENGINE", "python").lower()
+MODEL_FUSED_PATH = os.getenv("MODEL_FUSED_PATH", str(BASE_DIR / "models" / "model_fused.onnx"))
+if not os.path.isabs(MODEL_FUSED_PATH):
+    MODEL_FUSED_PATH = os.path.abspath(os.path.join(str(BASE_DIR), MODEL_FUSED_PATH))
+
+# 是否使用跨进程共享的内存映射权重(需先运行 python -m app.models.shared_weights 导出)
+MODEL_SHARED_WEIGHTS = os.getenv("MODEL_SHARED_WEIGHTS", "False").lower() in ("true", "1", "t")
+
+# ONNX Runtime 调优设置
+# 每种主机类型的最优会话参数，由 python -m app.models.tuning 生成
+ORT_PROFILE_PATH = os.getenv("ORT_PROFILE_PATH", str(BASE_DIR / "models" / "ort_profile.json"))
+if not os.path.isabs(ORT_PROFILE_PATH):
+    ORT_PROFILE_PATH = os.path.abspath(os.path.join(str(BASE_DIR), ORT_PROFILE_PATH))
+# off: 只读取已有的调优结果; startup: 当前主机没有调优结果时在加载模型前调优
+ORT_AUTOTUNE = os.getenv("ORT_AUTOTUNE", "off").lower()
+# 覆盖调优配置中的算子内线程数(0表示不覆盖)，多进程批处理时按进程数分配核心
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS", "0"))
+# 是否使用IOBinding并复用预分配的输出缓冲区
+ORT_USE_IOBINDING = os.getenv("ORT_USE_IOBINDING", "True").lower() in ("true", "1", "t")
+
+# 绑核设置
+# off: 不绑核; worker: 每个推理进程领取一个互不重叠的CPU集合，推理线程数取其中的物理核数
+CPU_PINNING = os.getenv("CPU_PINNING", "off").lower()
+# CPU集合(槽位)数，通常等于同一主机上的推理进程数；0表示每个NUMA节点一个
+CPU_PINNING_SLOTS = int(os.getenv("CPU_PINNING_SLOTS", "0"))
+# 槽位锁文件目录，同一主机上共用一组槽位的进程必须相同
+CPU_PINNING_LOCK_DIR = os.getenv("CPU_PINNING_LOCK_DIR", "/tmp")
+
+# 裁剪到主体时，掩码值不超过该阈值的像素视为背景
+CROP_ALPHA_THRESHOLD = int(os.getenv("CROP_ALPHA_THRESHOLD", "8"))
+# 一次请求最多生成的尺寸数量
+MAX_OUTPUT_SIZES = int(os.getenv("MAX_OUTPUT_SIZES", "8"))
+# 客户端给出感兴趣区域时，边界框四周按其最长边的比例扩展后再裁剪推理，保留主体边缘的上下文
+ROI_PADDING = float(os.getenv("ROI_PADDING", "0.1"))
+
+# 渐进式返回设置
+# 预览图的最长边(像素)
+PREVIEW_MAX_SIZE = int(os.getenv("PREVIEW_MAX_SIZE", "512"))
+# 预览推理的模型输入尺寸(最长边，模型输入尺寸为动态时才生效)
+PREVIEW_INPUT_SIZE = int(os.getenv("PREVIEW_INPUT_SIZE", "320"))
+
+# 多背景合成设置
+# 预注册背景图所在目录，文件名(不含扩展名)即背景图名称
+BACKGROUND_ASSETS_DIR = os.getenv("BACKGROUND_ASSETS_DIR", str(BASE_DIR / "backgrounds"))
+if not os.path.isabs(BACKGROUND_ASSETS_DIR):
+    BACKGROUND_ASSETS_DIR = os.path.abspath(os.path.join(str(BASE_DIR), BACKGROUND_ASSETS_DIR))
+# 缩放后背景图缓存的容量(MB)
+BACKGROUND_CACHE_MB = float(os.getenv("BACKGROUND_CACHE_MB", "256"))
+# 缓存的解码后原始背景图数量，超出时淘汰最久未使用的
+BACKGROUND_ORIGINALS_MAX = int(os.getenv("BACKGROUND_ORIGINALS_MAX", "8"))
+# 一次请求最多合成的背景数量
+MAX_BACKGROUNDS = int(os.getenv("MAX_BACKGROUNDS", "6"))
+# 模糊背景的默认高斯模糊半径
+BACKGROUND_BLUR_RADIUS = float(os.getenv("BACKGROUND_BLUR_RADIUS", "20"))
+
+# 低内存模式：JPEG按目标尺寸缩小解码、在模型分辨率上量化掩码、按通道合成结果等，
+# 以少量画质差异换取更低的单请求峰值内存
+LOW_MEMORY_MODE = os.getenv("LOW_MEMORY_MODE", "False").lower() in ("true", "1", "t")
+# 单请求峰值内存统计: off、rss(每个请求启动一个线程采样进程常驻内存)
+# 或 tracemalloc(额外统计Python和NumPy分配，开销较大)
+MEMORY_ACCOUNTING = os.getenv("MEMORY_ACCOUNTING", "off").lower()
+# 常驻内存的采样间隔(毫秒)
+MEMORY_SAMPLE_MS = float(os.getenv("MEMORY_SAMPLE_MS", "2"))
+
+# 流式编码：PNG按行带压缩并边编码边发送，缩短首字节时间，编码缓冲区大小与图像高度无关
+STREAM_ENCODING = os.getenv("STREAM_ENCODING", "False").lower() in ("true", "1", "t")
+# 每个行带原始像素数据的字节数上限
+STREAM_BAND_BYTES = int(os.getenv("STREAM_BAND_BYTES", str(1024 * 1024)))
+
+# 并发与自适应降级设置
+# 同时处理的请求数，超出的请求排队等待
+PROCESSING_CONCURRENCY = int(os.getenv("PROCESSING_CONCURRENCY", "1"))
+# 是否在排队或推理耗时超过SLO时降级处理允许降级的请求
+DEGRADATION_ENABLED = os.getenv("DEGRADATION_ENABLED", "False").lower() in ("true", "1", "t")
+# 排队耗时和推理耗时的SLO(毫秒)，按观察窗口内的p95判断
+SLO_QUEUE_WAIT_MS = float(os.getenv("SLO_QUEUE_WAIT_MS", "500"))
+SLO_INFERENCE_MS = float(os.getenv("SLO_INFERENCE_MS", "2000"))
+# 允许的最高降级级别(0-3)
+DEGRADATION_MAX_LEVEL = int(os.getenv("DEGRADATION_MAX_LEVEL", "3"))
+# 观察窗口(秒)和判断所需的最少样本数
+DEGRADATION_WINDOW_S = float(os.getenv("DEGRADATION_WINDOW_S", "10"))
+DEGRADATION_MIN_SAMPLES = int(os.getenv("DEGRADATION_MIN_SAMPLES", "5"))
+# 两次级别切换之间的最短间隔(秒)
+DEGRADATION_COOLDOWN_S = float(os.getenv("DEGRADATION_COOLDOWN_S", "5"))
+# 压力(p95耗时/SLO)低于该比例时恢复一级
+DEGRADATION_RECOVER_RATIO = float(os.getenv("DEGRADATION_RECOVER_RATIO", "0.5"))
+
+# 分阶段流水线：解码、预处理、推理、后处理和编码各用一组线程，阶段之间用有界队列衔接，
+# 不同请求的不同阶段可以同时进行；要让多个请求同时进入流水线，PROCESSING_CONCURRENCY需大于1
+PIPELINE_ENABLED = os.getenv("PIPELINE_ENABLED", "False").lower() in ("true", "1", "t")
+PIPELINE_DECODE_WORKERS = int(os.getenv("PIPELINE_DECODE_WORKERS", "2"))
+PIPELINE_PREPROCESS_WORKERS = int(os.getenv("PIPELINE_PREPROCESS_WORKERS", "1"))
+PIPELINE_INFERENCE_WORKERS = int(os.getenv("PIPELINE_INFERENCE_WORKERS", "1"))
+PIPELINE_POSTPROCESS_WORKERS = int(os.getenv("PIPELINE_POSTPROCESS_WORKERS", "2"))
+PIPELINE_ENCODE_WORKERS = int(os.getenv("PIPELINE_ENCODE_WORKERS", "2"))
+# 每个阶段的等待队列长度，队列满时上游阻塞
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+# 相同请求合并：同一图片内容的推理正在进行时，后到的请求不占用处理名额，等待并共用它的掩码，各自合成
+COALESCING_ENABLED = os.getenv("COALESCING_ENABLED", "True").lower() in ("true", "1", "t")
+
+# 推理后端设置
+# local: 在当前进程内加载模型; shm: 通过共享内存将张量交给独立的推理进程;
+# remote: 通过TCP将张量交给一个或多个独立的推理服务
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "local").lower()
+SHM_SOCKET_PATH = os.getenv("SHM_SOCKET_PATH", "/tmp/rmbg-inference.sock")
+SHM_RING_SLOTS = int(os.getenv("SHM_RING_SLOTS", "8"))
+SHM_CLIENT_CONNECTIONS = int(os.getenv("SHM_CLIENT_CONNECTIONS", "2"))
+# 连接都在使用时，等待空闲连接的最长时间(秒)
+SHM_ACQUIRE_TIMEOUT_S = float(os.getenv("SHM_ACQUIRE_TIMEOUT_S", "30"))
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "4"))
+INFERENCE_BATCH_WAIT_MS = float(os.getenv("INFERENCE_BATCH_WAIT_MS", "5"))
+# TCP推理服务地址列表(主机:端口，逗号分隔)，请求按健康状态和负载分配
+REMOTE_BACKENDS = [
+    address.strip() for address in os.getenv("REMOTE_BACKENDS", "127.0.0.1:9100").split(",") if address.strip()
+]
+# 每个推理服务的最大连接数
+REMOTE_CLIENT_CONNECTIONS = int(os.getenv("REMOTE_CLIENT_CONNECTIONS", "4"))
+# 连接和读写超时(秒)
+REMOTE_TIMEOUT_S = float(os.getenv("REMOTE_TIMEOUT_S", "30"))
+# 连接失败的推理服务被摘除的时间(秒)，之后用一个请求试探是否恢复
+REMOTE_RETRY_S = float(os.getenv("REMOTE_RETRY_S", "5"))
+# 连续读写超时多少次后摘除推理服务，单次超时可能只是服务端繁忙
+REMOTE_MAX_TIMEOUTS = int(os.getenv("REMOTE_MAX_TIMEOUTS", "3"))
+# 传输张量的数据类型: float32 或 float16(数据量减半，掩码有微小误差)
+REMOTE_TENSOR_DTYPE = os.getenv("REMOTE_TENSOR_DTYPE", "float32").lower()
+# TCP推理服务的监听地址和单个请求张量的最大大小(MB)
+REMOTE_SERVER_HOST = os.getenv("REMOTE_SERVER_HOST", "0.0.0.0")
+REMOTE_SERVER_PORT = int(os.getenv("REMOTE_SERVER_PORT", "9100"))
+REMOTE_MAX_TENSOR_MB = float(os.getenv("REMOTE_MAX_TENSOR_MB", "256"))
+
+# 追踪设置
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "True").lower() in ("true", "1", "t")
+# 保存在内存中的慢请求追踪数量
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+# 耗时超过该值(毫秒)的请求才保存追踪
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "1000"))
+# 对该比例的请求启用ONNX Runtime算子级分析(0表示关闭)，同一时间只分析一个请求
+TRACE_ORT_PROFILE_RATE = float(os.getenv("TRACE_ORT_PROFILE_RATE", "0"))
+
+# 在线性能分析设置
+# 调用 /api/debug/profile 需要的令牌，为空时禁用该接口
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+# 单次采集的最长时间(秒)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# 采样模式的默认采样间隔(毫秒)
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+
 # 模板目录
 TEMPLATES_DIR = BASE_DIR / "app" / "templates"
 
@@ -3,6 +3,7 @@ FastAPI应用主入口点
 """
 
 import logging
+import os
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
@@ -10,7 +11,9 @@ from fastapi.templating import Jinja2Templates
 from starlette.middleware.cors import CORSMiddleware
 
 from app import config
+from app.api.debug import router as debug_router
 from app.api.routes import router as api_router
+from app.utils import tracing
 
 # 配置日志
 logging.basicConfig(
@@ -26,6 +29,9 @@ async def lifespan(app: FastAPI):
     logger.info(f"Starting {config.APP_NAME} v{config.APP_VERSION}")
     logger.info(f"Debug mode: {config.DEBUG}")
     logger.info(f"Model path: {config.MODEL_PATH}")
+    logger.debug(f"Base dir: {config.BASE_DIR}")
+    if config.INFERENCE_BACKEND == "local" and not config.MODEL_STAND_IN and not os.path.exists(config.MODEL_PATH):
+        logger.warning(f"Model file not found: {config.MODEL_PATH}")
 
     yield  # 应用运行期间
 
@@ -49,6 +55,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求追踪
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """为每个请求创建追踪，并通过traceparent响应头返回追踪上下文"""
+    if not config.TRACING_ENABLED:
+        return await call_next(request)
+
+    root, token = tracing.start_trace(
+        f"{request.method} {request.url.path}",
+        request.headers.get("traceparent"),
+        method=request.method,
+        path=request.url.path,
+    )
+    try:
+        response = await call_next(request)
+        root.set_attribute("status_code", response.status_code)
+    finally:
+        tracing.finish_trace(root, token)
+
+    response.headers["traceparent"] = root.traceparent()
+    return response
+
 # 挂载静态文件
 app.mount("/static", StaticFiles(directory=config.STATIC_DIR), name="static")
 
@@ -57,6 +85,7 @@ templates = Jinja2Templates(directory=config.TEMPLATES_DIR)
 
 # 包含API路由
 app.include_router(api_router)
+app.include_router(debug_router)
 
 # 根路由
 @app.get("/")
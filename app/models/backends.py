@@ -0,0 +1,109 @@
+"""
+推理后端接口
+
+SegmentationService 只通过该接口推理，HTTP、解码和编码的容量可以与推理容量分开扩展:
+    local: 在当前进程内用 ModelManager 推理
+    shm: 通过共享内存交给同一主机上的独立推理进程 (app.models.shared_memory)
+    remote: 通过TCP交给一个或多个独立推理服务，按健康状态和排队深度负载均衡 (app.models.remote)
+"""
+
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app import config
+from app.utils import tracing
+
+
+class InferenceBackend:
+    """推理后端基类"""
+
+    name = "base"
+
+    def get_input_size(self) -> List[int]:
+        """模型输入尺寸[宽度, 高度]"""
+        raise NotImplementedError
+
+    def run(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        """
+        执行推理
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+            variant: 模型变体名称，None表示主模型
+
+        返回:
+            掩码张量，形状为(批次, 1, 高度, 宽度)
+        """
+        raise NotImplementedError
+
+    def get_batch_size(self) -> int:
+        """离线批量处理时每次推理的批次大小"""
+        return config.INFERENCE_MAX_BATCH
+
+    def degradation_support(self) -> Dict[str, Any]:
+        """后端支持的降级方式: 是否接受更小的模型输入尺寸，以及可用的模型变体"""
+        return {"dynamic_input": False, "model_variants": []}
+
+    def get_model_info(self) -> Dict[str, Any]:
+        """获取模型信息"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """释放连接等资源"""
+
+
+class LocalBackend(InferenceBackend):
+    """在当前进程内推理"""
+
+    name = "local"
+
+    def __init__(self):
+        from app.models.model_manager import ModelManager
+
+        self.model_manager = ModelManager()
+
+    def get_input_size(self) -> List[int]:
+        return self.model_manager.get_input_size()
+
+    def run(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        if variant is not None and not self.model_manager.has_variant(variant):
+            variant = None
+
+        # 被抽样的请求使用开启分析器的会话，记录算子级耗时
+        span = tracing.current_span()
+        if span is not None and span.trace.profile_inference and variant is None:
+            output, events = self.model_manager.run_profiled(batch)
+            span.trace.add_profile_events(events, span)
+            return output
+        return self.model_manager.run(batch, variant)
+
+    def get_batch_size(self) -> int:
+        return self.model_manager.get_batch_size()
+
+    def degradation_support(self) -> Dict[str, Any]:
+        return {
+            "dynamic_input": self.model_manager.supports_dynamic_input(),
+            "model_variants": self.model_manager.get_variants(),
+        }
+
+    def get_model_info(self) -> Dict[str, Any]:
+        return self.model_manager.get_model_info()
+
+
+def create_backend() -> InferenceBackend:
+    """
+    按 INFERENCE_BACKEND 配置创建推理后端
+
+    返回:
+        推理后端实例，shm 和 remote 后端为进程内单例，复用连接池
+    """
+    if config.INFERENCE_BACKEND == "shm":
+        from app.models.shared_memory import SharedMemoryClient
+
+        return SharedMemoryClient()
+    if config.INFERENCE_BACKEND == "remote":
+        from app.models.remote import RemoteInferenceClient
+
+        return RemoteInferenceClient()
+    return LocalBackend()
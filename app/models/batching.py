@@ -0,0 +1,112 @@
+"""
+推理服务的凑批队列
+
+共享内存推理服务和TCP推理服务共用：请求线程提交待推理的请求并等待完成，
+单独的批处理线程把短时间内到达的同类请求合并成一个批次执行推理。
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PendingWork:
+    """
+    等待批处理的单个请求
+
+    key 相同的请求才能合并到同一批次，count 为请求包含的样本数
+    """
+
+    def __init__(self, key: Hashable, count: int = 1):
+        self.key = key
+        self.count = count
+        self.done = threading.Event()
+        self.error: Optional[str] = None
+
+
+class BatchQueue:
+    """把同时到达的同类请求合并成批次，由单独的线程依次执行"""
+
+    def __init__(self, run_batch: Callable[[List[PendingWork]], None], max_batch: int = 4,
+                 batch_wait: float = 0.005, name: str = "batcher"):
+        """
+        初始化凑批队列并启动批处理线程
+
+        参数:
+            run_batch: 执行一个批次的函数，结果写回各请求
+            max_batch: 一个批次最多包含的样本数
+            batch_wait: 凑批的最长等待时间(秒)
+            name: 批处理线程名称
+        """
+        self.run_batch = run_batch
+        self.max_batch = max(1, max_batch)
+        self.batch_wait = batch_wait
+        self._pending: "queue.Queue[Optional[PendingWork]]" = queue.Queue()
+        # 上一批放不下的请求，下一批从它开始，保持先到先处理
+        self._carry: Optional[PendingWork] = None
+        self._thread = threading.Thread(target=self._batch_loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, pending: PendingWork) -> None:
+        """提交请求到批处理队列"""
+        self._pending.put(pending)
+
+    def run(self, pending: PendingWork) -> None:
+        """提交请求并等待批次执行完成"""
+        self.submit(pending)
+        pending.done.wait()
+
+    def queue_depth(self) -> int:
+        """当前等待推理的请求数"""
+        return self._pending.qsize() + (self._carry is not None)
+
+    def _collect_batch(self) -> List[PendingWork]:
+        """阻塞等待第一个请求，再在等待窗口内收集同类请求组成批次"""
+        first, self._carry = self._carry or self._pending.get(), None
+        if first is None:
+            return []
+        batch = [first]
+        total = first.count
+        deadline = time.monotonic() + self.batch_wait
+        while total < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._pending.put(None)
+                break
+            if item.key != first.key or total + item.count > self.max_batch:
+                # 不同类或放不下的请求作为下一批的第一个请求
+                self._carry = item
+                break
+            batch.append(item)
+            total += item.count
+        return batch
+
+    def _batch_loop(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            if not batch:
+                return
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                logger.error(f"批量推理出错: {str(e)}")
+                for pending in batch:
+                    pending.error = str(e)
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+    def close(self, timeout: float = 5) -> None:
+        """停止批处理线程，已提交的请求处理完后退出"""
+        self._pending.put(None)
+        self._thread.join(timeout=timeout)
@@ -2,16 +2,23 @@
 模型管理器，负责加载和管理ONNX模型
 """
 
+import json
 import logging
 import os
+import tempfile
+import threading
 import time
 from pathlib import Path
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Set, Tuple, Dict, Any, Optional
 
 import numpy as np
 import onnxruntime as ort
 
 from app import config
+from app.models.shared_weights import SharedWeights, open_shared_weights
+from app.models.stand_in import StandInSession
+from app.models.tuning import DEFAULT_PROFILE, build_session_options, load_profile, tune_and_save
+from app.utils import cpu_topology
 
 logger = logging.getLogger(__name__)
 
@@ -36,11 +43,36 @@ class ModelManager:
         self.model_path = config.MODEL_PATH
         self.model_input_size = config.MODEL_INPUT_SIZE_LIST
         self.ort_session = None
+        # 包含前后处理的包装模型会话，MODEL_ENGINE=fused 时加载
+        self.fused_session = None
+        # 按需加载的模型变体(如量化模型)会话
+        self.variant_sessions: Dict[str, Any] = {}
+        self._variant_lock = threading.Lock()
+        self.shared_weights: Optional[SharedWeights] = None
+        self.session_profile: Dict[str, Any] = dict(DEFAULT_PROFILE)
+        self.use_iobinding = config.ORT_USE_IOBINDING
+        # 输出形状不支持IOBinding的模型变体，None为主模型
+        self._iobinding_unsupported: Set[Optional[str]] = set()
+        # 当前进程的绑核信息，未绑核时为None
+        self.cpu_pinning: Optional[Dict[str, Any]] = None
+        # 每个线程各自的预分配输出缓冲区，按输出形状缓存
+        self._output_buffers = threading.local()
+        # 同一时间只为一个抽样请求创建分析会话
+        self._profiling_lock = threading.Lock()
         self.load_model()
         self._initialized = True
 
     def load_model(self) -> None:
         """加载ONNX模型"""
+        # 先绑核再创建会话，推理线程和权重内存都落在所绑定的CPU和NUMA节点上
+        self.cpu_pinning = cpu_topology.pin_current_process()
+
+        if config.MODEL_STAND_IN:
+            logger.warning("使用替身模型，推理结果没有实际意义")
+            self.ort_session = StandInSession(self.model_input_size, config.MODEL_STAND_IN_DELAY_MS / 1000.0)
+            self.use_iobinding = False
+            return
+
         try:
             # 检查模型文件是否存在
             if not Path(self.model_path).exists():
@@ -54,34 +86,289 @@ class ModelManager:
             start_time = time.time()
             logger.info(f"正在加载模型: {self.model_path}")
 
-            # 配置ONNX运行时
-            session_options = ort.SessionOptions()
-            session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            # 配置ONNX运行时，使用当前主机类型的调优结果
+            self.session_profile = self._load_session_profile()
+            session_options = self._session_options()
+
+            # 使用内存映射的共享权重，同一主机上的进程共享同一份物理内存
+            if config.MODEL_SHARED_WEIGHTS:
+                self.shared_weights = open_shared_weights(self.model_path)
+                if self.shared_weights is not None:
+                    logger.info(f"使用共享权重: {self.shared_weights.nbytes / 1024 / 1024:.1f} MB")
 
             # 加载模型
-            self.ort_session = ort.InferenceSession(
-                self.model_path,
-                sess_options=session_options
-            )
+            self.ort_session = self._create_session(session_options)
 
             # 记录完成时间
             elapsed_time = time.time() - start_time
             logger.info(f"模型加载完成，用时: {elapsed_time:.2f}秒")
 
+            # 原模型的会话仍然保留：模型信息、批次和动态尺寸判断、共享内存和TCP推理服务以及降级时的
+            # Python前后处理都使用它，包装模型另外加载一份权重
+            if config.MODEL_ENGINE == "fused":
+                self.fused_session = self._load_fused_session()
+
         except Exception as e:
             logger.error(f"加载模型时出错: {str(e)}")
             raise RuntimeError(f"无法加载ONNX模型: {str(e)}")
 
-    def get_session(self) -> ort.InferenceSession:
-        """获取ONNX会话实例"""
+    def _create_session(self, session_options: ort.SessionOptions) -> ort.InferenceSession:
+        """按主模型的方式创建会话，使用共享权重时交给ONNX Runtime同一份内存映射的权重"""
+        if self.shared_weights is None:
+            return ort.InferenceSession(self.model_path, sess_options=session_options)
+        self.shared_weights.apply(session_options)
+        return ort.InferenceSession(
+            self.shared_weights.model_path,
+            sess_options=session_options,
+            disabled_optimizers=self.shared_weights.disabled_optimizers,
+        )
+
+    def _load_fused_session(self) -> Optional[ort.InferenceSession]:
+        """加载包含前后处理的包装模型，文件不存在时退回Python前后处理"""
+        if not Path(config.MODEL_FUSED_PATH).exists():
+            logger.warning(f"包装模型不存在: {config.MODEL_FUSED_PATH}，使用Python前后处理；"
+                           f"可用 python -m app.tools.compile_model 生成")
+            return None
+        start_time = time.time()
+        session = ort.InferenceSession(config.MODEL_FUSED_PATH, sess_options=self._session_options())
+        logger.info(f"包装模型加载完成，用时: {time.time() - start_time:.2f}秒，原模型的会话同时保留，"
+                    f"权重占用约为 MODEL_ENGINE=python 时的两倍")
+        return session
+
+    def _load_session_profile(self) -> Dict[str, Any]:
+        """读取当前主机的调优配置，按需在启动时调优"""
+        profile = load_profile(config.ORT_PROFILE_PATH)
+        if profile is None and config.ORT_AUTOTUNE == "startup":
+            logger.info("当前主机没有调优配置，开始调优会话参数")
+            try:
+                profile = tune_and_save()["profile"]
+            except Exception as e:
+                logger.error(f"调优会话参数时出错: {str(e)}")
+        if profile is None:
+            profile = dict(DEFAULT_PROFILE)
+        else:
+            logger.info(f"使用调优配置: {profile}")
+            profile = dict(profile, tuned=True)
+        if config.ORT_INTRA_OP_THREADS > 0:
+            profile["intra_op_num_threads"] = config.ORT_INTRA_OP_THREADS
+        if self.cpu_pinning is not None:
+            # 绑核时线程数取所绑定CPU集合中的物理核数
+            profile["intra_op_num_threads"] = self.cpu_pinning["threads"]
+        return profile
+
+    def _session_options(self) -> ort.SessionOptions:
+        """按调优配置创建会话选项，绑核时把推理线程固定到各物理核上"""
+        session_options = build_session_options(self.session_profile)
+        if self.cpu_pinning is not None:
+            cpu_topology.apply_to_session_options(session_options, self.cpu_pinning)
+        return session_options
+
+    def get_batch_size(self) -> int:
+        """调优得到的推理批次大小，未调优时使用配置值"""
+        if self.session_profile.get("tuned"):
+            return int(self.session_profile["batch_size"])
+        return config.INFERENCE_MAX_BATCH
+
+    def get_session(self, variant: Optional[str] = None) -> ort.InferenceSession:
+        """
+        获取ONNX会话实例
+
+        参数:
+            variant: 模型变体名称，None表示主模型；变体会话在第一次使用时加载
+        """
+        if variant is not None:
+            return self._get_variant_session(variant)
         if self.ort_session is None:
             self.load_model()
         return self.ort_session
 
+    def _variant_path(self, variant: str) -> str:
+        if variant == "quantized":
+            return config.MODEL_QUANTIZED_PATH
+        raise ValueError(f"未知的模型变体: {variant}")
+
+    def has_variant(self, variant: str) -> bool:
+        """模型变体是否可用"""
+        if variant in self.variant_sessions or isinstance(self.ort_session, StandInSession):
+            return True
+        try:
+            return Path(self._variant_path(variant)).exists()
+        except ValueError:
+            return False
+
+    def get_variants(self) -> List[str]:
+        """可用的模型变体"""
+        return [variant for variant in ("quantized",) if self.has_variant(variant)]
+
+    def _get_variant_session(self, variant: str) -> Any:
+        """加载并缓存模型变体会话，使用与主模型相同的会话参数"""
+        session = self.variant_sessions.get(variant)
+        if session is not None:
+            return session
+
+        with self._variant_lock:
+            session = self.variant_sessions.get(variant)
+            if session is not None:
+                return session
+            if isinstance(self.get_session(), StandInSession):
+                # 替身模型的量化变体按一半的推理耗时模拟
+                session = StandInSession(self.model_input_size, config.MODEL_STAND_IN_DELAY_MS / 2000.0)
+            else:
+                path = self._variant_path(variant)
+                try:
+                    start_time = time.time()
+                    session = ort.InferenceSession(path, sess_options=self._session_options())
+                    logger.info(f"模型变体 {variant} 加载完成，用时: {time.time() - start_time:.2f}秒")
+                except Exception as e:
+                    logger.error(f"加载模型变体时出错: {str(e)}")
+                    raise RuntimeError(f"无法加载模型变体 {variant}: {str(e)}")
+            self.variant_sessions[variant] = session
+            return session
+
     def get_input_size(self) -> List[int]:
         """获取模型输入尺寸"""
         return self.model_input_size
 
+    def has_fused_engine(self) -> bool:
+        """是否已加载包含前后处理的包装模型"""
+        return self.fused_session is not None
+
+    def run_fused(self, image: np.ndarray, input_size: List[int]) -> np.ndarray:
+        """
+        用包装模型完成缩放、归一化、推理、掩码缩放回原图尺寸和拉伸
+
+        参数:
+            image: (高, 宽, 3) uint8 RGB图像
+            input_size: 模型输入尺寸(宽度, 高度)
+
+        返回:
+            (高, 宽) uint8 掩码
+        """
+        width, height = input_size
+        return self.fused_session.run(None, {
+            "image": np.ascontiguousarray(image),
+            "target_size": np.array([height, width], dtype=np.int64),
+        })[0]
+
+    def supports_batching(self) -> bool:
+        """模型输入的批次维度是否允许大于1"""
+        batch_dim = self.get_session().get_inputs()[0].shape[0]
+        return not isinstance(batch_dim, int) or batch_dim != 1
+
+    def supports_dynamic_input(self) -> bool:
+        """模型输入的高度和宽度是否为动态维度，是则可以用更小的输入尺寸推理"""
+        shape = self.get_session().get_inputs()[0].shape
+        return len(shape) == 4 and not any(isinstance(dim, int) for dim in shape[2:])
+
+    def run(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        """
+        执行推理并返回模型的第一个输出
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+            variant: 模型变体名称，None表示主模型
+
+        返回:
+            模型输出的掩码张量，形状为(批次, 1, 高度, 宽度)
+        """
+        if batch.shape[0] == 1 or self.supports_batching():
+            return self._run_session(batch, variant)
+
+        # 模型批次维度固定为1时逐张推理；IOBinding每次返回同一个缓冲区，逐张复制到各自的行
+        outputs: Optional[np.ndarray] = None
+        for i in range(batch.shape[0]):
+            output = self._run_session(batch[i:i + 1], variant)
+            if outputs is None:
+                outputs = np.empty((batch.shape[0],) + output.shape[1:], dtype=output.dtype)
+            outputs[i] = output[0]
+        return outputs
+
+    def _run_session(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        """执行一次会话推理，优先使用IOBinding"""
+        session = self.get_session(variant)
+        input_name = session.get_inputs()[0].name
+
+        if self.use_iobinding and variant not in self._iobinding_unsupported:
+            try:
+                return self._run_with_iobinding(session, input_name, batch)
+            except ValueError as e:
+                # 模型的输出维度不支持预分配缓冲区，该模型以后都使用普通推理
+                logger.warning(f"模型不支持IOBinding，改用普通推理: {str(e)}")
+                self._iobinding_unsupported.add(variant)
+            except Exception as e:
+                # 其他错误只影响这一次推理
+                logger.warning(f"IOBinding推理失败，本次改用普通推理: {str(e)}")
+
+        return session.run(None, {input_name: batch})[0]
+
+    def _run_with_iobinding(self, session: ort.InferenceSession, input_name: str,
+                            batch: np.ndarray) -> np.ndarray:
+        """
+        使用IOBinding推理，输出直接写入预分配的缓冲区
+
+        返回的数组在同一线程下一次推理时会被覆盖，调用方需要在此之前用完或复制
+        """
+        output = session.get_outputs()[0]
+        shape = self._expected_output_shape(output.shape, batch.shape)
+        buffers = getattr(self._output_buffers, "buffers", None)
+        if buffers is None:
+            buffers = self._output_buffers.buffers = {}
+        buffer = buffers.get(shape)
+        if buffer is None:
+            buffer = buffers[shape] = np.empty(shape, dtype=np.float32)
+
+        binding = session.io_binding()
+        binding.bind_cpu_input(input_name, np.ascontiguousarray(batch))
+        binding.bind_output(output.name, "cpu", 0, np.float32, list(shape), buffer.ctypes.data)
+        session.run_with_iobinding(binding)
+        return buffer
+
+    def run_profiled(self, batch: np.ndarray) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """
+        在开启ONNX Runtime分析器的临时会话上推理，用于解释个别慢请求
+
+        分析器按会话开启，end_profiling 之后无法重新开始，所以每个抽样请求各用一个会话。
+        会话与主模型使用相同的调优选项和共享权重，不另外复制一份权重；同一时间只创建一个，
+        其他抽样请求在这期间直接使用主模型会话推理，不记录算子级事件
+
+        参数:
+            batch: 预处理后的输入张量
+
+        返回:
+            模型输出和Chrome Trace Event格式的算子级事件
+        """
+        if isinstance(self.get_session(), StandInSession):
+            return self.run(batch), []
+
+        if not self._profiling_lock.acquire(blocking=False):
+            return self.run(batch), []
+        try:
+            session_options = self._session_options()
+            session_options.enable_profiling = True
+            with tempfile.TemporaryDirectory() as profile_dir:
+                session_options.profile_file_prefix = os.path.join(profile_dir, "ort_profile")
+                session = self._create_session(session_options)
+                input_name = session.get_inputs()[0].name
+                output = session.run(None, {input_name: batch})[0]
+                profile_path = session.end_profiling()
+                with open(profile_path, "r", encoding="utf-8") as f:
+                    events = json.load(f)
+        finally:
+            self._profiling_lock.release()
+        return output, events
+
+    @staticmethod
+    def _expected_output_shape(declared: List[Any], input_shape: Tuple[int, ...]) -> Tuple[int, ...]:
+        """根据模型声明的输出形状推断实际形状，动态维度按(批次, 1, 高, 宽)补齐"""
+        batch_size, _, height, width = input_shape
+        defaults = (batch_size, 1, height, width)
+        if len(declared) != 4:
+            raise ValueError(f"不支持的输出维度: {declared}")
+        return tuple(
+            dim if isinstance(dim, int) and index > 0 else defaults[index]
+            for index, dim in enumerate(declared)
+        )
+
     def get_model_info(self) -> Dict[str, Any]:
         """获取模型信息"""
         if self.ort_session is None:
@@ -98,6 +385,13 @@ class ModelManager:
                 "model_path": self.model_path,
                 "input_size": self.model_input_size,
                 "model_name": getattr(metadata, "name", "Unknown"),  # 安全访问 name 属性
+                "shared_weights": self.shared_weights is not None,
+                "session_profile": self.session_profile,
+                "iobinding": self.use_iobinding,
+                "engine": "fused" if self.has_fused_engine() else "python",
+                "cpu_topology": cpu_topology.describe_topology(),
+                "dynamic_input": self.supports_dynamic_input(),
+                "model_variants": self.get_variants(),
                 "inputs": [
                     {
                         "name": inp.name,
@@ -0,0 +1,589 @@
+"""
+TCP推理服务与负载均衡客户端
+
+前端进程把预处理后的张量以紧凑的二进制格式发给独立的推理服务，推理服务可以部署在其他主机上，
+与HTTP、解码和编码的容量分开扩展。每条消息是定长的消息头加原始张量数据，不经过JSON或Base64；
+连接在请求之间保持，客户端为每个推理服务维护一个连接池。
+
+推理服务把同时到达的同尺寸、同模型变体的请求合并成一个批次，每个响应带回服务端正在处理的请求数。
+客户端按健康状态、本地在途请求数和服务端报告的请求数选择推理服务；连接失败或断开的服务暂时摘除，
+请求改发到其他服务，经过 REMOTE_RETRY_S 后再用一个请求试探是否恢复。读写超时可能只是服务端繁忙，
+连续 REMOTE_MAX_TIMEOUTS 次超时才摘除；超时的请求不改发到其他服务。
+
+启动推理服务:
+    python -m app.models.remote --port 9100
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app import config
+from app.models.backends import InferenceBackend, LocalBackend
+from app.models.batching import BatchQueue, PendingWork
+from app.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 消息格式
+# 请求头: 魔数, 操作码, 张量数据类型, 模型变体名称长度, 批次, 通道, 高度, 宽度
+# 之后依次是模型变体名称和张量数据
+_REQUEST = struct.Struct("!2sBBHIIII")
+# 响应头: 状态码, 张量数据类型, 服务端正在处理的请求数, 批次, 通道, 高度, 宽度, 附加数据长度
+# 之后是张量数据、JSON或错误信息
+_RESPONSE = struct.Struct("!BBHIIIII")
+_MAGIC = b"RB"
+
+OP_RUN = 1
+OP_INFO = 2
+OP_HEALTH = 3
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# 张量数据类型，数据按小端序排列；float16 数据量减半，掩码有微小误差
+DTYPES = {0: np.dtype("<f4"), 1: np.dtype("<f2")}
+DTYPE_CODES = {"float32": 0, "float16": 1}
+
+_requests = registry.counter("rmbg_remote_requests_total", "发往各推理服务的推理请求数", ("backend", "outcome"))
+_healthy = registry.gauge("rmbg_remote_backend_healthy", "推理服务是否健康(1健康，0已摘除)", ("backend",))
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytearray:
+    """从套接字读取固定长度的数据到新缓冲区，连接关闭时抛出ConnectionError"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionError("连接已关闭")
+        received += count
+    return buffer
+
+
+def _set_nodelay(sock: socket.socket) -> None:
+    # 消息头和数据分开发送，关闭Nagle算法避免等待确认
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _PendingTensor(PendingWork):
+    """等待批处理的一个请求，同尺寸、同模型变体的请求可以合并"""
+
+    def __init__(self, tensor: np.ndarray, variant: Optional[str], dtype_code: int):
+        super().__init__((variant,) + tuple(tensor.shape[1:]), tensor.shape[0])
+        self.tensor = tensor
+        self.variant = variant
+        self.dtype_code = dtype_code
+        self.output_shape: Tuple[int, ...] = (0, 0, 0, 0)
+        self.payload = b""
+
+
+class _RemoteHandler(socketserver.BaseRequestHandler):
+    """处理一个客户端连接上的连续请求"""
+
+    server: "RemoteInferenceServer"
+
+    def setup(self) -> None:
+        _set_nodelay(self.request)
+
+    def handle(self) -> None:
+        try:
+            while True:
+                magic, op, dtype_code, variant_length, *shape = _REQUEST.unpack(
+                    _recv_exact(self.request, _REQUEST.size))
+                if magic != _MAGIC:
+                    # 无法确定消息边界，只能关闭连接
+                    self._send_error("协议错误")
+                    return
+                variant = _recv_exact(self.request, variant_length).decode() if variant_length else None
+
+                if op == OP_RUN:
+                    if not self._handle_run(dtype_code, variant, shape):
+                        return
+                elif op == OP_INFO:
+                    payload = json.dumps(self.server.get_model_info(), default=str).encode()
+                    self._send(STATUS_OK, payload=payload)
+                elif op == OP_HEALTH:
+                    self._send(STATUS_OK)
+                else:
+                    self._send_error(f"未知操作码: {op}")
+        except ConnectionError:
+            pass
+
+    def _handle_run(self, dtype_code: int, variant: Optional[str], shape: List[int]) -> bool:
+        """执行一次推理，请求无效且无法跳过其数据时返回False"""
+        dtype = DTYPES.get(dtype_code)
+        size = int(np.prod(shape)) * (dtype.itemsize if dtype is not None else 0)
+        if dtype is None or shape[0] == 0 or size > self.server.max_tensor_bytes:
+            self._send_error(f"不支持的张量: 数据类型 {dtype_code}, 形状 {shape}")
+            return False
+
+        tensor = np.frombuffer(_recv_exact(self.request, size), dtype=dtype).reshape(shape)
+        pending = _PendingTensor(tensor.astype(np.float32, copy=False), variant, dtype_code)
+        self.server.run(pending)
+        if pending.error is not None:
+            self._send_error(pending.error)
+        else:
+            self._send(STATUS_OK, dtype_code, pending.output_shape, pending.payload)
+        return True
+
+    def _send(self, status: int, dtype_code: int = 0, shape: Sequence[int] = (0, 0, 0, 0),
+              payload: bytes = b"") -> None:
+        depth = min(self.server.active_requests(), 0xFFFF)
+        self.request.sendall(_RESPONSE.pack(status, dtype_code, depth, *shape, len(payload)))
+        if payload:
+            self.request.sendall(payload)
+
+    def _send_error(self, message: str) -> None:
+        self._send(STATUS_ERROR, payload=message.encode())
+
+
+class RemoteInferenceServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    TCP推理服务
+
+    每个连接一个线程，批处理线程把同时到达的请求合并成一个批次执行推理
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], run_batch: Callable[[np.ndarray, Optional[str]], np.ndarray],
+                 max_batch: int = 4, batch_wait: float = 0.005,
+                 model_info: Optional[Callable[[], Dict[str, Any]]] = None, max_tensor_bytes: int = 256 << 20):
+        """
+        初始化推理服务
+
+        参数:
+            address: 监听的(主机, 端口)，端口为0时由系统分配
+            run_batch: 批量推理函数，输入(批次, 3, 高, 宽)和模型变体，输出(批次, 1, 高, 宽)
+            max_batch: 单次推理的最大批次
+            batch_wait: 凑批的最长等待时间(秒)
+            model_info: 返回模型信息的函数
+            max_tensor_bytes: 单个请求张量数据的最大字节数
+        """
+        self.run_batch = run_batch
+        self.model_info = model_info
+        self.max_tensor_bytes = max_tensor_bytes
+        self._active = 0
+        self._active_lock = threading.Lock()
+
+        super().__init__(address, _RemoteHandler)
+        self.batches = BatchQueue(self._run_batch, max_batch, batch_wait, name="remote-batcher")
+        host, port = self.server_address[:2]
+        logger.info(f"TCP推理服务已启动: {host}:{port}, 最大批次: {max_batch}")
+
+    def run(self, pending: _PendingTensor) -> None:
+        """提交请求并等待推理完成"""
+        with self._active_lock:
+            self._active += 1
+        try:
+            self.batches.run(pending)
+        finally:
+            with self._active_lock:
+                self._active -= 1
+
+    def active_requests(self) -> int:
+        """正在排队或推理的请求数"""
+        return self._active
+
+    def get_model_info(self) -> Dict[str, Any]:
+        """获取模型信息"""
+        info = self.model_info() if self.model_info else {"status": "loaded"}
+        info["backend"] = "remote"
+        info["active_requests"] = self.active_requests()
+        return info
+
+    def _run_batch(self, batch: List[_PendingTensor]) -> None:
+        """执行一个批次的推理并把各请求的掩码编码为响应数据"""
+        first = batch[0]
+        if len(batch) == 1:
+            inputs = first.tensor
+        else:
+            inputs = np.concatenate([pending.tensor for pending in batch])
+        outputs = self.run_batch(inputs, first.variant)
+
+        start = 0
+        for pending in batch:
+            mask = outputs[start:start + pending.count]
+            start += pending.count
+            # 输出可能是下一批推理会覆盖的缓冲区，在批处理线程中编码成独立的字节
+            pending.output_shape = mask.shape
+            pending.payload = mask.astype(DTYPES[pending.dtype_code], copy=False).tobytes()
+
+    def server_close(self) -> None:
+        """关闭服务并停止批处理线程"""
+        super().server_close()
+        self.batches.close()
+
+
+class _RemoteConnection:
+    """到推理服务的一个持久连接"""
+
+    def __init__(self, address: Tuple[str, int], timeout: float):
+        try:
+            self.sock = socket.create_connection(address, timeout=timeout)
+        except socket.timeout as e:
+            # 连接超时说明服务不可达，与读写超时区分开
+            raise ConnectionError(f"连接推理服务超时: {str(e)}")
+        _set_nodelay(self.sock)
+
+    def request(self, op: int, tensor: Optional[np.ndarray] = None, variant: Optional[str] = None,
+                dtype_code: int = 0) -> Tuple[int, int, Tuple[int, ...], bytearray]:
+        """
+        发送一个请求并读取响应
+
+        返回:
+            (张量数据类型, 服务端正在处理的请求数, 张量形状, 附加数据)
+
+        异常:
+            RuntimeError: 推理服务返回错误
+            socket.timeout: 读写超时
+            ConnectionError/OSError: 连接失败或中断
+        """
+        shape = tensor.shape if tensor is not None else (0, 0, 0, 0)
+        variant_bytes = variant.encode() if variant else b""
+        self.sock.sendall(_REQUEST.pack(_MAGIC, op, dtype_code, len(variant_bytes), *shape) + variant_bytes)
+        if tensor is not None:
+            data = np.ascontiguousarray(tensor, dtype=DTYPES[dtype_code])
+            self.sock.sendall(memoryview(data).cast("B"))
+
+        status, out_dtype, depth, *out_shape, length = _RESPONSE.unpack(_recv_exact(self.sock, _RESPONSE.size))
+        payload = _recv_exact(self.sock, length) if length else bytearray()
+        if status != STATUS_OK:
+            raise RuntimeError(payload.decode())
+        return out_dtype, depth, tuple(out_shape), payload
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class RemoteBackend:
+    """一个推理服务的连接池和健康状态"""
+
+    def __init__(self, address: str, pool_size: int, timeout: float, retry_after: float, max_timeouts: int = 3):
+        """
+        参数:
+            address: 推理服务地址，格式为 主机:端口
+            pool_size: 最多同时打开的连接数
+            timeout: 连接和读写超时(秒)
+            retry_after: 连接失败后摘除的时间(秒)
+            max_timeouts: 连续读写超时多少次后摘除
+        """
+        host, port = address.rsplit(":", 1)
+        self.address = address
+        self._address = (host, int(port))
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.max_timeouts = max(1, max_timeouts)
+        self._slots = threading.BoundedSemaphore(max(1, pool_size))
+        self._idle: "queue.LifoQueue[_RemoteConnection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+        self.in_flight = 0
+        # 服务端最近一次报告的正在处理的请求数
+        self.server_active = 0
+        self.healthy = True
+        self.failures = 0
+        # 连续读写超时的次数
+        self.timeouts = 0
+        self.last_error: Optional[str] = None
+        self._retry_at = 0.0
+        _healthy.set(1, backend=address)
+
+    def load(self) -> int:
+        """负载: 本地在途请求数加服务端报告的正在处理的请求数"""
+        return self.in_flight + self.server_active
+
+    def claim_probe(self, now: float) -> bool:
+        """已摘除的服务到了重试时间时，让一个请求去试探，其他请求继续等到下一次重试时间"""
+        with self._lock:
+            if self.healthy or now < self._retry_at:
+                return False
+            self._retry_at = now + self.retry_after
+            return True
+
+    def call(self, op: int, tensor: Optional[np.ndarray] = None, variant: Optional[str] = None,
+             dtype_code: int = 0) -> Tuple[int, int, Tuple[int, ...], bytearray]:
+        """
+        用池中的连接发送一个请求，连接失败或断开时摘除该服务
+
+        异常:
+            RuntimeError: 推理服务返回错误或等待连接超时
+            socket.timeout: 读写超时，连续超时 max_timeouts 次后摘除该服务
+            ConnectionError/OSError: 连接失败或断开，服务已被摘除
+        """
+        with self._lock:
+            self.in_flight += 1
+        try:
+            if not self._slots.acquire(timeout=self.timeout):
+                raise RuntimeError(f"等待推理服务 {self.address} 的连接超时")
+            try:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = _RemoteConnection(self._address, self.timeout)
+                try:
+                    result = conn.request(op, tensor, variant, dtype_code)
+                except Exception:
+                    # 服务端遇到无效请求时会关闭连接，出错的连接不再复用
+                    conn.close()
+                    raise
+                self._idle.put(conn)
+            finally:
+                self._slots.release()
+        except socket.timeout as e:
+            self._timed_out(e)
+            raise
+        except (ConnectionError, OSError) as e:
+            self._mark_down(e)
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        self._mark_up(result[1])
+        return result
+
+    def _mark_up(self, server_active: int) -> None:
+        with self._lock:
+            self.server_active = server_active
+            if not self.healthy:
+                logger.info(f"推理服务已恢复: {self.address}")
+                _healthy.set(1, backend=self.address)
+            self.healthy = True
+            self.failures = 0
+            self.timeouts = 0
+
+    def _timed_out(self, error: Exception) -> None:
+        """读写超时可能只是服务端繁忙，连续超时达到 max_timeouts 次才摘除"""
+        with self._lock:
+            self.timeouts += 1
+            self.last_error = str(error)
+            if self.timeouts < self.max_timeouts:
+                logger.warning(f"推理服务响应超时({self.timeouts}/{self.max_timeouts}): {self.address}")
+                return
+        self._mark_down(error)
+
+    def _mark_down(self, error: Exception) -> None:
+        with self._lock:
+            if self.healthy:
+                logger.warning(f"推理服务不可用，暂时摘除: {self.address}: {str(error)}")
+                _healthy.set(0, backend=self.address)
+            self.healthy = False
+            self.failures += 1
+            self.last_error = str(error)
+            self._retry_at = time.monotonic() + self.retry_after
+        # 同一服务的其他空闲连接大概率也已失效
+        self._close_idle()
+
+    def _close_idle(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取健康状态和负载"""
+        with self._lock:
+            return {
+                "address": self.address,
+                "healthy": self.healthy,
+                "in_flight": self.in_flight,
+                "server_active": self.server_active,
+                "failures": self.failures,
+                "timeouts": self.timeouts,
+                "last_error": self.last_error,
+            }
+
+    def close(self) -> None:
+        """关闭所有空闲连接"""
+        self._close_idle()
+
+
+class RemoteInferenceClient(InferenceBackend):
+    """通过TCP推理服务推理，在多个服务之间按健康状态和负载均衡"""
+
+    name = "remote"
+    _instance = None
+
+    def __new__(cls):
+        """单例模式，同一进程内复用连接池和健康状态"""
+        if cls._instance is None:
+            cls._instance = super(RemoteInferenceClient, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        """初始化客户端"""
+        if self._initialized:
+            return
+        if not config.REMOTE_BACKENDS:
+            raise RuntimeError("未配置推理服务地址 REMOTE_BACKENDS")
+
+        self.backends = [
+            RemoteBackend(address, config.REMOTE_CLIENT_CONNECTIONS, config.REMOTE_TIMEOUT_S, config.REMOTE_RETRY_S,
+                          config.REMOTE_MAX_TIMEOUTS)
+            for address in config.REMOTE_BACKENDS
+        ]
+        if config.REMOTE_TENSOR_DTYPE not in DTYPE_CODES:
+            raise ValueError(f"不支持的张量数据类型: {config.REMOTE_TENSOR_DTYPE}")
+        self.dtype_code = DTYPE_CODES[config.REMOTE_TENSOR_DTYPE]
+        self._rotation = itertools.count()
+        self._model_info: Optional[Dict[str, Any]] = None
+        self._initialized = True
+
+    def _choose(self, exclude: List[RemoteBackend]) -> Optional[RemoteBackend]:
+        """
+        选择处理下一个请求的推理服务
+
+        到了重试时间的已摘除服务优先用于试探；否则在健康的服务中选择负载最低的，
+        负载相同时轮流选择，避免请求都落到列表中的第一个服务
+        """
+        now = time.monotonic()
+        for backend in self.backends:
+            if backend not in exclude and backend.claim_probe(now):
+                return backend
+
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            return None
+        offset = next(self._rotation)
+        rotated = [candidates[(offset + i) % len(candidates)] for i in range(len(candidates))]
+        return min(rotated, key=lambda backend: backend.load())
+
+    def _call(self, op: int, tensor: Optional[np.ndarray] = None,
+              variant: Optional[str] = None) -> Tuple[int, int, Tuple[int, ...], bytearray]:
+        """
+        发送请求，连接失败时改发到其他推理服务
+
+        异常:
+            socket.timeout: 读写超时；推理服务可能仍在处理该请求，不改发到其他服务，避免重复推理
+            RuntimeError: 没有可用的推理服务
+        """
+        tried: List[RemoteBackend] = []
+        last_error: Optional[Exception] = None
+        while True:
+            backend = self._choose(tried)
+            if backend is None:
+                detail = f": {str(last_error)}" if last_error is not None else ""
+                raise RuntimeError(f"没有可用的推理服务{detail}")
+            try:
+                result = backend.call(op, tensor, variant, self.dtype_code)
+            except socket.timeout:
+                if op == OP_RUN:
+                    _requests.inc(backend=backend.address, outcome="timeout")
+                raise
+            except (ConnectionError, OSError) as e:
+                if op == OP_RUN:
+                    _requests.inc(backend=backend.address, outcome="failed")
+                tried.append(backend)
+                last_error = e
+                continue
+            if op == OP_RUN:
+                _requests.inc(backend=backend.address, outcome="ok")
+            return result
+
+    def run(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        """
+        通过推理服务执行推理
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+            variant: 模型变体名称，推理服务没有该变体时使用主模型
+
+        返回:
+            掩码张量，形状为(批次, 1, 高度, 宽度)
+        """
+        dtype_code, _, shape, payload = self._call(OP_RUN, batch, variant)
+        return np.frombuffer(payload, dtype=DTYPES[dtype_code]).reshape(shape).astype(np.float32, copy=False)
+
+    def _info(self) -> Dict[str, Any]:
+        """推理服务的模型信息，各推理服务应加载同一个模型，只读取一次"""
+        if self._model_info is None:
+            _, _, _, payload = self._call(OP_INFO)
+            self._model_info = json.loads(payload)
+        return self._model_info
+
+    def get_input_size(self) -> List[int]:
+        """模型输入尺寸[宽度, 高度]，取自推理服务的模型信息"""
+        return list(self._info()["input_size"])
+
+    def degradation_support(self) -> Dict[str, Any]:
+        """推理服务接受任意尺寸的张量，降级能力取决于其加载的模型"""
+        info = self._info()
+        return {
+            "dynamic_input": bool(info.get("dynamic_input")),
+            "model_variants": list(info.get("model_variants") or []),
+        }
+
+    def get_model_info(self) -> Dict[str, Any]:
+        """
+        获取模型信息和各推理服务的状态
+
+        健康状态和负载取自推理请求时记录的状态，不逐个探测推理服务，
+        避免已摘除或繁忙的服务让接口阻塞 REMOTE_TIMEOUT_S 秒
+        """
+        try:
+            info = dict(self._info())
+        except Exception as e:
+            info = {"status": "error", "error": str(e)}
+        info["backend"] = "remote"
+        info["backends"] = [backend.get_stats() for backend in self.backends]
+        return info
+
+    def close(self) -> None:
+        """关闭所有空闲连接"""
+        for backend in self.backends:
+            backend.close()
+
+
+def serve(argv: Optional[List[str]] = None) -> None:
+    """加载模型并启动TCP推理服务"""
+    parser = argparse.ArgumentParser(description="RMBG TCP推理服务")
+    parser.add_argument("--host", default=config.REMOTE_SERVER_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=config.REMOTE_SERVER_PORT, help="监听端口")
+    args = parser.parse_args(argv)
+
+    backend = LocalBackend()
+    server = RemoteInferenceServer(
+        (args.host, args.port),
+        backend.run,
+        max_batch=backend.get_batch_size(),
+        batch_wait=config.INFERENCE_BATCH_WAIT_MS / 1000.0,
+        model_info=backend.get_model_info,
+        max_tensor_bytes=int(config.REMOTE_MAX_TENSOR_MB * 1024 * 1024),
+    )
+
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    serve()
@@ -0,0 +1,467 @@
+"""
+共享内存推理通道
+
+HTTP前端进程只负责解码、预处理和编码，预处理后的张量写入独立推理进程创建的
+multiprocessing.shared_memory 环形缓冲区，推理结果也通过同一块共享内存返回。
+UNIX套接字只传递几十字节的控制消息，大数组不经过pickle。
+
+启动推理进程:
+    python -m app.models.shared_memory
+"""
+
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import struct
+import threading
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app import config
+from app.models.backends import InferenceBackend
+from app.models.batching import BatchQueue, PendingWork
+
+logger = logging.getLogger(__name__)
+
+# 控制消息格式
+# 握手: 槽位编号(-1表示无空闲槽位), 槽位最大高度, 槽位最大宽度, 共享内存名称
+_HANDSHAKE = struct.Struct("!iII64s")
+# 请求: 操作码, 输入高度, 输入宽度
+_REQUEST = struct.Struct("!BII")
+# 响应: 状态码, 输出高度, 输出宽度, 附加数据长度(错误信息或JSON)
+_RESPONSE = struct.Struct("!BIII")
+
+OP_RUN = 1
+OP_INFO = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_CHANNELS = 3
+_FLOAT_SIZE = np.dtype(np.float32).itemsize
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """从套接字读取固定长度的数据，连接关闭时抛出ConnectionError"""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("连接已关闭")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    附加到已有的共享内存块
+
+    附加方不拥有这块内存，需要从resource_tracker中注销，
+    否则前端进程退出时会把推理进程的共享内存一起删除
+    """
+    shm = shared_memory.SharedMemory(name=name, create=False)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+class SharedMemoryRing:
+    """
+    共享内存环形缓冲区
+
+    每个槽位包含一块输入区(3 x 高度 x 宽度 的float32)和一块输出区(高度 x 宽度 的float32)，
+    槽位按连接分配，同一时刻只有一个请求使用一个槽位
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, max_size: Tuple[int, int]):
+        """
+        初始化环形缓冲区视图
+
+        参数:
+            shm: 共享内存块
+            slots: 槽位数量
+            max_size: 槽位可容纳的最大(高度, 宽度)
+        """
+        self.shm = shm
+        self.slots = slots
+        self.max_height, self.max_width = max_size
+        self.input_capacity = _CHANNELS * self.max_height * self.max_width
+        self.output_capacity = self.max_height * self.max_width
+        self.slot_bytes = (self.input_capacity + self.output_capacity) * _FLOAT_SIZE
+
+    @classmethod
+    def required_bytes(cls, slots: int, max_size: Tuple[int, int]) -> int:
+        """计算指定槽位数量和尺寸所需的共享内存字节数"""
+        height, width = max_size
+        return slots * (_CHANNELS + 1) * height * width * _FLOAT_SIZE
+
+    @classmethod
+    def create(cls, slots: int, max_size: Tuple[int, int]) -> "SharedMemoryRing":
+        """创建新的共享内存块(由推理进程调用)"""
+        shm = shared_memory.SharedMemory(create=True, size=cls.required_bytes(slots, max_size))
+        return cls(shm, slots, max_size)
+
+    @classmethod
+    def attach(cls, name: str, slots: int, max_size: Tuple[int, int]) -> "SharedMemoryRing":
+        """附加到推理进程创建的共享内存块(由前端进程调用)"""
+        return cls(_attach_shared_memory(name), slots, max_size)
+
+    def _check_size(self, height: int, width: int) -> None:
+        if height > self.max_height or width > self.max_width:
+            raise ValueError(
+                f"张量尺寸 {height}x{width} 超出共享内存槽位容量 {self.max_height}x{self.max_width}"
+            )
+
+    def input_view(self, slot: int, height: int, width: int) -> np.ndarray:
+        """获取槽位输入区的numpy视图，形状(3, 高度, 宽度)"""
+        self._check_size(height, width)
+        offset = slot * self.slot_bytes
+        return np.ndarray((_CHANNELS, height, width), dtype=np.float32,
+                          buffer=self.shm.buf, offset=offset)
+
+    def output_view(self, slot: int, height: int, width: int) -> np.ndarray:
+        """获取槽位输出区的numpy视图，形状(高度, 宽度)"""
+        self._check_size(height, width)
+        offset = slot * self.slot_bytes + self.input_capacity * _FLOAT_SIZE
+        return np.ndarray((height, width), dtype=np.float32,
+                          buffer=self.shm.buf, offset=offset)
+
+    def close(self) -> None:
+        """关闭共享内存映射"""
+        self.shm.close()
+
+
+class _PendingRun(PendingWork):
+    """等待推理进程批处理的单个请求，同尺寸的请求可以合并"""
+
+    def __init__(self, slot: int, height: int, width: int):
+        super().__init__((height, width))
+        self.slot = slot
+        self.height = height
+        self.width = width
+        self.output_shape: Tuple[int, int] = (0, 0)
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    """处理单个前端连接：分配槽位并转发推理请求"""
+
+    server: "InferenceServer"
+
+    def handle(self) -> None:
+        slot = self.server.acquire_slot()
+        ring = self.server.ring
+        name = ring.shm.name.encode()
+        self.request.sendall(_HANDSHAKE.pack(
+            -1 if slot is None else slot, ring.max_height, ring.max_width, name
+        ))
+        if slot is None:
+            return
+
+        try:
+            while True:
+                op, height, width = _REQUEST.unpack(_recv_exact(self.request, _REQUEST.size))
+                if op == OP_RUN:
+                    self._handle_run(slot, height, width)
+                elif op == OP_INFO:
+                    payload = json.dumps(self.server.get_model_info(), default=str).encode()
+                    self.request.sendall(_RESPONSE.pack(STATUS_OK, 0, 0, len(payload)) + payload)
+                else:
+                    self._send_error(f"未知操作码: {op}")
+        except ConnectionError:
+            pass
+        finally:
+            self.server.release_slot(slot)
+
+    def _handle_run(self, slot: int, height: int, width: int) -> None:
+        pending = _PendingRun(slot, height, width)
+        self.server.batches.run(pending)
+        if pending.error is not None:
+            self._send_error(pending.error)
+        else:
+            out_height, out_width = pending.output_shape
+            self.request.sendall(_RESPONSE.pack(STATUS_OK, out_height, out_width, 0))
+
+    def _send_error(self, message: str) -> None:
+        payload = message.encode()
+        self.request.sendall(_RESPONSE.pack(STATUS_ERROR, 0, 0, len(payload)) + payload)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    独立推理进程的服务端
+
+    每个连接独占一个共享内存槽位，批处理线程把同时到达的请求合并成一个批次执行推理
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, run_batch: Callable[[np.ndarray], np.ndarray],
+                 input_size: List[int], slots: int = 8, max_batch: int = 4,
+                 batch_wait: float = 0.005, model_info: Optional[Callable[[], Dict[str, Any]]] = None):
+        """
+        初始化推理服务端
+
+        参数:
+            socket_path: UNIX套接字路径
+            run_batch: 批量推理函数，输入(批次, 3, 高, 宽)，输出(批次, 1, 高, 宽)
+            input_size: 模型输入尺寸[宽度, 高度]，决定槽位容量
+            slots: 共享内存槽位数量，即最多同时服务的连接数
+            max_batch: 单次推理的最大批次
+            batch_wait: 凑批的最长等待时间(秒)
+            model_info: 返回模型信息的函数
+        """
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        width, height = input_size
+        self.ring = SharedMemoryRing.create(slots, (height, width))
+        self.run_batch = run_batch
+        self.model_info = model_info
+        self._free_slots: "queue.SimpleQueue[int]" = queue.SimpleQueue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+
+        super().__init__(socket_path, _ConnectionHandler)
+        self.batches = BatchQueue(self._run_batch, max_batch, batch_wait, name="shm-batcher")
+        logger.info(f"共享内存推理服务已启动: {socket_path}, 共享内存: {self.ring.shm.name}, 槽位: {slots}")
+
+    def acquire_slot(self) -> Optional[int]:
+        """为新连接分配空闲槽位，没有空闲槽位时返回None"""
+        try:
+            return self._free_slots.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release_slot(self, slot: int) -> None:
+        """连接关闭后归还槽位"""
+        self._free_slots.put(slot)
+
+    def queue_depth(self) -> int:
+        """当前等待推理的请求数"""
+        return self.batches.queue_depth()
+
+    def get_model_info(self) -> Dict[str, Any]:
+        """获取模型信息"""
+        info = self.model_info() if self.model_info else {"status": "loaded"}
+        info["backend"] = "shm"
+        return info
+
+    def _run_batch(self, batch: List[_PendingRun]) -> None:
+        """执行一个批次的推理并把掩码写回各自的槽位"""
+        height, width = batch[0].height, batch[0].width
+        if len(batch) == 1:
+            inputs = self.ring.input_view(batch[0].slot, height, width)[np.newaxis]
+        else:
+            inputs = np.stack([self.ring.input_view(p.slot, height, width) for p in batch])
+        outputs = self.run_batch(inputs)
+        for index, pending in enumerate(batch):
+            mask = np.squeeze(outputs[index])
+            out_height, out_width = mask.shape
+            self.ring.output_view(pending.slot, out_height, out_width)[...] = mask
+            pending.output_shape = (out_height, out_width)
+
+    def server_close(self) -> None:
+        """关闭服务端并释放共享内存"""
+        super().server_close()
+        self.batches.close()
+        self.ring.close()
+        try:
+            self.ring.shm.unlink()
+        except FileNotFoundError:
+            pass
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class _SlotConnection:
+    """前端到推理进程的一个连接，独占一个共享内存槽位"""
+
+    def __init__(self, socket_path: str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        slot, max_height, max_width, name = _HANDSHAKE.unpack(_recv_exact(self.sock, _HANDSHAKE.size))
+        if slot < 0:
+            self.sock.close()
+            raise RuntimeError("推理服务没有空闲的共享内存槽位")
+        self.slot = slot
+        self.max_size = (max_height, max_width)
+        self.ring = SharedMemoryRing.attach(name.rstrip(b"\0").decode(), slot + 1, self.max_size)
+
+    def _request(self, op: int, height: int = 0, width: int = 0) -> Tuple[int, int, bytes]:
+        self.sock.sendall(_REQUEST.pack(op, height, width))
+        status, out_height, out_width, length = _RESPONSE.unpack(_recv_exact(self.sock, _RESPONSE.size))
+        payload = _recv_exact(self.sock, length) if length else b""
+        if status != STATUS_OK:
+            raise RuntimeError(payload.decode())
+        return out_height, out_width, payload
+
+    def run(self, tensor: np.ndarray) -> np.ndarray:
+        """推理单张预处理后的图像，输入(3, 高, 宽)，返回(高, 宽)的掩码副本"""
+        _, height, width = tensor.shape
+        self.ring.input_view(self.slot, height, width)[...] = tensor
+        out_height, out_width, _ = self._request(OP_RUN, height, width)
+        # 槽位会被下一次请求覆盖，必须复制出来
+        return self.ring.output_view(self.slot, out_height, out_width).copy()
+
+    def model_info(self) -> Dict[str, Any]:
+        _, _, payload = self._request(OP_INFO)
+        return json.loads(payload)
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        finally:
+            self.ring.close()
+
+
+class SharedMemoryClient(InferenceBackend):
+    """前端进程使用的共享内存推理客户端"""
+
+    name = "shm"
+
+    _instance = None
+
+    def __new__(cls):
+        """单例模式，同一进程内复用连接池"""
+        if cls._instance is None:
+            cls._instance = super(SharedMemoryClient, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        """初始化客户端"""
+        if self._initialized:
+            return
+
+        self.socket_path = config.SHM_SOCKET_PATH
+        self.pool_size = max(1, config.SHM_CLIENT_CONNECTIONS)
+        self.acquire_timeout = config.SHM_ACQUIRE_TIMEOUT_S
+        self._idle: "queue.LifoQueue[_SlotConnection]" = queue.LifoQueue()
+        # 每个许可对应一个可用或可新建的连接，连接归还或断开时都释放许可
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._input_size: Optional[List[int]] = None
+        self._initialized = True
+
+    def _acquire(self) -> _SlotConnection:
+        """
+        取出空闲连接，没有空闲连接时新建连接
+
+        异常:
+            RuntimeError: 等待超时或无法连接推理服务
+        """
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise RuntimeError(f"等待推理服务连接超时({self.acquire_timeout}秒)")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        try:
+            return _SlotConnection(self.socket_path)
+        except Exception as e:
+            self._slots.release()
+            logger.error(f"连接共享内存推理服务时出错: {str(e)}")
+            raise RuntimeError(f"推理服务不可用: {str(e)}")
+
+    def _release(self, conn: _SlotConnection, broken: bool = False) -> None:
+        if broken:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def _call(self, func: Callable[[_SlotConnection], Any]) -> Any:
+        conn = self._acquire()
+        try:
+            result = func(conn)
+        except (ConnectionError, OSError) as e:
+            self._release(conn, broken=True)
+            raise RuntimeError(f"与推理服务的连接中断: {str(e)}")
+        except Exception:
+            self._release(conn)
+            raise
+        self._release(conn)
+        return result
+
+    def get_input_size(self) -> List[int]:
+        """模型输入尺寸[宽度, 高度]，取自推理进程的槽位容量"""
+        if self._input_size is None:
+            def read_size(conn: _SlotConnection) -> List[int]:
+                height, width = conn.max_size
+                return [width, height]
+            self._input_size = self._call(read_size)
+        return self._input_size
+
+    def run(self, batch: np.ndarray, variant: Optional[str] = None) -> np.ndarray:
+        """
+        通过共享内存执行推理
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+            variant: 推理进程只加载主模型，忽略模型变体
+
+        返回:
+            掩码张量，形状为(批次, 1, 高度, 宽度)
+        """
+        masks = self._call(lambda conn: [conn.run(tensor) for tensor in batch])
+        return np.stack(masks)[:, np.newaxis]
+
+    def get_model_info(self) -> Dict[str, Any]:
+        """从推理进程获取模型信息"""
+        try:
+            return self._call(lambda conn: conn.model_info())
+        except Exception as e:
+            return {"status": "error", "error": str(e)}
+
+    def close(self) -> None:
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
+def serve() -> None:
+    """加载模型并启动共享内存推理服务"""
+    from app.models.model_manager import ModelManager
+
+    model_manager = ModelManager()
+    server = InferenceServer(
+        config.SHM_SOCKET_PATH,
+        model_manager.run,
+        model_manager.get_input_size(),
+        slots=config.SHM_RING_SLOTS,
+        max_batch=model_manager.get_batch_size(),
+        batch_wait=config.INFERENCE_BATCH_WAIT_MS / 1000.0,
+        model_info=model_manager.get_model_info,
+    )
+
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    # 容器停止时发送SIGTERM，同样需要释放共享内存
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    serve()
@@ -0,0 +1,210 @@
+"""
+跨进程共享的模型权重
+
+把ONNX模型的权重导出到一个按页对齐的数据文件，并生成JSON索引。加载时用np.memmap
+只读映射数据文件，再通过SessionOptions.add_initializer交给ONNX Runtime直接使用，
+同一台机器上的所有worker共享页缓存中的同一份权重，而不是各自持有私有副本。
+
+去除权重的模型中，这些张量的外部数据指向一个同样大小、内容全为0的稀疏占位文件，
+ONNX Runtime只能从 add_initializer 得到真正的权重，不会自己再读一份数据文件。
+NchwcTransformer 会把卷积权重重排成每个进程私有的新张量，并且读取的是模型中的原始张量，
+因此使用共享权重时需要关闭(见 SharedWeights.disabled_optimizers)。
+
+导出共享权重(需要安装onnx):
+    python -m app.models.shared_weights models/model.onnx
+"""
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+
+logger = logging.getLogger(__name__)
+
+# 数据文件中每个张量的起始偏移按页对齐，便于内核按页共享
+_ALIGNMENT = 4096
+
+# 小于该字节数的张量保留在模型文件中，共享它们得不偿失
+_SIZE_THRESHOLD = 1024
+
+# ONNX TensorProto.DataType 到 numpy 类型的映射
+_ONNX_DTYPES = {
+    1: np.float32,
+    2: np.uint8,
+    3: np.int8,
+    4: np.uint16,
+    5: np.int16,
+    6: np.int32,
+    7: np.int64,
+    9: np.bool_,
+    10: np.float16,
+    11: np.float64,
+    12: np.uint32,
+    13: np.uint64,
+}
+
+
+def get_shared_paths(model_path: str) -> Dict[str, str]:
+    """
+    获取共享权重相关文件的路径
+
+    参数:
+        model_path: 原始ONNX模型路径
+
+    返回:
+        包含 model(去除权重的模型)、data(权重数据)、index(索引)、placeholder(占位文件) 路径的字典
+    """
+    base = os.path.splitext(model_path)[0]
+    return {
+        "model": f"{base}.shared.onnx",
+        "data": f"{base}.shared.bin",
+        "index": f"{base}.shared.json",
+        "placeholder": f"{base}.shared.placeholder",
+    }
+
+
+def has_shared_weights(model_path: str) -> bool:
+    """检查模型是否已经导出共享权重"""
+    return all(Path(path).exists() for path in get_shared_paths(model_path).values())
+
+
+def export_shared_weights(model_path: str) -> Dict[str, str]:
+    """
+    导出共享权重
+
+    参数:
+        model_path: 原始ONNX模型路径
+
+    返回:
+        生成的文件路径
+    """
+    import onnx
+    from onnx.external_data_helper import set_external_data
+
+    paths = get_shared_paths(model_path)
+    model = onnx.load(model_path)
+    entries: List[Dict[str, Any]] = []
+
+    with open(paths["data"], "wb") as data_file:
+        offset = 0
+        for tensor in model.graph.initializer:
+            if tensor.data_type not in _ONNX_DTYPES:
+                continue
+            array = onnx.numpy_helper.to_array(tensor)
+            if array.nbytes < _SIZE_THRESHOLD:
+                continue
+
+            # 填充到对齐位置
+            padding = (-offset) % _ALIGNMENT
+            data_file.write(b"\0" * padding)
+            offset += padding
+
+            raw = np.ascontiguousarray(array).tobytes()
+            data_file.write(raw)
+            entries.append({
+                "name": tensor.name,
+                "dtype": np.dtype(_ONNX_DTYPES[tensor.data_type]).str,
+                "shape": list(array.shape),
+                "offset": offset,
+                "length": len(raw),
+            })
+
+            # 模型文件中改为指向占位文件的外部数据引用，不再内嵌权重
+            tensor.raw_data = raw
+            set_external_data(tensor, location=os.path.basename(paths["placeholder"]), offset=offset,
+                              length=len(raw))
+            tensor.data_location = onnx.TensorProto.EXTERNAL
+            for field in ("raw_data", "float_data", "int32_data", "int64_data", "double_data", "uint64_data"):
+                tensor.ClearField(field)
+            offset += len(raw)
+
+    # 与数据文件等长的稀疏文件，通过模型的外部数据校验但不占用磁盘，读出的内容全为0
+    with open(paths["placeholder"], "wb") as placeholder_file:
+        placeholder_file.truncate(offset)
+
+    onnx.save_model(model, paths["model"])
+    with open(paths["index"], "w", encoding="utf-8") as index_file:
+        json.dump({"data": os.path.basename(paths["data"]), "tensors": entries}, index_file, indent=2)
+
+    logger.info(f"已导出 {len(entries)} 个共享权重张量到 {paths['data']}")
+    return paths
+
+
+class SharedWeights:
+    """以只读内存映射方式打开的共享权重"""
+
+    def __init__(self, model_path: str):
+        """
+        打开共享权重
+
+        参数:
+            model_path: 原始ONNX模型路径
+        """
+        self.paths = get_shared_paths(model_path)
+        with open(self.paths["index"], "r", encoding="utf-8") as index_file:
+            self.index = json.load(index_file)
+
+        data_path = os.path.join(os.path.dirname(self.paths["index"]), self.index["data"])
+        self._data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._values: Dict[str, ort.OrtValue] = {}
+
+        for entry in self.index["tensors"]:
+            array = np.ndarray(
+                tuple(entry["shape"]),
+                dtype=np.dtype(entry["dtype"]),
+                buffer=self._data,
+                offset=entry["offset"],
+            )
+            # OrtValue不会复制numpy数组的内存，数组必须与会话同生命周期
+            self._arrays[entry["name"]] = array
+            self._values[entry["name"]] = ort.OrtValue.ortvalue_from_numpy(array)
+
+    @property
+    def model_path(self) -> str:
+        """去除权重后的模型路径"""
+        return self.paths["model"]
+
+    @property
+    def disabled_optimizers(self) -> List[str]:
+        """创建会话时需要关闭的图优化，传给 InferenceSession 的 disabled_optimizers"""
+        return ["NchwcTransformer"]
+
+    @property
+    def nbytes(self) -> int:
+        """共享权重的总字节数"""
+        return sum(entry["length"] for entry in self.index["tensors"])
+
+    def apply(self, session_options: ort.SessionOptions) -> None:
+        """
+        把共享权重注册到会话选项
+
+        参数:
+            session_options: ONNX Runtime会话选项
+        """
+        for name, value in self._values.items():
+            session_options.add_initializer(name, value)
+        # 预打包会为每个进程生成私有的权重副本，共享权重时关闭
+        session_options.add_session_config_entry("session.disable_prepacking", "1")
+
+
+def open_shared_weights(model_path: str) -> Optional[SharedWeights]:
+    """打开模型的共享权重，未导出时返回None"""
+    if not has_shared_weights(model_path):
+        logger.warning(f"未找到共享权重文件，请先运行: python -m app.models.shared_weights {model_path}")
+        return None
+    return SharedWeights(model_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="导出跨进程共享的模型权重")
+    parser.add_argument("model_path", help="原始ONNX模型路径")
+    args = parser.parse_args()
+    for kind, path in export_shared_weights(args.model_path).items():
+        print(f"{kind}: {path}")
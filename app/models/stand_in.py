@@ -0,0 +1,47 @@
+"""
+替身模型
+
+在没有真实模型文件的环境(压测、基准测试、测试)中代替ONNX会话，
+输入输出形状与RMBG一致，并可以模拟推理耗时
+"""
+
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+class StandInSession:
+    """实现了ModelManager所用接口子集的替身ONNX会话"""
+
+    def __init__(self, input_size: List[int], delay: float = 0.0):
+        """
+        初始化替身会话
+
+        参数:
+            input_size: 模型输入尺寸[宽度, 高度]
+            delay: 每张图像模拟的推理耗时(秒)
+        """
+        self.delay = delay
+        # 替身模型接受任意输入尺寸
+        self._inputs = [SimpleNamespace(name="input", shape=["batch_size", 3, "height", "width"], type="tensor(float)")]
+        self._outputs = [SimpleNamespace(name="output", shape=["batch_size", 1, "height", "width"], type="tensor(float)")]
+
+    def get_inputs(self) -> List[Any]:
+        return self._inputs
+
+    def get_outputs(self) -> List[Any]:
+        return self._outputs
+
+    def get_modelmeta(self) -> Any:
+        return SimpleNamespace(name="stand-in")
+
+    def run(self, output_names: Optional[List[str]], input_feed: Dict[str, np.ndarray]) -> List[np.ndarray]:
+        """以通道均值的sigmoid作为掩码"""
+        batch = input_feed[self._inputs[0].name]
+        if self.delay > 0:
+            # sleep会释放GIL，与ONNX Runtime推理时的行为一致
+            time.sleep(self.delay * batch.shape[0])
+        logits = batch.mean(axis=1, keepdims=True) * 8.0
+        return [(1.0 / (1.0 + np.exp(-logits))).astype(np.float32)]
@@ -0,0 +1,275 @@
+"""
+ONNX Runtime 会话参数自动调优
+
+在当前主机上用配置的模型和输入尺寸对候选会话参数(线程数、执行模式、内存池、
+内存模式)和批次大小做基准测试，把最优配置按主机类型保存到JSON文件，
+ModelManager 加载模型时读取对应主机的配置。
+
+离线调优:
+    python -m app.models.tuning
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import time
+from itertools import product
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+# 未调优时使用的默认配置，与ONNX Runtime自身的默认行为一致
+DEFAULT_PROFILE: Dict[str, Any] = {
+    "intra_op_num_threads": 0,
+    "inter_op_num_threads": 0,
+    "execution_mode": "sequential",
+    "enable_cpu_mem_arena": True,
+    "enable_mem_pattern": True,
+    "batch_size": 1,
+}
+
+
+def get_host_key() -> str:
+    """
+    获取主机类型标识
+
+    同一型号CPU、相同逻辑核数的主机共用一份调优结果
+    """
+    cpu_model = platform.processor() or platform.machine()
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+
+    cpu_model = re.sub(r"[^0-9A-Za-z]+", "-", cpu_model).strip("-").lower()
+    return f"{cpu_model}-{os.cpu_count() or 1}cpu"
+
+
+def build_session_options(profile: Dict[str, Any]) -> ort.SessionOptions:
+    """
+    根据调优配置创建会话选项
+
+    参数:
+        profile: 调优配置
+
+    返回:
+        ONNX Runtime会话选项
+    """
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = int(profile.get("intra_op_num_threads", 0))
+    session_options.inter_op_num_threads = int(profile.get("inter_op_num_threads", 0))
+    session_options.execution_mode = (
+        ort.ExecutionMode.ORT_PARALLEL
+        if profile.get("execution_mode") == "parallel"
+        else ort.ExecutionMode.ORT_SEQUENTIAL
+    )
+    session_options.enable_cpu_mem_arena = bool(profile.get("enable_cpu_mem_arena", True))
+    session_options.enable_mem_pattern = bool(profile.get("enable_mem_pattern", True))
+    return session_options
+
+
+def candidate_profiles(cpu_count: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    生成候选会话配置
+
+    参数:
+        cpu_count: 可用逻辑核数，默认取当前主机
+
+    返回:
+        候选配置列表(批次大小统一为1，批次另行调优)
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    intra_threads = sorted({1, max(1, cpu_count // 2), cpu_count})
+
+    candidates = []
+    for threads, arena, mem_pattern in product(intra_threads, (True, False), (True, False)):
+        candidates.append(dict(DEFAULT_PROFILE, intra_op_num_threads=threads,
+                               enable_cpu_mem_arena=arena, enable_mem_pattern=mem_pattern))
+
+    # 并行执行模式只在有多个分支的图上有意义，用默认内存设置测试
+    for threads in intra_threads:
+        for inter_threads in sorted({1, 2}):
+            candidates.append(dict(DEFAULT_PROFILE, intra_op_num_threads=threads,
+                                   inter_op_num_threads=inter_threads, execution_mode="parallel"))
+    return candidates
+
+
+def benchmark_profile(model_path: str, profile: Dict[str, Any], input_size: List[int],
+                      runs: int = 10, warmup: int = 2) -> Dict[str, float]:
+    """
+    测量单个配置的推理性能
+
+    参数:
+        model_path: ONNX模型路径
+        profile: 会话配置
+        input_size: 模型输入尺寸[宽度, 高度]
+        runs: 计时的推理次数
+        warmup: 预热次数
+
+    返回:
+        包含 p50、p95 延迟(秒)和吞吐量(张/秒)的字典
+    """
+    session = ort.InferenceSession(model_path, sess_options=build_session_options(profile))
+    input_name = session.get_inputs()[0].name
+    batch_size = int(profile.get("batch_size", 1))
+    width, height = input_size
+    batch = np.random.rand(batch_size, 3, height, width).astype(np.float32) - 0.5
+
+    for _ in range(warmup):
+        session.run(None, {input_name: batch})
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        session.run(None, {input_name: batch})
+        latencies.append(time.perf_counter() - start)
+
+    latencies_array = np.array(latencies)
+    return {
+        "p50": float(np.percentile(latencies_array, 50)),
+        "p95": float(np.percentile(latencies_array, 95)),
+        "throughput": batch_size * runs / float(latencies_array.sum()),
+    }
+
+
+def tune(model_path: str, input_size: List[int], runs: int = 10,
+         batch_sizes: Optional[List[int]] = None,
+         candidates: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    在当前主机上调优会话参数
+
+    先以单张推理的p50延迟选出最优的会话配置，再用该配置测试不同批次大小，
+    选出吞吐量最高的批次大小
+
+    参数:
+        model_path: ONNX模型路径
+        input_size: 模型输入尺寸[宽度, 高度]
+        runs: 每个配置计时的推理次数
+        batch_sizes: 候选批次大小
+        candidates: 候选会话配置，默认由 candidate_profiles 生成
+
+    返回:
+        包含最优配置和全部测量结果的字典
+    """
+    candidates = candidates or candidate_profiles()
+    batch_sizes = batch_sizes or [1, 2, 4]
+    results = []
+
+    for profile in candidates:
+        try:
+            stats = benchmark_profile(model_path, profile, input_size, runs=runs)
+        except Exception as e:
+            logger.warning(f"配置 {profile} 测试失败: {str(e)}")
+            continue
+        results.append({"profile": profile, **stats})
+        logger.info(f"{profile} -> p50 {stats['p50'] * 1000:.1f}ms")
+
+    if not results:
+        raise RuntimeError("所有候选配置都测试失败")
+
+    best = dict(min(results, key=lambda r: r["p50"])["profile"])
+
+    # 用最优会话配置测试批次大小
+    best_throughput = 0.0
+    for batch_size in batch_sizes:
+        profile = dict(best, batch_size=batch_size)
+        try:
+            stats = benchmark_profile(model_path, profile, input_size, runs=max(2, runs // batch_size))
+        except Exception as e:
+            # 模型批次维度固定时只能使用1
+            logger.warning(f"批次大小 {batch_size} 测试失败: {str(e)}")
+            continue
+        results.append({"profile": profile, **stats})
+        logger.info(f"批次 {batch_size} -> {stats['throughput']:.2f} 张/秒")
+        if stats["throughput"] > best_throughput:
+            best_throughput = stats["throughput"]
+            best["batch_size"] = batch_size
+
+    return {
+        "host": get_host_key(),
+        "model_path": model_path,
+        "input_size": list(input_size),
+        "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "profile": best,
+        "results": results,
+    }
+
+
+def load_profile(profile_path: str, host_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    读取指定主机类型的调优配置
+
+    参数:
+        profile_path: 调优结果文件路径
+        host_key: 主机类型标识，默认取当前主机
+
+    返回:
+        调优配置，不存在时返回None
+    """
+    if not os.path.exists(profile_path):
+        return None
+    try:
+        with open(profile_path, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"读取调优配置时出错: {str(e)}")
+        return None
+
+    entry = profiles.get(host_key or get_host_key())
+    if entry is None:
+        return None
+    return dict(DEFAULT_PROFILE, **entry["profile"])
+
+
+def save_profile(profile_path: str, tuning_result: Dict[str, Any]) -> None:
+    """
+    保存调优结果，同一文件中按主机类型保存多份配置
+
+    参数:
+        profile_path: 调优结果文件路径
+        tuning_result: tune 的返回值
+    """
+    profiles: Dict[str, Any] = {}
+    if os.path.exists(profile_path):
+        with open(profile_path, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+
+    profiles[tuning_result["host"]] = {
+        key: value for key, value in tuning_result.items() if key != "results"
+    }
+    with open(profile_path, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, indent=2, ensure_ascii=False)
+
+
+def tune_and_save(runs: int = 10) -> Dict[str, Any]:
+    """按当前配置的模型和输入尺寸调优，并保存到 ORT_PROFILE_PATH"""
+    result = tune(config.MODEL_PATH, config.MODEL_INPUT_SIZE_LIST, runs=runs)
+    save_profile(config.ORT_PROFILE_PATH, result)
+    logger.info(f"调优完成，主机 {result['host']} 的最优配置: {result['profile']}")
+    return result
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+    parser = argparse.ArgumentParser(description="调优ONNX Runtime会话参数")
+    parser.add_argument("--runs", type=int, default=10, help="每个配置计时的推理次数")
+    args = parser.parse_args()
+
+    tuned = tune_and_save(runs=args.runs)
+    print(json.dumps(tuned["profile"], indent=2))
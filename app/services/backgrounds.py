@@ -0,0 +1,270 @@
+"""
+多背景合成
+
+一次推理得到掩码后，为请求列出的每个背景(透明、纯色、预注册的背景图、原图模糊)
+生成合成结果。推理和前景转换只做一次，每个背景只需一次按掩码的逐像素混合。
+背景图由服务端资源缓存解码一次，并按目标尺寸缓存缩放后的结果。
+"""
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageOps
+
+from app import config
+from app.utils.color_utils import parse_color
+
+logger = logging.getLogger(__name__)
+
+# 背景图资源支持的扩展名
+ASSET_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+_ASSET_NAME_RE = re.compile(r"^[0-9A-Za-z_-]+$")
+
+
+def parse_backgrounds(backgrounds_str: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    解析背景列表参数
+
+    逗号分隔，每项为以下之一:
+        transparent        透明背景
+        #RRGGBB[AA]        纯色背景
+        image:<名称>       预注册的背景图
+        blur[:<半径>]      原图模糊后作为背景
+
+    参数:
+        backgrounds_str: 背景列表字符串
+
+    返回:
+        背景描述列表，每项包含 key(用于输出命名) 和 type 以及对应参数
+
+    异常:
+        ValueError: 参数格式无效或数量超过限制
+    """
+    backgrounds: List[Dict[str, Any]] = []
+    if not backgrounds_str:
+        return backgrounds
+
+    for token in (value.strip() for value in backgrounds_str.split(",")):
+        if not token:
+            continue
+        lowered = token.lower()
+        if lowered == "transparent":
+            background = {"key": "transparent", "type": "transparent"}
+        elif lowered.startswith("image:"):
+            name = token[len("image:"):]
+            if not _ASSET_NAME_RE.match(name):
+                raise ValueError(f"无效的背景图名称: {name}")
+            background = {"key": f"image_{name}", "type": "image", "name": name}
+        elif lowered == "blur" or lowered.startswith("blur:"):
+            radius_str = lowered[len("blur:"):] if ":" in lowered else str(config.BACKGROUND_BLUR_RADIUS)
+            try:
+                radius = float(radius_str)
+            except ValueError:
+                raise ValueError(f"无效的模糊半径: {radius_str}")
+            if not 0 < radius <= 200:
+                raise ValueError(f"无效的模糊半径: {radius_str}，必须在0到200之间")
+            background = {"key": f"blur_{radius:g}", "type": "blur", "radius": radius}
+        else:
+            color = parse_color(token)
+            if color is None:
+                raise ValueError(f"无效的背景: {token}")
+            background = {"key": "color_" + "".join(f"{c:02x}" for c in color), "type": "color", "color": color}
+
+        # 重复的背景只合成一次
+        if all(existing["key"] != background["key"] for existing in backgrounds):
+            backgrounds.append(background)
+
+    if len(backgrounds) > config.MAX_BACKGROUNDS:
+        raise ValueError(f"背景数量不能超过 {config.MAX_BACKGROUNDS} 个")
+    return backgrounds
+
+
+def _image_bytes(image: Image.Image) -> int:
+    """RGBA图像占用的像素内存"""
+    return image.width * image.height * 4
+
+
+class BackgroundAssetCache:
+    """背景图资源缓存(单例)，按目标尺寸缓存缩放后的RGBA像素"""
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(BackgroundAssetCache, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self.assets_dir = config.BACKGROUND_ASSETS_DIR
+        self.max_bytes = int(config.BACKGROUND_CACHE_MB * 1024 * 1024)
+        self.max_originals = max(1, config.BACKGROUND_ORIGINALS_MAX)
+        self._lock = threading.Lock()
+        # 解码后的原始背景图，按最近使用排序
+        self._originals: "OrderedDict[str, Image.Image]" = OrderedDict()
+        # (名称, 宽, 高) -> 缩放后的RGBA背景图，按最近使用排序
+        self._resized: "OrderedDict[Tuple[str, int, int], Image.Image]" = OrderedDict()
+        self._resized_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._initialized = True
+
+    def list_assets(self) -> List[str]:
+        """列出资源目录中可用的背景图名称"""
+        if not os.path.isdir(self.assets_dir):
+            return []
+        names = []
+        for filename in sorted(os.listdir(self.assets_dir)):
+            name, extension = os.path.splitext(filename)
+            if extension.lower() in ASSET_EXTENSIONS and _ASSET_NAME_RE.match(name):
+                names.append(name)
+        return names
+
+    def has_asset(self, name: str) -> bool:
+        """检查背景图是否存在"""
+        return name in self._originals or self._find_asset(name) is not None
+
+    def _find_asset(self, name: str) -> Optional[str]:
+        for extension in ASSET_EXTENSIONS:
+            for candidate in (extension, extension.upper()):
+                path = os.path.join(self.assets_dir, name + candidate)
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def _decode_original(self, name: str) -> Image.Image:
+        """解码原始背景图，调用时不持有锁"""
+        path = self._find_asset(name)
+        if path is None:
+            raise ValueError(f"背景图不存在: {name}")
+        with Image.open(path) as image:
+            return image.convert("RGBA")
+
+    def _remember_original(self, name: str, original: Image.Image) -> Image.Image:
+        """记录解码后的原始背景图，超出数量时淘汰最久未使用的，调用时持有锁"""
+        existing = self._originals.get(name)
+        if existing is not None:
+            # 其他线程已经解码了同一张背景图，沿用先放入的那份
+            original = existing
+        self._originals[name] = original
+        self._originals.move_to_end(name)
+        while len(self._originals) > self.max_originals:
+            self._originals.popitem(last=False)
+        return original
+
+    def get(self, name: str, size: Tuple[int, int]) -> Image.Image:
+        """
+        获取缩放并居中裁剪到指定尺寸的背景图
+
+        参数:
+            name: 背景图名称
+            size: 目标尺寸(宽, 高)
+
+        返回:
+            RGBA背景图，由缓存共享，调用方不能直接修改
+
+        异常:
+            ValueError: 背景图不存在
+        """
+        key = (name, size[0], size[1])
+        with self._lock:
+            resized = self._resized.get(key)
+            if resized is not None:
+                self._resized.move_to_end(key)
+                self.hits += 1
+                return resized
+
+            self.misses += 1
+            original = self._originals.get(name)
+            if original is not None:
+                self._originals.move_to_end(name)
+
+        # 解码和缩放在锁外进行，不阻塞其他背景图和尺寸的命中；同一项同时未命中时可能重复计算一次
+        if original is None:
+            original = self._decode_original(name)
+        resized = ImageOps.fit(original, size, Image.LANCZOS)
+
+        with self._lock:
+            self._remember_original(name, original)
+            existing = self._resized.get(key)
+            if existing is not None:
+                self._resized.move_to_end(key)
+                return existing
+
+            self._resized[key] = resized
+            self._resized_bytes += _image_bytes(resized)
+            # 超出容量时淘汰最久未使用的尺寸，至少保留当前这一项
+            while self._resized_bytes > self.max_bytes and len(self._resized) > 1:
+                _, evicted = self._resized.popitem(last=False)
+                self._resized_bytes -= _image_bytes(evicted)
+            return resized
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._originals.clear()
+            self._resized.clear()
+            self._resized_bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            return {
+                "assets_dir": self.assets_dir,
+                "originals": len(self._originals),
+                "max_originals": self.max_originals,
+                "resized": len(self._resized),
+                "resized_bytes": self._resized_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def composite_backgrounds(image: Image.Image, mask: Image.Image,
+                          backgrounds: List[Dict[str, Any]],
+                          asset_cache: Optional[BackgroundAssetCache] = None) -> Dict[str, Image.Image]:
+    """
+    用同一个掩码把前景合成到多个背景上
+
+    前景只转换一次RGBA，每个背景只做一次按掩码的逐像素混合(Image.paste，
+    与 apply_mask 的结果逐像素一致)
+
+    参数:
+        image: 前景图像
+        mask: 与前景同尺寸的L模式掩码
+        backgrounds: parse_backgrounds 返回的背景描述
+        asset_cache: 背景图资源缓存，默认使用单例
+
+    返回:
+        背景key到合成结果(RGBA图像)的有序字典
+    """
+    foreground = image if image.mode == "RGBA" else image.convert("RGBA")
+
+    results: Dict[str, Image.Image] = OrderedDict()
+    for background in backgrounds:
+        background_type = background["type"]
+        if background_type == "transparent":
+            result = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        elif background_type == "color":
+            result = Image.new("RGBA", image.size, background["color"])
+        elif background_type == "image":
+            cache = asset_cache or BackgroundAssetCache()
+            # 缓存中的背景图是共享的，合成前复制一份
+            result = cache.get(background["name"], image.size).copy()
+        elif background_type == "blur":
+            result = foreground.filter(ImageFilter.GaussianBlur(background["radius"]))
+            result.putalpha(255)
+        else:
+            raise ValueError(f"未知的背景类型: {background_type}")
+
+        result.paste(foreground, mask=mask)
+        results[background["key"]] = result
+    return results
@@ -0,0 +1,286 @@
+"""
+相同请求合并
+
+同一张图片几乎同时被多次上传时，按图片内容的哈希合并正在进行的推理(single-flight)：第一个请求执行推理，
+在它完成前到达的相同请求等待并共用它的掩码，各自按自己的背景、裁剪和尺寸参数合成。
+合并键还包含感兴趣区域和决定推理结果的降级参数，只有掩码完全相同的请求才会合并。
+推理完成后键即被移除，不缓存结果。
+
+路由在排队等待处理名额之前通过 reserve 按内容哈希分组：第一个请求排队占用名额，
+同一内容的请求在它得到掩码之前到达时不再排队，直接解码并等待它的掩码，之后不占名额完成合成和编码。
+第一个请求的合并键不同(例如感兴趣区域不同)或没有执行推理时，等待的请求自己排队占用名额推理。
+因此 PROCESSING_CONCURRENCY=1 时相同请求同样可以合并。
+
+等待的请求没有执行预处理、推理和后处理，这几项耗时报告为0，等待时间记录在 coalesced_wait，
+降级控制器也不把它们计为推理样本。
+"""
+
+import contextvars
+import hashlib
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, BinaryIO, Callable, Dict, Optional, Tuple, Union
+
+from PIL import Image
+
+from app import config
+from app.services.degradation import DegradationController
+from app.utils.metrics import registry
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+_coalesced = registry.counter("rmbg_coalesced_requests_total", "共用其他请求推理结果、省去一次推理的请求数")
+_leaders = registry.counter("rmbg_coalescing_leaders_total", "参与合并判断并实际执行推理的请求数")
+_in_flight = registry.gauge("rmbg_coalescing_in_flight", "正在执行、可被合并的推理数")
+
+Prediction = Tuple[Image.Image, Dict[str, Any]]
+
+_HASH_CHUNK = 1024 * 1024
+
+# 等待的请求没有执行的阶段，耗时报告为0
+_SKIPPED_STAGES = ("preprocessing_time", "inference_time", "postprocess_time")
+
+
+def content_hash(data: Union[str, bytes, memoryview]) -> str:
+    """图片字节或Base64文本的内容哈希"""
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_stream(stream: BinaryIO) -> str:
+    """分块计算文件对象的内容哈希，完成后回到文件开头"""
+    digest = hashlib.blake2b(digest_size=16)
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(_HASH_CHUNK), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class _Call:
+    """一次正在进行的推理"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Prediction] = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class _Group:
+    """同一内容哈希的一组请求，第一个请求占用处理名额并推理，其余请求等待它的掩码"""
+
+    def __init__(self):
+        self.settled = threading.Event()
+        # 第一个请求推理使用的合并键，没有推理时为None
+        self.key: Optional[str] = None
+        self.result: Optional[Prediction] = None
+        self.error: Optional[BaseException] = None
+        self.members = 0
+
+
+# 当前请求所在的组: (内容哈希, 组, 是否为占用处理名额的第一个请求)
+_membership: "contextvars.ContextVar[Optional[Tuple[str, _Group, bool]]]" = contextvars.ContextVar(
+    "coalescing_group", default=None)
+
+
+class SingleFlight:
+    """按键合并同时进行的相同计算，单例模式"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super(SingleFlight, cls).__new__(cls)
+                cls._instance._initialized = False
+            return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._groups: Dict[str, _Group] = {}
+        self._initialized = True
+
+    def do(self, key: str, fn: Callable[[], Prediction]) -> Tuple[Prediction, bool]:
+        """
+        执行计算，相同键的计算正在进行时等待并共用其结果
+
+        参数:
+            key: 合并键
+            fn: 计算函数
+
+        返回:
+            计算结果，以及结果是否来自其他请求
+
+        异常:
+            执行计算的请求失败时，等待的请求抛出同一个异常
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                _in_flight.set(len(self._calls))
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            _coalesced.inc()
+            return call.result, True
+
+        _leaders.inc()
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                _in_flight.set(len(self._calls))
+            call.done.set()
+            if call.waiters:
+                logger.debug(f"{call.waiters}个相同请求共用了一次推理")
+        return call.result, False
+
+    def join(self, digest: str) -> Tuple[_Group, bool]:
+        """
+        按内容哈希加入请求组
+
+        返回:
+            所在的组，以及是否为需要占用处理名额的第一个请求
+        """
+        with self._lock:
+            group = self._groups.get(digest)
+            if group is None:
+                group = self._groups[digest] = _Group()
+                return group, True
+            group.members += 1
+            return group, False
+
+    def settle(self, digest: str, group: _Group, key: Optional[str] = None,
+               result: Optional[Prediction] = None, error: Optional[BaseException] = None) -> None:
+        """第一个请求推理完成或结束处理时解散组，此后到达的相同请求重新分组"""
+        with self._lock:
+            if group.settled.is_set():
+                return
+            del self._groups[digest]
+            group.key, group.result, group.error = key, result, error
+            group.settled.set()
+
+    def share(self, group: _Group, key: str, fn: Callable[[], Prediction]) -> Tuple[Prediction, bool]:
+        """
+        等待组内第一个请求的掩码；合并键不同或它没有推理时，排队占用处理名额后自己推理
+
+        返回:
+            计算结果，以及结果是否来自其他请求
+        """
+        group.settled.wait()
+        if group.key == key:
+            if group.error is not None:
+                raise group.error
+            _coalesced.inc()
+            return group.result, True
+        with DegradationController().hold():
+            return self.do(key, fn)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """正在进行的推理数、累计合并的请求数和实际执行推理的请求数"""
+        with self._lock:
+            in_flight = len(self._calls)
+        return {"in_flight": in_flight, "coalesced": _coalesced.get(), "leaders": _leaders.get()}
+
+
+@asynccontextmanager
+async def reserve(digest: Optional[str],
+                  is_cancelled: Optional[Callable[[], Awaitable[bool]]] = None) -> AsyncIterator[float]:
+    """
+    在事件循环中排队等待处理名额；同一内容的请求已在排队或处理时不占用名额，加入它的组等待掩码
+
+    参数:
+        digest: 上传内容的哈希，为None时不合并，按 DegradationController.reserve 排队
+        is_cancelled: 排队期间定期调用的协程函数，返回True时放弃排队
+
+    返回:
+        排队耗时(秒)，不占用名额的请求为0
+
+    异常:
+        RequestCancelled: 排队期间请求被取消
+    """
+    controller = DegradationController()
+    if digest is None or not config.COALESCING_ENABLED:
+        async with controller.reserve(is_cancelled) as queue_wait:
+            yield queue_wait
+        return
+
+    flight = SingleFlight()
+    group, leader = flight.join(digest)
+    # 交给线程池的函数复制当前上下文，predict 据此判断请求在组中的角色
+    token = _membership.set((digest, group, leader))
+    try:
+        if leader:
+            async with controller.reserve(is_cancelled) as queue_wait:
+                yield queue_wait
+        else:
+            yield 0.0
+    finally:
+        _membership.reset(token)
+        if leader:
+            # 没有执行推理就结束时，等待的请求改为自己推理
+            flight.settle(digest, group)
+
+
+def can_coalesce(image: Image.Image) -> bool:
+    """图像是否带有内容哈希且启用了请求合并"""
+    return config.COALESCING_ENABLED and "content_hash" in image.info
+
+
+def predict(image: Image.Image, key_parts: Tuple[Any, ...], fn: Callable[[], Prediction]) -> Prediction:
+    """
+    预测掩码，同一图片内容和参数的推理正在进行时共用其结果；经 reserve 分组的请求等待组内第一个请求的掩码
+
+    参数:
+        image: 解码后的图像，image.info["content_hash"] 为原始字节的内容哈希，没有时不合并
+        key_parts: 除图片内容外决定掩码的参数，例如感兴趣区域、模型输入尺寸和模型变体
+        fn: 实际执行推理的函数
+
+    返回:
+        (掩码, 各阶段耗时)，共用结果时 coalesced 为True，预处理、推理和后处理耗时为0，
+        coalesced_wait 为等待其他请求推理的时间
+    """
+    if not can_coalesce(image):
+        return fn()
+
+    key = f"{image.info['content_hash']}:{key_parts!r}"
+    start = time.time()
+    flight = SingleFlight()
+    membership = _membership.get()
+    if membership is None:
+        (mask, metrics), shared = flight.do(key, fn)
+    else:
+        digest, group, leader = membership
+        if not leader:
+            (mask, metrics), shared = flight.share(group, key, fn)
+        else:
+            try:
+                (mask, metrics), shared = flight.do(key, fn)
+            except BaseException as e:
+                flight.settle(digest, group, key, error=e)
+                raise
+            flight.settle(digest, group, key, result=(mask, metrics))
+    if shared:
+        # 掩码只读共用，各请求的合成都会生成新图像
+        metrics = dict(metrics, coalesced=True, coalesced_wait=time.time() - start)
+        metrics.update((stage, 0.0) for stage in _SKIPPED_STAGES if stage in metrics)
+    return mask, metrics
@@ -0,0 +1,445 @@
+"""
+基于SLO的自适应降级
+
+控制器限制同时处理的请求数，超出的请求排队等待。排队耗时和推理耗时超过配置的SLO时，
+把允许降级的请求逐级切换到更小的模型输入尺寸、量化模型以及更快的缩放和编码方式；
+压力消除后再逐级恢复。每次级别切换之间至少间隔一个冷却时间，恢复阈值低于降级阈值，
+避免在两个级别之间来回切换。
+
+当前请求使用的级别保存在上下文变量中，SegmentationService 和图像编码按级别调整处理方式。
+
+路由在事件循环中通过 reserve 排队，获得名额后才把请求交给线程池，排队的请求不占用线程池线程，
+也不受线程池线程数的限制，全部计入排队数和排队耗时。
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app import config
+from app.utils.metrics import registry
+
+# 降级级别，级别越高越快、质量越低
+# input_scale: 模型输入尺寸的缩放比例(模型输入尺寸为动态时才生效)
+# model_variant: 使用的模型变体(对应模型文件存在时才生效)
+# fast_resize: 缩小到模型输入尺寸时先按整数倍缩小(reducing_gap)
+# png_compress_level: PNG压缩级别，越低编码越快、文件越大
+DEGRADATION_LEVELS: List[Dict[str, Any]] = [
+    {"level": 0, "name": "full"},
+    {"level": 1, "name": "reduced_input", "input_scale": 0.75},
+    {"level": 2, "name": "quantized", "input_scale": 0.75, "model_variant": "quantized"},
+    {"level": 3, "name": "fast", "input_scale": 0.5, "model_variant": "quantized",
+     "fast_resize": True, "png_compress_level": 1},
+]
+
+_current_level: "contextvars.ContextVar[Dict[str, Any]]" = contextvars.ContextVar(
+    "degradation_level", default=DEGRADATION_LEVELS[0])
+
+_level_gauge = registry.gauge("rmbg_degradation_level", "控制器当前允许的最高降级级别")
+_transitions = registry.counter("rmbg_degradation_transitions_total", "降级级别切换次数",
+                                ("from_level", "to_level"))
+_served = registry.counter("rmbg_requests_served_total", "按实际降级级别统计的请求数", ("degradation_level",))
+_queue_wait_p95 = registry.gauge("rmbg_queue_wait_p95_seconds", "观察窗口内排队耗时的p95")
+_inference_p95 = registry.gauge("rmbg_inference_p95_seconds", "观察窗口内推理耗时的p95")
+_waiting = registry.gauge("rmbg_requests_waiting", "正在排队等待处理的请求数")
+
+# 排队时检查请求是否已取消的间隔(秒)
+_CANCEL_POLL_INTERVAL = 0.05
+
+
+class RequestCancelled(Exception):
+    """请求在排队或处理阶段之间被客户端取消"""
+
+
+class _Waiter:
+    """一个排队等待名额的线程或协程"""
+
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake: Callable[[], bool]):
+        # 通知等待者已获得名额，无法通知(例如事件循环已关闭)时返回False
+        self.wake = wake
+        self.granted = False
+
+
+def _resolve(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _Slots:
+    """处理名额，空出时按到达顺序直接交给排队的线程或协程"""
+
+    def __init__(self, count: int):
+        self._lock = threading.Lock()
+        self._free = count
+        self._waiters: Deque[_Waiter] = deque()
+
+    def _try_acquire(self, waiter: _Waiter) -> bool:
+        """有空闲名额且无人排队时直接获得名额，否则排到队尾"""
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """放弃排队；名额已经交给它时转给下一个等待者"""
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self.release()
+
+    def acquire(self, is_cancelled: Optional[Callable[[], bool]] = None) -> None:
+        """
+        在当前线程中等待名额
+
+        参数:
+            is_cancelled: 排队期间定期调用，返回True时放弃排队
+
+        异常:
+            RequestCancelled: 排队期间请求被取消
+        """
+        event = threading.Event()
+        waiter = _Waiter(lambda: event.set() or True)
+        if self._try_acquire(waiter):
+            return
+        try:
+            while not event.wait(None if is_cancelled is None else _CANCEL_POLL_INTERVAL):
+                if is_cancelled():
+                    raise RequestCancelled("请求在排队期间被取消")
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def acquire_async(self, is_cancelled: Optional[Callable[[], Awaitable[bool]]] = None) -> None:
+        """
+        在事件循环中等待名额，不占用线程
+
+        参数:
+            is_cancelled: 排队期间定期调用的协程函数，返回True时放弃排队
+
+        异常:
+            RequestCancelled: 排队期间请求被取消
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake() -> bool:
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+                return True
+            except RuntimeError:
+                return False
+
+        waiter = _Waiter(wake)
+        if self._try_acquire(waiter):
+            return
+        try:
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=None if is_cancelled is None else _CANCEL_POLL_INTERVAL)
+                if done:
+                    return
+                if await is_cancelled():
+                    raise RequestCancelled("请求在排队期间被取消")
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    def release(self) -> None:
+        """归还名额，有人排队时交给最早排队的等待者"""
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._free += 1
+                    return
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+            if waiter.wake():
+                return
+
+
+def current_level() -> Dict[str, Any]:
+    """获取当前请求使用的降级级别，不在请求中时为不降级"""
+    return _current_level.get()
+
+
+@contextmanager
+def use_level(level: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """在代码块内使用指定的降级级别"""
+    token = _current_level.set(level)
+    try:
+        yield level
+    finally:
+        _current_level.reset(token)
+
+
+def effective_level(level: Dict[str, Any], support: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    去掉当前部署不支持的降级方式
+
+    参数:
+        level: 降级级别
+        support: SegmentationService.degradation_support 返回的能力
+
+    返回:
+        只包含可用降级方式的级别
+    """
+    effective = dict(level)
+    if not support.get("dynamic_input"):
+        effective.pop("input_scale", None)
+    if effective.get("model_variant") not in support.get("model_variants", ()):
+        effective.pop("model_variant", None)
+    return effective
+
+
+def _settings(level: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in level.items() if key not in ("level", "name")}
+
+
+class Admission:
+    """一个已获得处理名额的请求"""
+
+    def __init__(self, controller: "DegradationController", level: Dict[str, Any], queue_wait: float):
+        self.controller = controller
+        self.level = level
+        self.queue_wait = queue_wait
+        self.inference_time: Optional[float] = None
+
+    def record(self, metrics: Dict[str, Any]) -> Dict[str, Any]:
+        """把排队耗时和降级级别写入性能指标，并记下推理耗时供控制器观察"""
+        # 共用其他请求推理结果的请求没有自己的推理耗时，不作为推理样本
+        self.inference_time = None if metrics.get("coalesced") else metrics.get("inference_time")
+        metrics["queue_wait"] = self.queue_wait
+        metrics["degradation_level"] = self.level["level"]
+        metrics["degradation"] = self.level["name"]
+        return metrics
+
+
+class DegradationController:
+    """降级控制器(单例)，同时负责限制并发处理的请求数"""
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(DegradationController, cls).__new__(cls)
+            cls._instance._initialized = False
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self.enabled = config.DEGRADATION_ENABLED
+        self.levels = DEGRADATION_LEVELS[:max(1, min(len(DEGRADATION_LEVELS), config.DEGRADATION_MAX_LEVEL + 1))]
+        self.slo_queue_wait = config.SLO_QUEUE_WAIT_MS / 1000.0
+        self.slo_inference = config.SLO_INFERENCE_MS / 1000.0
+        self.window = config.DEGRADATION_WINDOW_S
+        self.min_samples = config.DEGRADATION_MIN_SAMPLES
+        self.cooldown = config.DEGRADATION_COOLDOWN_S
+        self.recover_ratio = config.DEGRADATION_RECOVER_RATIO
+
+        self.level = 0
+        self._lock = threading.Lock()
+        self._slots = _Slots(max(1, config.PROCESSING_CONCURRENCY))
+        # 观察窗口: (时间, 排队耗时, 推理耗时)
+        self._samples: Deque[Tuple[float, float, Optional[float]]] = deque()
+        # 正在排队的请求的开始时间
+        self._waiting: Dict[int, float] = {}
+        self._next_ticket = 0
+        self._last_transition = time.monotonic()
+        self.transitions: List[Dict[str, Any]] = []
+        _level_gauge.set(0)
+        self._initialized = True
+
+    @contextmanager
+    def _queued(self) -> Iterator[None]:
+        """在代码块内把请求计入排队数"""
+        with self._lock:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._waiting[ticket] = time.monotonic()
+            _waiting.set(len(self._waiting))
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._waiting[ticket]
+                _waiting.set(len(self._waiting))
+
+    @asynccontextmanager
+    async def reserve(self, is_cancelled: Optional[Callable[[], Awaitable[bool]]] = None) -> AsyncIterator[float]:
+        """
+        在事件循环中排队等待处理名额，代码块结束时释放
+
+        在交给线程池之前调用，排队期间不占用线程池线程；代码块内把返回的排队耗时
+        传给线程池中的 admit(reserved_wait=...)
+
+        参数:
+            is_cancelled: 排队期间定期调用的协程函数，例如 request.is_disconnected，返回True时放弃排队
+
+        返回:
+            排队耗时(秒)
+
+        异常:
+            RequestCancelled: 排队期间请求被取消
+        """
+        start = time.monotonic()
+        with self._queued():
+            await self._slots.acquire_async(is_cancelled)
+        try:
+            yield time.monotonic() - start
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def hold(self, is_cancelled: Optional[Callable[[], bool]] = None) -> Iterator[float]:
+        """
+        在当前线程中排队等待处理名额，代码块结束时释放
+
+        参数:
+            is_cancelled: 排队期间定期调用，返回True时放弃排队
+
+        返回:
+            排队耗时(秒)
+
+        异常:
+            RequestCancelled: 排队期间请求被取消
+        """
+        start = time.monotonic()
+        with self._queued():
+            self._slots.acquire(is_cancelled)
+        try:
+            yield time.monotonic() - start
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def admit(self, allow_degraded: bool = True, support: Optional[Dict[str, Any]] = None,
+              is_cancelled: Optional[Callable[[], bool]] = None,
+              reserved_wait: Optional[float] = None) -> Iterator[Admission]:
+        """
+        等待处理名额，按当前压力选择降级级别，并在代码块内使用该级别
+
+        参数:
+            allow_degraded: 请求是否允许降级
+            support: 当前部署支持的降级能力，不支持的降级方式会被去掉
+            is_cancelled: 排队期间定期调用，返回True时放弃排队
+            reserved_wait: 已通过 reserve 排队时为其排队耗时，不再排队，名额由 reserve 释放
+
+        返回:
+            Admission，代码块结束后把排队和推理耗时交给控制器
+
+        异常:
+            RequestCancelled: 排队期间请求被取消
+        """
+        with ExitStack() as stack:
+            if reserved_wait is None:
+                queue_wait = stack.enter_context(self.hold(is_cancelled))
+            else:
+                queue_wait = reserved_wait
+            admission = Admission(self, self.select_level(allow_degraded, support), queue_wait)
+            _served.inc(degradation_level=admission.level["level"])
+            with use_level(admission.level):
+                yield admission
+        self.observe(admission.queue_wait, admission.inference_time)
+
+    def select_level(self, allow_degraded: bool = True, support: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        选择请求使用的级别
+
+        使用控制器当前级别中部署支持的降级方式；不支持的方式被去掉后与更低级别效果相同时，
+        报告效果相同的最低级别
+        """
+        if not self.enabled or not allow_degraded:
+            return self.levels[0]
+        self._evaluate()
+        if support is None:
+            return self.levels[self.level]
+
+        target = _settings(effective_level(self.levels[self.level], support))
+        for level in self.levels[:self.level + 1]:
+            effective = effective_level(level, support)
+            if _settings(effective) == target:
+                return effective
+        return self.levels[0]
+
+    def observe(self, queue_wait: float, inference_time: Optional[float]) -> None:
+        """记录一个请求的排队耗时和推理耗时"""
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, queue_wait, inference_time))
+        self._evaluate(now)
+
+    def _pressure(self, now: float) -> Optional[float]:
+        """
+        计算观察窗口内的压力：p95排队耗时和p95推理耗时相对SLO的最大比值
+
+        仍在排队的请求按已等待的时间计入排队耗时；样本不足时返回None
+        """
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+        waits = [sample[1] for sample in self._samples]
+        waits.extend(now - start for start in self._waiting.values())
+        inferences = [sample[2] for sample in self._samples if sample[2] is not None]
+        if len(waits) < self.min_samples:
+            return None
+
+        wait_p95 = float(np.percentile(waits, 95))
+        _queue_wait_p95.set(wait_p95)
+        pressure = wait_p95 / self.slo_queue_wait if self.slo_queue_wait > 0 else 0.0
+        if inferences:
+            inference_p95 = float(np.percentile(inferences, 95))
+            _inference_p95.set(inference_p95)
+            if self.slo_inference > 0:
+                pressure = max(pressure, inference_p95 / self.slo_inference)
+        return pressure
+
+    def _evaluate(self, now: Optional[float] = None) -> None:
+        """冷却时间过后，按压力降级或恢复一级"""
+        if not self.enabled:
+            return
+        now = now or time.monotonic()
+        with self._lock:
+            if now - self._last_transition < self.cooldown:
+                return
+            pressure = self._pressure(now)
+            if pressure is None:
+                return
+
+            if pressure > 1.0 and self.level < len(self.levels) - 1:
+                self._transition(self.level + 1, now, pressure)
+            elif pressure < self.recover_ratio and self.level > 0:
+                self._transition(self.level - 1, now, pressure)
+
+    def _transition(self, level: int, now: float, pressure: float) -> None:
+        """切换级别，切换前的样本不再代表新级别下的压力"""
+        _transitions.inc(from_level=self.level, to_level=level)
+        _level_gauge.set(level)
+        self.transitions.append({"time": time.time(), "from_level": self.level, "to_level": level,
+                                 "pressure": pressure})
+        del self.transitions[:-50]
+        self.level = level
+        self._last_transition = now
+        self._samples.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取控制器状态"""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "level": self.levels[self.level],
+                "waiting": len(self._waiting),
+                "samples": len(self._samples),
+                "slo": {"queue_wait": self.slo_queue_wait, "inference": self.slo_inference},
+                "transitions": list(self.transitions),
+            }
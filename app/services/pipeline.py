@@ -0,0 +1,355 @@
+"""
+分阶段流水线
+
+把一次请求拆成解码、预处理、推理、后处理(掩码还原和合成)和编码五个阶段，每个阶段有自己的
+线程池和有界等待队列。请求线程依次把每个阶段交给对应的线程池并等待结果，因此同一请求内的阶段
+仍按顺序执行，不同请求的不同阶段可以同时进行：第N+1个请求解码时，第N个请求在推理，
+第N-1个请求在编码。某个阶段的队列满时上游阻塞，慢阶段不会无限堆积请求。
+
+阶段任务在提交时复制调用方的上下文执行，链路追踪的父span和降级级别照常生效。
+"""
+
+import contextvars
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app import config
+from app.services import coalescing, degradation
+from app.services.segmentation import Box, SegmentationService
+from app.utils import profiling, tracing
+from app.utils.image_utils import MAX_IMAGE_SIZE, render_outputs, resize_image_to_limit, scale_roi
+from app.utils.metrics import registry
+
+# 配置日志
+logger = logging.getLogger(__name__)
+
+STAGES = ("decode", "preprocess", "inference", "postprocess", "encode")
+
+# 计算阶段占用率的时间窗口(秒)
+OCCUPANCY_WINDOW_S = 10.0
+
+_busy = registry.gauge("rmbg_pipeline_stage_busy", "流水线各阶段正在执行任务的线程数", ("stage",))
+_queue_length = registry.gauge("rmbg_pipeline_queue_length", "流水线各阶段等待执行的任务数", ("stage",))
+_workers = registry.gauge("rmbg_pipeline_stage_workers", "流水线各阶段的线程数", ("stage",))
+_busy_seconds = registry.counter("rmbg_pipeline_stage_busy_seconds_total",
+                                 "流水线各阶段线程执行任务的累计耗时(秒)，除以线程数即为占用率", ("stage",))
+_items = registry.counter("rmbg_pipeline_stage_items_total", "流水线各阶段完成的任务数", ("stage",))
+
+# 当前请求各阶段的排队和执行耗时，由 track_request 设置
+_request_timings: "contextvars.ContextVar[Optional[Dict[str, Dict[str, float]]]]" = contextvars.ContextVar(
+    "pipeline_request_timings", default=None)
+
+
+class _Job:
+    """提交到某个阶段的一次调用"""
+
+    def __init__(self, fn: Callable[..., Any], args: Tuple[Any, ...], kwargs: Dict[str, Any]):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.context = contextvars.copy_context()
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.submitted = time.perf_counter()
+        self.started = 0.0
+        self.finished = 0.0
+
+    def run(self) -> None:
+        self.started = time.perf_counter()
+        try:
+            self.result = self.context.run(profiling.call, self.fn, *self.args, **self.kwargs)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished = time.perf_counter()
+            # 释放参数引用，大图不随任务对象滞留
+            self.fn = self.args = self.kwargs = self.context = None
+
+
+class Stage:
+    """流水线的一个阶段：固定数量的线程从有界队列中取任务执行"""
+
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue: "queue.Queue[Optional[_Job]]" = queue.Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._items = 0
+        self._busy_seconds = 0.0
+        # 最近完成任务的(开始时间, 结束时间)，用于计算时间窗口内的占用率
+        self._intervals: Deque[Tuple[float, float]] = deque()
+        self._running: Dict[int, float] = {}
+        _workers.set(self.workers, stage=name)
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"pipeline-{name}-{index}", daemon=True)
+            for index in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job: _Job) -> None:
+        """把任务放入队列，队列满时阻塞"""
+        self.queue.put(job)
+        _queue_length.set(self.queue.qsize(), stage=self.name)
+
+    def _worker(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            _queue_length.set(self.queue.qsize(), stage=self.name)
+            started = time.perf_counter()
+            with self._lock:
+                self._busy += 1
+                self._running[threading.get_ident()] = started
+                _busy.set(self._busy, stage=self.name)
+            try:
+                job.run()
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self._busy -= 1
+                    self._items += 1
+                    self._busy_seconds += finished - started
+                    self._running.pop(threading.get_ident(), None)
+                    self._intervals.append((started, finished))
+                    self._trim(finished)
+                    _busy.set(self._busy, stage=self.name)
+                _busy_seconds.inc(finished - started, stage=self.name)
+                _items.inc(stage=self.name)
+                # 统计更新后再唤醒等待的请求线程
+                job.done.set()
+
+    def _trim(self, now: float) -> None:
+        while self._intervals and self._intervals[0][1] < now - OCCUPANCY_WINDOW_S:
+            self._intervals.popleft()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取阶段的运行状态
+
+        返回:
+            线程数、忙碌线程数、队列长度、完成任务数、累计执行耗时和最近时间窗口内的占用率(0-1)
+        """
+        now = time.perf_counter()
+        window_start = now - OCCUPANCY_WINDOW_S
+        with self._lock:
+            self._trim(now)
+            busy_time = sum(end - max(start, window_start) for start, end in self._intervals)
+            busy_time += sum(now - max(start, window_start) for start in self._running.values())
+            return {
+                "workers": self.workers,
+                "busy": self._busy,
+                "queue_length": self.queue.qsize(),
+                "queue_capacity": self.queue.maxsize,
+                "items": self._items,
+                "busy_seconds": round(self._busy_seconds, 6),
+                "occupancy": round(min(1.0, busy_time / (OCCUPANCY_WINDOW_S * self.workers)), 4),
+            }
+
+    def close(self) -> None:
+        """通知所有线程在处理完已排队的任务后退出"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class Pipeline:
+    """分阶段流水线，单例模式，各阶段的线程在首次使用时启动"""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(Pipeline, cls).__new__(cls)
+                cls._instance._initialized = False
+            return cls._instance
+
+    def __init__(self):
+        with Pipeline._lock:
+            if not self._initialized:
+                self._start()
+
+    def _start(self) -> None:
+        workers = {
+            "decode": config.PIPELINE_DECODE_WORKERS,
+            "preprocess": config.PIPELINE_PREPROCESS_WORKERS,
+            "inference": config.PIPELINE_INFERENCE_WORKERS,
+            "postprocess": config.PIPELINE_POSTPROCESS_WORKERS,
+            "encode": config.PIPELINE_ENCODE_WORKERS,
+        }
+        self.stages = {name: Stage(name, workers[name], config.PIPELINE_QUEUE_SIZE) for name in STAGES}
+        self._initialized = True
+        logger.info("流水线已启动: " + ", ".join(f"{name}={stage.workers}" for name, stage in self.stages.items()))
+
+    def run(self, stage: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        在指定阶段的线程池中执行函数并等待结果
+
+        参数:
+            stage: 阶段名称，见 STAGES
+            fn: 要执行的函数
+            args, kwargs: 函数参数
+
+        返回:
+            函数的返回值
+
+        异常:
+            函数抛出的异常原样抛出
+        """
+        job = _Job(fn, args, kwargs)
+        self.stages[stage].submit(job)
+        job.done.wait()
+
+        timings = _request_timings.get()
+        if timings is not None:
+            entry = timings.setdefault(stage, {"queue_wait": 0.0, "run_time": 0.0})
+            entry["queue_wait"] += job.started - job.submitted
+            entry["run_time"] += job.finished - job.started
+
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        获取流水线的运行状态
+
+        返回:
+            是否启用和各阶段的状态
+        """
+        return {
+            "enabled": config.PIPELINE_ENABLED,
+            "occupancy_window_s": OCCUPANCY_WINDOW_S,
+            "stages": {name: stage.get_stats() for name, stage in self.stages.items()},
+        }
+
+    def close(self) -> None:
+        """停止所有阶段的线程"""
+        for stage in self.stages.values():
+            stage.close()
+
+
+def stage(name: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """在流水线的指定阶段执行函数；流水线关闭时直接在当前线程执行"""
+    if not config.PIPELINE_ENABLED:
+        return fn(*args, **kwargs)
+    return Pipeline().run(name, fn, *args, **kwargs)
+
+
+@contextmanager
+def track_request() -> Iterator[Dict[str, Dict[str, float]]]:
+    """
+    记录当前请求在各阶段的排队和执行耗时
+
+    返回:
+        阶段名称到 {"queue_wait", "run_time"} 的字典，请求结束后可以写入响应的metrics
+    """
+    timings: Dict[str, Dict[str, float]] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def total_queue_wait(timings: Dict[str, Dict[str, float]]) -> float:
+    """请求在各阶段等待队列中的总耗时"""
+    return sum(entry["queue_wait"] for entry in timings.values())
+
+
+def _infer(segmentation_service: SegmentationService, tensor: np.ndarray) -> Tuple[np.ndarray, float]:
+    mask_output, inference_time = segmentation_service.infer(tensor)
+    # 本进程推理时输出是推理线程复用的缓冲区，该线程的下一次推理会覆盖它，交给后处理阶段前先复制
+    return np.array(mask_output, copy=True), inference_time
+
+
+def predict_mask(image: Image.Image, segmentation_service: SegmentationService,
+                 roi: Optional[Box] = None) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    分别在预处理、推理和后处理阶段预测单张图像的掩码
+
+    参数:
+        image: 限制尺寸后的输入图像
+        segmentation_service: 分割服务
+        roi: 图像坐标的主体边界框
+
+    返回:
+        与 SegmentationService.predict_mask 相同的(掩码, 各阶段耗时)
+    """
+    if segmentation_service.uses_fused_engine():
+        # 包装模型在一次会话调用中完成前后处理，整体在推理阶段执行
+        return stage("inference", segmentation_service.predict_mask, image, roi)
+
+    box = segmentation_service.expand_roi(roi, image.size) if roi is not None else None
+    tensor, preprocessing_time = stage("preprocess", segmentation_service.prepare_input, image, box)
+    mask_output, inference_time = stage("inference", _infer, segmentation_service, tensor)
+    del tensor
+    mask_image, postprocess_time = stage("postprocess", segmentation_service.finish_mask,
+                                         mask_output[0][0], image.size, box)
+    metrics = {
+        "preprocessing_time": preprocessing_time,
+        "inference_time": inference_time,
+        "postprocess_time": postprocess_time,
+    }
+    if box is not None:
+        metrics["roi"] = list(box)
+    return mask_image, metrics
+
+
+def render(image: Image.Image, bg_type: str, bg_color: str, segmentation_service: SegmentationService,
+           **options: Any) -> Dict[str, Any]:
+    """
+    生成所有输出图像，流水线启用时推理前后的步骤分别在各自阶段执行，
+    相同图片的推理正在进行时共用它的掩码
+
+    参数:
+        image: 解码后的输入图像
+        bg_type: 背景类型 (transparent 或 color)
+        bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        segmentation_service: 分割服务
+        options: 传给 render_outputs 的其他参数
+
+    返回:
+        与 render_outputs 相同的字典
+    """
+    if not config.PIPELINE_ENABLED and not coalescing.can_coalesce(image):
+        return render_outputs(image, bg_type, bg_color, segmentation_service, **options)
+
+    # 掩码要对 render_outputs 限制尺寸后的图像预测
+    with tracing.span("resize_image_to_limit", original_size=list(image.size)):
+        image = resize_image_to_limit(image, MAX_IMAGE_SIZE)
+    roi = options.pop("roi", None)
+    box = scale_roi(roi, image) if roi is not None else None
+    if config.PIPELINE_ENABLED:
+        predict = functools.partial(predict_mask, image, segmentation_service, box)
+    else:
+        predict = functools.partial(segmentation_service.predict_mask, image, box)
+    # 掩码由图片内容、感兴趣区域、模型输入尺寸和降级使用的模型变体、缩放方式决定
+    level = degradation.current_level()
+    key_parts = (box, tuple(segmentation_service.get_input_size()),
+                 level.get("model_variant"), bool(level.get("fast_resize")))
+    prediction = coalescing.predict(image, key_parts, predict)
+    return stage("postprocess", render_outputs, image, bg_type, bg_color, segmentation_service,
+                 prediction=prediction, **options)
+
+
+def get_stats() -> Dict[str, Any]:
+    """获取流水线状态，未启用时不启动线程"""
+    if not config.PIPELINE_ENABLED and Pipeline._instance is None:
+        return {"enabled": False, "stages": {}}
+    return Pipeline().get_stats()
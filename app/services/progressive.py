@@ -0,0 +1,202 @@
+"""
+渐进式返回
+
+先生成低分辨率预览，再生成完整分辨率的最终结果，两个阶段分别排队获取处理名额。
+模型输入尺寸为动态时，预览用缩小后的图片和较小的模型输入单独推理；模型输入尺寸固定时，
+小图推理并不会更快，预览直接对原图推理并缩小掩码，最终阶段复用这次推理的掩码。
+最终阶段在排队期间和各步骤之间检查请求是否已取消，客户端看到预览后断开时跳过剩余步骤。
+"""
+
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from app import config
+from app.services import degradation
+from app.services.degradation import DegradationController, RequestCancelled
+from app.services.segmentation import SegmentationService
+from app.utils import tracing
+from app.utils.color_utils import parse_color
+from app.utils.image_utils import image_to_base64, render_outputs, scale_roi
+from app.utils.metrics import registry
+
+_stages = registry.counter("rmbg_progressive_stages_total", "渐进式返回各阶段完成和跳过的次数",
+                           ("stage", "outcome"))
+
+# 预览只需要快速编码
+_PREVIEW_ENCODE_LEVEL = {"level": 0, "name": "preview", "png_compress_level": 1}
+
+
+def _check_cancelled(is_cancelled: Optional[Callable[[], bool]]) -> None:
+    if is_cancelled is not None and is_cancelled():
+        raise RequestCancelled("请求已被客户端取消")
+
+
+def preview_level(segmentation_service: SegmentationService) -> Dict[str, Any]:
+    """预览推理使用的级别：缩小模型输入到 PREVIEW_INPUT_SIZE 并快速缩放"""
+    input_size = segmentation_service.get_input_size()
+    return {
+        "level": 0,
+        "name": "preview",
+        "input_scale": min(1.0, config.PREVIEW_INPUT_SIZE / max(input_size)),
+        "fast_resize": True,
+    }
+
+
+def render_preview(
+    image: Image.Image,
+    bg_type: str,
+    bg_color: str,
+    segmentation_service: SegmentationService,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+    reserved_wait: Optional[float] = None,
+) -> Tuple[Dict[str, Any], Optional[Tuple[Image.Image, Dict[str, Any]]]]:
+    """
+    生成低分辨率预览
+
+    参数:
+        image: 限制尺寸后的输入图像
+        bg_type: 背景类型 (transparent 或 color)
+        bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        segmentation_service: 分割服务
+        is_cancelled: 排队期间定期调用，返回True时放弃
+        roi: 原图坐标的主体边界框
+        reserved_wait: 已通过 DegradationController.reserve 获得处理名额时为其排队耗时
+
+    返回:
+        预览事件数据(Base64图像、尺寸和各阶段耗时)，以及可供最终阶段复用的原图掩码(没有时为None)
+
+    异常:
+        ValueError: 背景颜色无效
+        RequestCancelled: 请求在排队期间被取消
+    """
+    start_time = time.time()
+    background_color = parse_color(bg_color) if bg_type == "color" else None
+    if bg_type == "color" and background_color is None:
+        raise ValueError("无效的背景颜色格式")
+
+    preview = image.copy()
+    preview.thumbnail((config.PREVIEW_MAX_SIZE, config.PREVIEW_MAX_SIZE), Image.BILINEAR, reducing_gap=2.0)
+
+    controller = DegradationController()
+    with controller.admit(False, is_cancelled=is_cancelled, reserved_wait=reserved_wait) as admission:
+        with tracing.span("preview", size=list(preview.size)):
+            prediction = None
+            if segmentation_service.degradation_support()["dynamic_input"]:
+                with degradation.use_level(preview_level(segmentation_service)):
+                    input_size = segmentation_service.get_input_size()
+                    mask, mask_metrics = segmentation_service.predict_mask(
+                        preview, scale_roi(roi, preview) if roi is not None else None)
+            else:
+                # 模型输入尺寸固定，对原图推理一次，最终阶段复用掩码
+                input_size = segmentation_service.get_input_size()
+                prediction = segmentation_service.predict_mask(
+                    image, scale_roi(roi, image) if roi is not None else None)
+                full_mask, mask_metrics = prediction
+                mask = full_mask.resize(preview.size, Image.BILINEAR)
+                # 完整推理的耗时交给降级控制器观察
+                admission.inference_time = mask_metrics["inference_time"]
+
+            apply_mask_start = time.time()
+            result = segmentation_service.apply_mask(preview, mask, background_color)
+            apply_mask_time = time.time() - apply_mask_start
+
+            encode_start = time.time()
+            with degradation.use_level(_PREVIEW_ENCODE_LEVEL):
+                result_base64 = image_to_base64(result)
+            encode_time = time.time() - encode_start
+
+    _stages.inc(stage="preview", outcome="completed")
+    return {
+        "image": result_base64,
+        "size": list(preview.size),
+        "metrics": {
+            "stage": "preview",
+            "queue_wait": admission.queue_wait,
+            "input_size": list(input_size),
+            **mask_metrics,
+            "apply_mask_time": apply_mask_time,
+            "encode_time": encode_time,
+            "stage_time": time.time() - start_time,
+            "trace_id": tracing.current_trace_id(),
+        },
+    }, prediction
+
+
+def render_final(
+    image: Image.Image,
+    bg_type: str,
+    bg_color: str,
+    segmentation_service: SegmentationService,
+    crop: bool = False,
+    crop_padding: int = 0,
+    allow_degraded: bool = True,
+    prediction: Optional[Tuple[Image.Image, Dict[str, Any]]] = None,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+    reserved_wait: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    生成完整分辨率的最终结果，在排队期间和各步骤之间检查取消
+
+    参数:
+        image: 限制尺寸后的输入图像
+        bg_type: 背景类型 (transparent 或 color)
+        bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        segmentation_service: 分割服务
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        allow_degraded: 负载过高时是否允许降级处理
+        prediction: 预览阶段得到的原图掩码，None表示重新推理
+        is_cancelled: 返回True时跳过剩余步骤
+        roi: 原图坐标的主体边界框，预览阶段的掩码已按它推理
+        reserved_wait: 已通过 DegradationController.reserve 获得处理名额时为其排队耗时
+
+    返回:
+        最终事件数据(Base64图像、尺寸和各阶段耗时)
+
+    异常:
+        RequestCancelled: 请求被取消，剩余步骤已跳过
+    """
+    start_time = time.time()
+    controller = DegradationController()
+    try:
+        with controller.admit(allow_degraded, segmentation_service.degradation_support(), is_cancelled,
+                              reserved_wait) as admission:
+            # 推理前检查，客户端看到预览后已经断开时不再推理
+            _check_cancelled(is_cancelled)
+            if prediction is None:
+                prediction = segmentation_service.predict_mask(
+                    image, scale_roi(roi, image) if roi is not None else None)
+                reused = False
+            else:
+                reused = True
+            _check_cancelled(is_cancelled)
+
+            outputs = render_outputs(image, bg_type, bg_color, segmentation_service,
+                                     crop=crop, crop_padding=crop_padding, prediction=prediction)
+            metrics = admission.record(outputs["metrics"])
+            if reused:
+                # 复用的掩码的推理耗时已经在预览阶段计入
+                admission.inference_time = None
+            _check_cancelled(is_cancelled)
+
+            encode_start = time.time()
+            with tracing.span("encode_result"):
+                result_base64 = image_to_base64(outputs["result_image"])
+            encode_time = time.time() - encode_start
+    except RequestCancelled:
+        _stages.inc(stage="final", outcome="skipped")
+        raise
+
+    _stages.inc(stage="final", outcome="completed")
+    metrics.update(stage="final", reused_preview_mask=reused, encode_time=encode_time,
+                   stage_time=time.time() - start_time)
+    return {
+        "image": result_base64,
+        "size": list(outputs["result_image"].size),
+        "metrics": metrics,
+        "bg_color_info": outputs["bg_color_info"],
+    }
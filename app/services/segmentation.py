@@ -4,23 +4,59 @@
 
 import logging
 import time
-from typing import Tuple, Optional, Dict, Any, Union
+from typing import Tuple, Optional, Dict, Any, Union, List
 
 import numpy as np
 from PIL import Image
 
-from app.models.model_manager import ModelManager
+from app import config
+from app.models.backends import LocalBackend, create_backend
+from app.services import degradation
+from app.services.backgrounds import composite_backgrounds
+from app.utils import tracing
 from app.utils.color_utils import parse_color
 
 logger = logging.getLogger(__name__)
 
+# (左, 上, 右, 下) 像素边界框
+Box = Tuple[int, int, int, int]
+
 
 class SegmentationService:
     """图像分割服务，提供图像抠图功能"""
 
     def __init__(self):
         """初始化分割服务"""
-        self.model_manager = ModelManager()
+        self.backend = create_backend()
+        # 模型由独立推理进程或推理服务持有时，前端进程不加载模型
+        self.model_manager = self.backend.model_manager if isinstance(self.backend, LocalBackend) else None
+
+    def get_input_size(self) -> List[int]:
+        """获取模型输入尺寸，当前降级级别缩小输入时返回缩小后的尺寸"""
+        input_size = self.backend.get_input_size()
+        scale = degradation.current_level().get("input_scale")
+        if scale and self.backend.degradation_support()["dynamic_input"]:
+            # 保持为32的倍数，与模型的下采样倍数对齐
+            return [max(32, int(size * scale) // 32 * 32) for size in input_size]
+        return input_size
+
+    def degradation_support(self) -> Dict[str, Any]:
+        """当前推理后端支持的降级方式，共享内存推理进程只支持更快的缩放和编码"""
+        return self.backend.degradation_support()
+
+    def run_inference(self, batch: np.ndarray) -> np.ndarray:
+        """
+        执行模型推理
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+
+        返回:
+            掩码张量，形状为(批次, 1, 高度, 宽度)
+        """
+        # 当前降级级别使用的模型变体
+        variant = degradation.current_level().get("model_variant")
+        return self.backend.run(batch, variant)
 
     def preprocess_image(self, image: np.ndarray) -> np.ndarray:
         """
@@ -33,7 +69,7 @@ class SegmentationService:
             预处理后的图像
         """
         # 获取模型输入尺寸
-        model_input_size = self.model_manager.get_input_size()
+        model_input_size = self.get_input_size()
 
         # 如果图像是灰度图，添加一个维度使其成为彩色图像
         if len(image.shape) < 3:
@@ -60,6 +96,27 @@ class SegmentationService:
 
         return image_normalized
 
+    def _to_model_rgb(self, image: Image.Image) -> np.ndarray:
+        """
+        把图像转换为RGB数组
+
+        常规模式按原图尺寸转换，由 preprocess_image 缩放到模型输入尺寸；降级启用快速缩放或低内存模式下
+        先缩小到模型输入尺寸再转数组，不生成原图尺寸的数组。低内存模式下其他模式的图像也先缩小再转换
+        (调色板图像除外，其缩放只能用最近邻)
+        """
+        # 降级时先按整数倍快速缩小，再双线性缩放到目标尺寸
+        reducing_gap = 2.0 if degradation.current_level().get("fast_resize") else None
+        if not config.LOW_MEMORY_MODE:
+            image = image.convert("RGB")
+            if reducing_gap is None:
+                return np.array(image)
+        elif image.mode in ("P", "1"):
+            image = image.convert("RGB")
+        resized = image.resize(tuple(self.get_input_size()), Image.BILINEAR, reducing_gap=reducing_gap)
+        if resized.mode != "RGB":
+            resized = resized.convert("RGB")
+        return np.array(resized)
+
     def postprocess_mask(self, mask: np.ndarray, orig_size: Tuple[int, int]) -> np.ndarray:
         """
         后处理模型输出的掩码
@@ -74,6 +131,11 @@ class SegmentationService:
         # 移除批次维度
         mask = np.squeeze(mask)
 
+        if config.LOW_MEMORY_MODE:
+            # 在模型分辨率上标准化并量化，只把uint8掩码放大到原图尺寸，不生成原图尺寸的浮点数组
+            normalized = self._normalize_mask(mask.astype(np.float32), in_place=True)
+            return np.array(Image.fromarray(normalized).resize(orig_size, Image.BILINEAR))
+
         # 调整掩码大小以匹配原始图像尺寸
         try:
             mask_resized = np.array(Image.fromarray(mask).resize(orig_size, Image.BILINEAR))
@@ -81,18 +143,35 @@ class SegmentationService:
             logger.error(f"调整掩码大小时出错: {str(e)}")
             raise RuntimeError(f"调整掩码大小时出错: {str(e)}")
 
+        return self._normalize_mask(mask_resized)
+
+    @staticmethod
+    def _normalize_mask(mask: np.ndarray, in_place: bool = False) -> np.ndarray:
+        """
+        把浮点掩码线性拉伸到[0, 255]并转换为uint8
+
+        参数:
+            mask: 浮点掩码
+            in_place: 是否直接在传入的数组上计算，为True时会修改传入的数组，省去同尺寸的临时数组
+
+        返回:
+            uint8掩码
+        """
         # 标准化掩码数据
-        mask_min = mask_resized.min()
-        mask_max = mask_resized.max()
-        if mask_max > mask_min:
-            mask_normalized = (mask_resized - mask_min) / (mask_max - mask_min)
-        else:
-            mask_normalized = np.zeros_like(mask_resized)
+        mask_min = mask.min()
+        mask_max = mask.max()
+        if mask_max <= mask_min:
+            return np.zeros(mask.shape, dtype=np.uint8)
 
-        # 转换为uint8图像
-        mask_uint8 = (mask_normalized * 255).astype(np.uint8)
+        if not in_place:
+            mask_normalized = (mask - mask_min) / (mask_max - mask_min)
+            # 转换为uint8图像
+            return (mask_normalized * 255).astype(np.uint8)
 
-        return mask_uint8
+        mask -= mask_min
+        mask /= mask_max - mask_min
+        mask *= 255
+        return mask.astype(np.uint8)
 
     def apply_mask(self, image: Image.Image, mask: Image.Image,
                    bg_color: Optional[Tuple[int, int, int, int]] = None) -> Image.Image:
@@ -107,6 +186,11 @@ class SegmentationService:
         返回:
             处理后的图像
         """
+        if config.LOW_MEMORY_MODE:
+            result = self._apply_mask_low_memory(image, mask, bg_color)
+            if result is not None:
+                return result
+
         # 确保原始图像有alpha通道
         if image.mode != "RGBA":
             image = image.convert("RGBA")
@@ -124,14 +208,283 @@ class SegmentationService:
 
         return result
 
-    def segment_image(self, image: Image.Image, bg_color_str: Optional[str] = None) -> Tuple[
-        Image.Image, Dict[str, Any]]:
+    @staticmethod
+    def _apply_mask_low_memory(image: Image.Image, mask: Image.Image,
+                               bg_color: Optional[Tuple[int, int, int, int]]) -> Optional[Image.Image]:
+        """
+        低内存模式下合成结果，不生成原图尺寸的RGBA副本
+
+        RGBA的每个通道先填充背景色的对应分量，再按掩码粘贴前景的对应通道(RGB图像的alpha通道视为255)，
+        最后合并为RGBA图像，与paste到背景画布上的结果逐像素一致。
+        图像不是RGB或RGBA时返回None，使用常规合成
+        """
+        if image.mode not in ("RGB", "RGBA"):
+            return None
+        fill = bg_color or (0, 0, 0, 0)
+        bands = []
+        for index, band in enumerate("RGBA"):
+            channel = Image.new("L", image.size, fill[index])
+            channel.paste(image.getchannel(band) if band in image.getbands() else 255, mask=mask)
+            bands.append(channel)
+        return Image.merge("RGBA", bands)
+
+    def predict_mask(self, image: Image.Image, roi: Optional[Box] = None) -> Tuple[Image.Image, Dict[str, Any]]:
+        """
+        预测图像的前景掩码
+
+        参数:
+            image: 输入图像
+            roi: 主体所在的边界框，只对扩展后的区域推理，区域外视为背景
+
+        返回:
+            与输入图像同尺寸的L模式掩码和各阶段耗时
+        """
+        return self.predict_masks([image], rois=[roi])[0]
+
+    def predict_masks(self, images: List[Image.Image], batch_size: Optional[int] = None,
+                      rois: Optional[List[Optional[Box]]] = None) -> List[Tuple[Image.Image, Dict[str, Any]]]:
+        """
+        批量预测多张图像的前景掩码，每批只执行一次推理
+
+        参数:
+            images: 输入图像列表
+            batch_size: 每次推理的最大批次，默认所有图像一次推理
+            rois: 与图像一一对应的主体边界框，None表示对整张图推理
+
+        返回:
+            与输入顺序一致的(掩码, 各阶段耗时)列表，同一批次的图像共享该批次的推理耗时
+
+        异常:
+            ValueError: 边界框与图像没有重叠
+        """
+        batch_size = max(1, batch_size or len(images))
+        boxes = [self.expand_roi(roi, image.size) if roi is not None else None
+                 for image, roi in zip(images, rois or [None] * len(images))]
+        if self.uses_fused_engine():
+            # 包装模型逐张处理任意尺寸的图像
+            return [self._predict_fused(image, box) for image, box in zip(images, boxes)]
+        predictions: List[Tuple[Image.Image, Dict[str, Any]]] = []
+
+        for batch_start in range(0, len(images), batch_size):
+            batch_images = images[batch_start:batch_start + batch_size]
+            batch_boxes = boxes[batch_start:batch_start + batch_size]
+
+            # 转换图像为RGB并预处理
+            tensors = []
+            preprocessing_times = []
+            for image, box in zip(batch_images, batch_boxes):
+                tensor, preprocessing_time = self.prepare_input(image, box)
+                tensors.append(tensor)
+                preprocessing_times.append(preprocessing_time)
+
+            # 执行推理
+            batch = tensors[0] if len(tensors) == 1 else np.concatenate(tensors)
+            mask_output, inference_time = self.infer(batch)
+
+            # 后处理掩码
+            for index, (image, box) in enumerate(zip(batch_images, batch_boxes)):
+                mask_image, postprocess_time = self.finish_mask(mask_output[index][0], image.size, box)
+                metrics = {
+                    "preprocessing_time": preprocessing_times[index],
+                    "inference_time": inference_time,
+                    "postprocess_time": postprocess_time,
+                }
+                if box is not None:
+                    metrics["roi"] = list(box)
+                predictions.append((mask_image, metrics))
+
+        return predictions
+
+    def uses_fused_engine(self) -> bool:
+        """本进程已加载包装模型，且当前降级级别不使用其他模型变体"""
+        return (self.model_manager is not None and self.model_manager.has_fused_engine()
+                and not degradation.current_level().get("model_variant"))
+
+    def _predict_fused(self, image: Image.Image, box: Optional[Box]) -> Tuple[Image.Image, Dict[str, Any]]:
+        """用包装模型预测掩码，缩放、归一化和掩码后处理都在ONNX Runtime中完成"""
+        start_time = time.time()
+        if box is not None:
+            with tracing.span("crop_roi", box=list(box)):
+                region = image.crop(box)
+        else:
+            region = image
+        with tracing.span("convert_rgb"):
+            image_array = np.asarray(region if region.mode == "RGB" else region.convert("RGB"))
+        preprocessing_time = time.time() - start_time
+
+        inference_start = time.time()
+        with tracing.span("fused_inference", size=list(region.size)):
+            try:
+                mask_array = self.model_manager.run_fused(image_array, self.get_input_size())
+            except Exception as e:
+                logger.error(f"模型推理时出错: {str(e)}")
+                raise RuntimeError(f"模型推理时出错: {str(e)}")
+        inference_time = time.time() - inference_start
+
+        postprocess_start = time.time()
+        mask_image = Image.fromarray(mask_array)
+        if box is not None:
+            canvas = Image.new("L", image.size, 0)
+            canvas.paste(mask_image, box[:2])
+            mask_image = canvas
+        metrics = {
+            "preprocessing_time": preprocessing_time,
+            "inference_time": inference_time,
+            "postprocess_time": time.time() - postprocess_start,
+            "engine": "fused",
+        }
+        if box is not None:
+            metrics["roi"] = list(box)
+        return mask_image, metrics
+
+    def expand_roi(self, roi: Box, size: Tuple[int, int]) -> Box:
+        """
+        把主体边界框按 ROI_PADDING 向四周扩展，并限制在图像范围内
+
+        参数:
+            roi: (左, 上, 右, 下) 边界框
+            size: 图像尺寸(宽度, 高度)
+
+        返回:
+            实际裁剪推理的区域
+
+        异常:
+            ValueError: 边界框与图像没有重叠
+        """
+        left, top, right, bottom = roi
+        width, height = size
+        padding = int(round(max(right - left, bottom - top) * config.ROI_PADDING))
+        box = (max(0, left - padding), max(0, top - padding),
+               min(width, right + padding), min(height, bottom + padding))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError("边界框与图像没有重叠")
+        return box
+
+    def prepare_input(self, image: Image.Image, box: Optional[Box] = None) -> Tuple[np.ndarray, float]:
+        """
+        把图像转换为模型输入张量
+
+        参数:
+            image: 输入图像
+            box: 只对该区域推理，模型输入分辨率全部用于该区域
+
+        返回:
+            (1, 3, 高度, 宽度)的输入张量和预处理耗时
+        """
+        start_time = time.time()
+        if box is not None:
+            with tracing.span("crop_roi", box=list(box)):
+                image = image.crop(box)
+        with tracing.span("convert_rgb"):
+            image_array = self._to_model_rgb(image)
+        with tracing.span("preprocess_image"):
+            tensor = self.preprocess_image(image_array)
+        return tensor, time.time() - start_time
+
+    def infer(self, batch: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        执行一个批次的推理
+
+        参数:
+            batch: 预处理后的输入张量，形状为(批次, 通道, 高度, 宽度)
+
+        返回:
+            掩码张量和推理耗时；本进程推理时掩码张量可能是当前线程下一次推理会覆盖的缓冲区
+
+        异常:
+            RuntimeError: 推理出错
+        """
+        inference_start = time.time()
+        with tracing.span("inference", batch_size=len(batch)):
+            try:
+                mask_output = self.run_inference(batch)
+            except Exception as e:
+                logger.error(f"模型推理时出错: {str(e)}")
+                raise RuntimeError(f"模型推理时出错: {str(e)}")
+        return mask_output, time.time() - inference_start
+
+    def finish_mask(self, output: np.ndarray, size: Tuple[int, int],
+                    box: Optional[Box] = None) -> Tuple[Image.Image, float]:
+        """
+        把单张图像的模型输出转换为原图尺寸的L模式掩码
+
+        参数:
+            output: 单张图像的模型输出，形状为(高度, 宽度)
+            size: 原图尺寸(宽度, 高度)
+            box: 推理区域，掩码放回该位置，区域外为背景
+
+        返回:
+            掩码和后处理耗时
+        """
+        postprocess_start = time.time()
+        with tracing.span("postprocess_mask"):
+            if box is None:
+                mask_image = Image.fromarray(self.postprocess_mask(output, size))
+            else:
+                mask_image = Image.new("L", size, 0)
+                region = self.postprocess_mask(output, (box[2] - box[0], box[3] - box[1]))
+                mask_image.paste(Image.fromarray(region), box[:2])
+        return mask_image, time.time() - postprocess_start
+
+    def get_crop_box(self, mask: Image.Image, padding: int = 0) -> Optional[Tuple[int, int, int, int]]:
+        """
+        计算掩码中主体的边界框
+
+        参数:
+            mask: L模式掩码
+            padding: 边界框四周额外保留的像素
+
+        返回:
+            (左, 上, 右, 下) 边界框，掩码中没有主体时返回None
+        """
+        threshold = config.CROP_ALPHA_THRESHOLD
+        # 忽略接近透明的噪声像素，避免边界框被撑满整张图
+        bbox = mask.point(lambda value: 255 if value > threshold else 0).getbbox()
+        if bbox is None:
+            return None
+
+        left, top, right, bottom = bbox
+        width, height = mask.size
+        return (
+            max(0, left - padding),
+            max(0, top - padding),
+            min(width, right + padding),
+            min(height, bottom + padding),
+        )
+
+    def crop_to_subject(self, image: Image.Image, mask: Image.Image, padding: int = 0
+                        ) -> Tuple[Image.Image, Image.Image, Optional[Tuple[int, int, int, int]]]:
+        """
+        把图像和掩码裁剪到主体的边界框
+
+        参数:
+            image: 输入图像
+            mask: 与图像同尺寸的L模式掩码
+            padding: 边界框四周保留的像素
+
+        返回:
+            裁剪后的图像、掩码和边界框，没有主体时原样返回且边界框为None
+        """
+        with tracing.span("crop_to_subject"):
+            crop_box = self.get_crop_box(mask, padding)
+            if crop_box is not None:
+                image = image.crop(crop_box)
+                mask = mask.crop(crop_box)
+        return image, mask, crop_box
+
+    def segment_image(self, image: Image.Image, bg_color_str: Optional[str] = None,
+                      crop: bool = False, crop_padding: int = 0,
+                      prediction: Optional[Tuple[Image.Image, Dict[str, Any]]] = None
+                      ) -> Tuple[Image.Image, Dict[str, Any]]:
         """
         执行图像分割，移除背景
 
         参数:
             image: 输入图像
             bg_color_str: 背景颜色字符串，None表示透明背景
+            crop: 是否把结果裁剪到主体的边界框
+            crop_padding: 裁剪时边界框四周保留的像素
+            prediction: predict_masks 预先批量得到的掩码和耗时，None表示单独推理
 
         返回:
             处理后的图像和性能指标
@@ -147,39 +500,18 @@ class SegmentationService:
         if bg_color_str:
             bg_color = parse_color(bg_color_str)
 
-        # 转换图像为RGB并获取numpy数组
-        rgb_image = image.convert("RGB")
-        image_array = np.array(rgb_image)
+        # 预测掩码
+        mask_image, mask_metrics = prediction or self.predict_mask(image)
 
-        # 预处理图像
-        preprocessed_image = self.preprocess_image(image_array)
-        preprocessing_time = time.time() - start_time
-
-        # 获取ONNX会话
-        ort_session = self.model_manager.get_session()
-
-        # 准备输入
-        input_name = ort_session.get_inputs()[0].name
-        ort_inputs = {input_name: preprocessed_image}
-
-        # 执行推理
-        inference_start = time.time()
-        try:
-            ort_outputs = ort_session.run(None, ort_inputs)
-        except Exception as e:
-            logger.error(f"模型推理时出错: {str(e)}")
-            raise RuntimeError(f"模型推理时出错: {str(e)}")
-        inference_time = time.time() - inference_start
-
-        # 后处理掩码
-        postprocess_start = time.time()
-        mask_array = self.postprocess_mask(ort_outputs[0][0][0], image_size)
-        mask_image = Image.fromarray(mask_array)
-        postprocess_time = time.time() - postprocess_start
+        # 先裁剪再合成，透明区域不参与合成和编码
+        crop_box = None
+        if crop:
+            image, mask_image, crop_box = self.crop_to_subject(image, mask_image, crop_padding)
 
         # 应用掩码
         apply_mask_start = time.time()
-        result_image = self.apply_mask(image, mask_image, bg_color)
+        with tracing.span("apply_mask"):
+            result_image = self.apply_mask(image, mask_image, bg_color)
         apply_mask_time = time.time() - apply_mask_start
 
         # 总处理时间
@@ -188,11 +520,56 @@ class SegmentationService:
         # 返回结果和性能指标
         metrics = {
             "total_time": total_time,
-            "preprocessing_time": preprocessing_time,
-            "inference_time": inference_time,
-            "postprocess_time": postprocess_time,
+            **mask_metrics,
+            "apply_mask_time": apply_mask_time,
+            "image_size": image_size,
+            "trace_id": tracing.current_trace_id(),
+        }
+        if crop:
+            metrics["crop_box"] = list(crop_box) if crop_box is not None else None
+
+        return result_image, metrics
+
+    def segment_backgrounds(self, image: Image.Image, backgrounds: List[Dict[str, Any]],
+                            crop: bool = False, crop_padding: int = 0,
+                            prediction: Optional[Tuple[Image.Image, Dict[str, Any]]] = None
+                            ) -> Tuple[Dict[str, Image.Image], Dict[str, Any]]:
+        """
+        执行一次分割，把前景合成到多个背景上
+
+        参数:
+            image: 输入图像
+            backgrounds: parse_backgrounds 返回的背景描述
+            crop: 是否把结果裁剪到主体的边界框
+            crop_padding: 裁剪时边界框四周保留的像素
+            prediction: predict_masks 预先批量得到的掩码和耗时，None表示单独推理
+
+        返回:
+            背景key到合成结果的有序字典和性能指标
+        """
+        start_time = time.time()
+        image_size = image.size
+
+        mask_image, mask_metrics = prediction or self.predict_mask(image)
+
+        crop_box = None
+        if crop:
+            image, mask_image, crop_box = self.crop_to_subject(image, mask_image, crop_padding)
+
+        composite_start = time.time()
+        with tracing.span("composite_backgrounds", count=len(backgrounds)):
+            results = composite_backgrounds(image, mask_image, backgrounds)
+        apply_mask_time = time.time() - composite_start
+
+        metrics = {
+            "total_time": time.time() - start_time,
+            **mask_metrics,
             "apply_mask_time": apply_mask_time,
             "image_size": image_size,
+            "backgrounds": list(results),
+            "trace_id": tracing.current_trace_id(),
         }
+        if crop:
+            metrics["crop_box"] = list(crop_box) if crop_box is not None else None
 
-        return result_image, metrics
\ No newline at end of file
+        return results, metrics
@@ -0,0 +1,3 @@
+"""
+工具包，包含压测和基准测试等命令行工具
+"""
@@ -0,0 +1,219 @@
+"""
+单请求峰值内存基准测试
+
+每个测试组合启动一个独立的uvicorn服务进程：先用小图预热(加载模型、初始化各级缓存)，
+记录服务进程的常驻内存基线并重置其VmHWM，再处理一张大图，用VmHWM减去基线得到单请求的
+峰值内存增量。客户端在另一个进程中流式读取响应，不计入服务进程的内存。
+给出容器内存上限时，按基线和峰值估算能同时处理的请求数。
+
+    python -m app.tools.bench_memory --size 3000 --pod-limit-mb 2048
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app.utils.memory_utils import read_peak_rss, read_rss, reset_peak_rss
+
+_MB = 1024 * 1024
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OUTPUT_TYPES = ("base64", "file")
+BG_TYPES = ("transparent", "color")
+
+
+def build_test_image(size: int, seed: int = 0) -> bytes:
+    """生成带噪声背景和主体的JPEG测试图"""
+    rng = np.random.RandomState(seed)
+    pixels = rng.randint(0, 256, (size, size, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    ImageDraw.Draw(image).ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill=(240, 240, 240))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(low_memory: bool, real_model: bool, timeout: float = 60.0) -> "tuple[subprocess.Popen, str]":
+    """启动一个uvicorn服务进程并等待就绪"""
+    port = _free_port()
+    env = dict(
+        os.environ,
+        LOW_MEMORY_MODE=str(low_memory),
+        MEMORY_ACCOUNTING="rss",
+        MODEL_STAND_IN=str(not real_model),
+        MODEL_STAND_IN_DELAY_MS="0",
+        TRACE_SLOW_MS="1e9",
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("服务进程启动失败")
+        try:
+            httpx.get(f"{url}/api/model-info", timeout=1.0)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("等待服务进程就绪超时")
+
+
+def _post(url: str, image_data: bytes, output_type: str, bg_type: str) -> Optional[Dict[str, Any]]:
+    """
+    发送请求并流式读取响应，只保留末尾用于解析metrics
+
+    返回:
+        base64输出时返回服务端的metrics
+    """
+    tail = b""
+    with httpx.stream(
+        "POST",
+        f"{url}/api/remove-background-base64",
+        data={
+            "image_base64": base64.b64encode(image_data).decode(),
+            "bg_type": bg_type,
+            "bg_color": "#FFFFFF",
+            "output_type": output_type,
+        },
+        timeout=600,
+    ) as response:
+        response.raise_for_status()
+        for chunk in response.iter_bytes():
+            tail = (tail + chunk)[-65536:]
+
+    index = tail.rfind(b'"metrics":')
+    if output_type != "base64" or index < 0:
+        return None
+    metrics, _ = json.JSONDecoder().raw_decode(tail[index + len(b'"metrics":'):].decode())
+    return metrics
+
+
+def measure_case(case: Dict[str, Any], image_data: bytes, real_model: bool = False) -> Dict[str, Any]:
+    """
+    在新的服务进程中测量一个组合
+
+    参数:
+        case: 包含 low_memory、output_type、bg_type
+        image_data: 测试图
+        real_model: 是否使用真实模型
+
+    返回:
+        包含基线、VmHWM峰值增量、服务端采样的峰值增量和耗时的结果
+    """
+    process, url = _start_server(case["low_memory"], real_model)
+    try:
+        _post(url, build_test_image(256, seed=1), case["output_type"], case["bg_type"])
+
+        baseline = read_rss(process.pid)
+        hwm_reset = reset_peak_rss(process.pid)
+        start = time.perf_counter()
+        metrics = _post(url, image_data, case["output_type"], case["bg_type"])
+        latency = time.perf_counter() - start
+        peak = read_peak_rss(process.pid) if hwm_reset else 0
+    finally:
+        process.terminate()
+        process.wait()
+
+    sampled = (metrics or {}).get("memory") or {}
+    return dict(
+        case,
+        baseline_rss=baseline,
+        peak_delta=peak - baseline if hwm_reset else None,
+        sampled_peak_delta=sampled.get("peak_rss_delta_bytes"),
+        latency=latency,
+    )
+
+
+def run_benchmark(size: int = 3000, real_model: bool = False,
+                  cases: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    运行所有测试组合
+
+    参数:
+        size: 测试图的边长
+        real_model: 是否使用真实模型，默认使用替身模型
+        cases: 测试组合，默认为普通/低内存模式与各输出类型、背景类型的组合
+
+    返回:
+        每个组合的测量结果
+    """
+    image_data = build_test_image(size)
+    cases = cases or [
+        {"low_memory": low_memory, "output_type": output_type, "bg_type": bg_type}
+        for low_memory in (False, True) for output_type in OUTPUT_TYPES for bg_type in BG_TYPES
+    ]
+
+    results = []
+    for case in cases:
+        try:
+            results.append(measure_case(case, image_data, real_model))
+        except Exception as e:
+            results.append(dict(case, error=str(e)))
+    return results
+
+
+def format_results(results: List[Dict[str, Any]], size: int, pod_limit_mb: Optional[float] = None) -> str:
+    """把测量结果格式化为表格"""
+    def mb(value: Optional[int]) -> str:
+        return f"{value / _MB:10.1f}" if value is not None else f"{'-':>10}"
+
+    lines = [
+        f"测试图: {size}x{size} JPEG",
+        f"{'模式':>8} {'输出':>8} {'背景':>12} {'基线(MB)':>10} {'峰值增量(MB)':>12} {'采样增量(MB)':>12} {'耗时(s)':>8}"
+        + (f" {'可并发数':>8}" if pod_limit_mb else ""),
+    ]
+    for result in results:
+        mode = "低内存" if result["low_memory"] else "普通"
+        if "error" in result:
+            lines.append(f"{mode:>8} {result['output_type']:>8} {result['bg_type']:>12} 出错: {result['error']}")
+            continue
+        line = (f"{mode:>8} {result['output_type']:>8} {result['bg_type']:>12} {mb(result['baseline_rss'])} "
+                f"{mb(result['peak_delta']):>12} {mb(result['sampled_peak_delta']):>12} {result['latency']:>8.2f}")
+        if pod_limit_mb:
+            peak = result["peak_delta"] or result["sampled_peak_delta"]
+            capacity = (pod_limit_mb * _MB - result["baseline_rss"]) / peak if peak else float("inf")
+            line += f" {max(0, int(capacity)):>8}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="单请求峰值内存基准测试")
+    parser.add_argument("--size", type=int, default=3000, help="测试图边长")
+    parser.add_argument("--real-model", action="store_true", help="使用真实模型而不是替身模型")
+    parser.add_argument("--pod-limit-mb", type=float, help="容器内存上限，用于估算可同时处理的请求数")
+    parser.add_argument("--output", help="JSON结果输出路径")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.size, args.real_model)
+    print(format_results(results, args.size, args.pod_limit_mb))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
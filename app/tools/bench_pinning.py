@@ -0,0 +1,200 @@
+"""
+绑核基准测试
+
+对同一个模型分别启动若干个不绑核和绑核的TCP推理服务进程(app.models.remote)，两种模式的进程数和
+每个进程的推理线程数相同，只差是否绑核。客户端以固定并发经负载均衡客户端发送单张推理请求，
+统计吞吐量和延迟分位数。绑核的收益主要体现在尾延迟上，在多插槽、多NUMA节点的主机上更明显。
+
+    python -m app.tools.bench_pinning --workers 4 --concurrency 8 --requests 400
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import numpy as np
+
+from app import config
+from app.models import remote
+from app.models.remote import RemoteInferenceClient
+from app.utils.cpu_topology import describe_set, plan_cpu_sets, read_topology
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(process: subprocess.Popen, port: int, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("推理服务进程启动失败")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("等待推理服务进程就绪超时")
+
+
+def _start_servers(workers: int, pinned: bool, model_path: str, input_size: List[int], threads: int,
+                   lock_dir: str, timeout: float = 120.0) -> "tuple[List[subprocess.Popen], List[str]]":
+    """启动一组推理服务进程，绑核时各进程从同一组槽位中领取CPU集合"""
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT_DIR,
+        MODEL_PATH=model_path,
+        MODEL_INPUT_SIZE=",".join(str(size) for size in input_size),
+        MODEL_STAND_IN="false",
+        ORT_AUTOTUNE="off",
+        ORT_INTRA_OP_THREADS=str(threads),
+        # 每个请求单独推理，延迟只反映调度和缓存的差异
+        INFERENCE_MAX_BATCH="1",
+        CPU_PINNING="worker" if pinned else "off",
+        CPU_PINNING_SLOTS=str(workers),
+        CPU_PINNING_LOCK_DIR=lock_dir,
+        LOG_LEVEL="WARNING",
+    )
+    processes: List[subprocess.Popen] = []
+    addresses: List[str] = []
+    try:
+        for _ in range(workers):
+            port = _free_port()
+            processes.append(subprocess.Popen(
+                [sys.executable, "-m", "app.models.remote", "--host", "127.0.0.1", "--port", str(port)],
+                cwd=ROOT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            ))
+            _wait_for_port(processes[-1], port, timeout)
+            addresses.append(f"127.0.0.1:{port}")
+    except Exception:
+        _stop(processes)
+        raise
+    return processes, addresses
+
+
+def _stop(processes: List[subprocess.Popen]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def measure_mode(pinned: bool, model_path: str, input_size: List[int], workers: int, threads: int,
+                 concurrency: int, requests: int) -> Dict[str, Any]:
+    """
+    测量一种模式的吞吐量和延迟
+
+    返回:
+        吞吐量(张/秒)、延迟分位数(秒)和各进程的绑核信息
+    """
+    with tempfile.TemporaryDirectory(prefix="rmbg-cpu-slots-") as lock_dir:
+        processes, addresses = _start_servers(workers, pinned, model_path, input_size, threads, lock_dir)
+        try:
+            config.REMOTE_BACKENDS = addresses
+            config.REMOTE_CLIENT_CONNECTIONS = concurrency
+            RemoteInferenceClient._instance = None
+            client = RemoteInferenceClient()
+
+            width, height = input_size
+            batch = np.random.RandomState(0).rand(1, 3, height, width).astype(np.float32) - 0.5
+            # 预热: 每个进程完成会话初始化和内存分配
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(lambda _: client.run(batch), range(workers * 2)))
+
+            def timed(_: int) -> float:
+                start = time.perf_counter()
+                client.run(batch)
+                return time.perf_counter() - start
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = np.array(list(executor.map(timed, range(requests))))
+            elapsed = time.perf_counter() - start_time
+
+            assignments = []
+            for backend in client.backends:
+                _, _, _, payload = backend.call(remote.OP_INFO)
+                assignments.append(json.loads(payload).get("cpu_topology", {}).get("assignment"))
+            client.close()
+        finally:
+            _stop(processes)
+
+    return {
+        "pinned": pinned,
+        "throughput": requests / elapsed,
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "max": float(latencies.max()),
+        "assignments": assignments,
+    }
+
+
+def run_benchmark(model_path: str, input_size: List[int], workers: int, concurrency: int,
+                  requests: int) -> Dict[str, Any]:
+    """依次测量不绑核和绑核两种模式"""
+    cpus = read_topology()
+    plan = [describe_set(cpus, cpu_set) for cpu_set in plan_cpu_sets(cpus, workers)]
+    # 两种模式使用相同的推理线程数，取最小槽位的物理核数
+    threads = min(slot["threads"] for slot in plan)
+    results = [
+        measure_mode(pinned, model_path, input_size, workers, threads, concurrency, requests)
+        for pinned in (False, True)
+    ]
+    return {"workers": workers, "threads": threads, "concurrency": concurrency, "plan": plan, "results": results}
+
+
+def format_results(report: Dict[str, Any]) -> str:
+    """把测量结果格式化为表格"""
+    lines = [
+        f"进程数: {report['workers']}  每进程推理线程数: {report['threads']}  并发: {report['concurrency']}",
+        "槽位: " + "  ".join(f"[{slot['cpus']}] 节点{slot['nodes']}" for slot in report["plan"]),
+        f"{'模式':>8} {'吞吐量(张/秒)':>14} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'max(ms)':>9}",
+    ]
+    for result in report["results"]:
+        mode = "绑核" if result["pinned"] else "不绑核"
+        lines.append(f"{mode:>8} {result['throughput']:>14.2f} {result['p50'] * 1000:>9.1f} "
+                     f"{result['p95'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} {result['max'] * 1000:>9.1f}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="绑核与不绑核的推理吞吐量和尾延迟对比")
+    parser.add_argument("--model", default=config.MODEL_PATH, help="ONNX模型路径")
+    parser.add_argument("--input-size", default=",".join(str(size) for size in config.MODEL_INPUT_SIZE_LIST),
+                        help="模型输入尺寸 宽度,高度")
+    parser.add_argument("--workers", type=int, default=0, help="推理进程数，默认每个NUMA节点一个")
+    parser.add_argument("--concurrency", type=int, default=0, help="客户端并发数，默认为进程数的两倍")
+    parser.add_argument("--requests", type=int, default=200, help="每种模式的请求数")
+    parser.add_argument("--output", help="JSON结果输出路径")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        parser.error(f"模型文件不存在: {args.model}")
+    input_size = [int(size) for size in args.input_size.split(",")]
+    workers = args.workers or len({cpu["node"] for cpu in read_topology()})
+    concurrency = args.concurrency or workers * 2
+
+    report = run_benchmark(args.model, input_size, workers, concurrency, args.requests)
+    print(format_results(report))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
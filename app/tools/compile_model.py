@@ -0,0 +1,192 @@
+"""
+模型编译工具
+
+把 model.onnx 包装成一个包含前后处理的新模型，缩放、归一化、维度变换、掩码缩放回原图尺寸和
+最小最大值拉伸都在ONNX Runtime的多线程算子中完成:
+
+    输入  image        uint8 (高, 宽, 3)  任意尺寸的RGB图像
+          target_size  int64 (2,)         模型输入的(高, 宽)
+    输出  mask         uint8 (高, 宽)     原图尺寸的掩码
+
+缩放使用带抗锯齿的双线性插值(opset 18)，与 SegmentationService.preprocess_image 中
+PIL的BILINEAR一致；模型的opset低于18时先转换到18。
+
+    python -m app.tools.compile_model --model models/model.onnx --output models/model_fused.onnx
+"""
+
+import argparse
+import logging
+import time
+from typing import List, Optional
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper, version_converter
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+# 与 SegmentationService.preprocess_image 相同的标准化参数
+MEAN = 0.5
+STD = 1.0
+
+# 抗锯齿缩放需要的最低opset
+MIN_OPSET = 18
+
+IMAGE_INPUT = "image"
+SIZE_INPUT = "target_size"
+MASK_OUTPUT = "mask"
+
+# 包装部分的节点和张量名称前缀，避免与原模型冲突
+_PREFIX = "rmbg_fused/"
+
+
+def _name(name: str) -> str:
+    return _PREFIX + name
+
+
+def _constant(name: str, values: List[float], dtype: type) -> onnx.TensorProto:
+    return numpy_helper.from_array(np.array(values, dtype=dtype), _name(name))
+
+
+def _default_opset(model: onnx.ModelProto) -> int:
+    for opset in model.opset_import:
+        if opset.domain in ("", "ai.onnx"):
+            return opset.version
+    raise ValueError("模型没有声明默认算子集")
+
+
+def _graph_input(graph: onnx.GraphProto) -> onnx.ValueInfoProto:
+    """模型的图像输入：第一个不是权重的图输入"""
+    initializers = {initializer.name for initializer in graph.initializer}
+    for graph_input in graph.input:
+        if graph_input.name not in initializers:
+            return graph_input
+    raise ValueError("模型没有输入")
+
+
+def _resize(name: str, source: str, sizes: str) -> onnx.NodeProto:
+    return helper.make_node(
+        "Resize", [source, "", "", sizes], [_name(name)], name=_name(name),
+        mode="linear", antialias=1, coordinate_transformation_mode="half_pixel",
+    )
+
+
+def build_fused_model(model: onnx.ModelProto) -> onnx.ModelProto:
+    """
+    在模型前后加上预处理和后处理
+
+    参数:
+        model: 输入(批次, 3, 高, 宽)、第一个输出为(批次, 1, 高, 宽)掩码的RMBG模型
+
+    返回:
+        输入uint8图像和目标尺寸、输出uint8掩码的新模型
+
+    异常:
+        ValueError: 模型结构不符合要求
+    """
+    if _default_opset(model) < MIN_OPSET:
+        model = version_converter.convert_version(model, MIN_OPSET)
+    core = model.graph
+    model_input = _graph_input(core)
+    model_output = core.output[0].name
+    if model_input.type.tensor_type.elem_type != TensorProto.FLOAT:
+        raise ValueError("只支持float32输入的模型")
+
+    initializers = [
+        _constant("batch_channels", [1, 3], np.int64),
+        _constant("batch_one", [1, 1], np.int64),
+        _constant("batch_axis", [0], np.int64),
+        _constant("squeeze_axes", [0, 1], np.int64),
+        _constant("hw_start", [0], np.int64),
+        _constant("hw_end", [2], np.int64),
+        _constant("scale", [1.0 / 255.0], np.float32),
+        _constant("mean", [MEAN], np.float32),
+        _constant("std", [STD], np.float32),
+        _constant("epsilon", [1e-12], np.float32),
+        _constant("max_value", [255.0], np.float32),
+    ]
+
+    pre_nodes = [
+        # (高, 宽, 3) uint8 -> (1, 3, 高, 宽) float32
+        helper.make_node("Cast", [IMAGE_INPUT], [_name("image_float")], to=TensorProto.FLOAT),
+        helper.make_node("Transpose", [_name("image_float")], [_name("image_chw")], perm=[2, 0, 1]),
+        helper.make_node("Unsqueeze", [_name("image_chw"), _name("batch_axis")], [_name("image_nchw")]),
+        # 缩放到模型输入尺寸
+        helper.make_node("Concat", [_name("batch_channels"), SIZE_INPUT], [_name("input_sizes")], axis=0),
+        _resize("image_resized", _name("image_nchw"), _name("input_sizes")),
+        # 归一化到[0, 1]后标准化
+        helper.make_node("Mul", [_name("image_resized"), _name("scale")], [_name("image_scaled")]),
+        helper.make_node("Sub", [_name("image_scaled"), _name("mean")], [_name("image_centered")]),
+        helper.make_node("Div", [_name("image_centered"), _name("std")], [model_input.name]),
+    ]
+
+    post_nodes = [
+        # 掩码缩放回原图尺寸
+        helper.make_node("Shape", [IMAGE_INPUT], [_name("image_shape")]),
+        helper.make_node("Slice", [_name("image_shape"), _name("hw_start"), _name("hw_end")],
+                         [_name("image_hw")]),
+        helper.make_node("Concat", [_name("batch_one"), _name("image_hw")], [_name("mask_sizes")], axis=0),
+        _resize("mask_resized", model_output, _name("mask_sizes")),
+        # 最小最大值拉伸到[0, 255]，掩码各处相同时全部为0
+        helper.make_node("ReduceMin", [_name("mask_resized")], [_name("mask_min")], keepdims=1),
+        helper.make_node("ReduceMax", [_name("mask_resized")], [_name("mask_max")], keepdims=1),
+        helper.make_node("Sub", [_name("mask_resized"), _name("mask_min")], [_name("mask_shifted")]),
+        helper.make_node("Sub", [_name("mask_max"), _name("mask_min")], [_name("mask_range")]),
+        helper.make_node("Max", [_name("mask_range"), _name("epsilon")], [_name("mask_divisor")]),
+        helper.make_node("Div", [_name("mask_shifted"), _name("mask_divisor")], [_name("mask_unit")]),
+        helper.make_node("Mul", [_name("mask_unit"), _name("max_value")], [_name("mask_scaled")]),
+        helper.make_node("Squeeze", [_name("mask_scaled"), _name("squeeze_axes")], [_name("mask_float")]),
+        # 与 astype(np.uint8) 一样向零取整
+        helper.make_node("Cast", [_name("mask_float")], [MASK_OUTPUT], to=TensorProto.UINT8),
+    ]
+    graph = helper.make_graph(
+        pre_nodes + list(core.node) + post_nodes,
+        f"{core.name or 'model'}_fused",
+        [
+            helper.make_tensor_value_info(IMAGE_INPUT, TensorProto.UINT8, ["height", "width", 3]),
+            helper.make_tensor_value_info(SIZE_INPUT, TensorProto.INT64, [2]),
+        ],
+        [helper.make_tensor_value_info(MASK_OUTPUT, TensorProto.UINT8, ["height", "width"])],
+        initializer=list(core.initializer) + initializers,
+        value_info=list(core.value_info),
+    )
+    fused = helper.make_model(graph, opset_imports=list(model.opset_import), producer_name="rmbg-compile")
+    fused.ir_version = model.ir_version
+    for function in model.functions:
+        fused.functions.append(function)
+    onnx.checker.check_model(fused)
+    return fused
+
+
+def compile_model(model_path: str, output_path: str) -> str:
+    """
+    读取模型、包装前后处理并保存
+
+    参数:
+        model_path: 原模型路径
+        output_path: 输出路径
+
+    返回:
+        输出路径
+    """
+    start_time = time.time()
+    fused = build_fused_model(onnx.load(model_path))
+    onnx.save(fused, output_path)
+    logger.info(f"包装模型已保存到 {output_path}，用时: {time.time() - start_time:.2f}秒")
+    return output_path
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="把预处理和后处理编译进ONNX模型")
+    parser.add_argument("--model", default=config.MODEL_PATH, help="原模型路径")
+    parser.add_argument("--output", default=config.MODEL_FUSED_PATH, help="包装模型的输出路径")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    compile_model(args.model, args.output)
+
+
+if __name__ == "__main__":
+    main()
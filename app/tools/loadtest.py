@@ -0,0 +1,303 @@
+"""
+压测工具
+
+生成混合尺寸和格式的合成图片语料，以不同并发数驱动API端点，报告吞吐量、
+p50/p95/p99延迟、错误率、拒绝率以及服务端返回的各阶段耗时。
+
+进程内压测(使用替身模型，不需要模型文件):
+    python -m app.tools.loadtest --concurrency 1,4,16 --requests 64
+
+压测本地服务:
+    python -m app.tools.loadtest --url http://127.0.0.1:8000 --concurrency 1,8,32
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw
+
+# 合成语料的尺寸和格式
+CORPUS_SIZES = [(320, 240), (800, 600), (1280, 960), (1920, 1080), (3000, 2000)]
+CORPUS_FORMATS = [("JPEG", "image/jpeg"), ("PNG", "image/png"), ("WEBP", "image/webp")]
+
+# 服务端返回的各阶段耗时字段
+STAGE_FIELDS = ["queue_wait", "preprocessing_time", "inference_time", "postprocess_time", "apply_mask_time",
+                "total_time"]
+
+# 表示服务过载、请求被拒绝的状态码
+REJECTION_STATUS = (429, 503)
+
+ENDPOINTS = {
+    "file": "/api/remove-background",
+    "base64": "/api/remove-background-base64",
+}
+
+
+def build_corpus(count: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    生成合成图片语料：渐变背景上的椭圆主体，尺寸和格式轮流取值
+
+    参数:
+        count: 图片数量
+        seed: 随机种子
+
+    返回:
+        每项包含 name、data(编码后的字节)、content_type、size
+    """
+    rng = np.random.RandomState(seed)
+    corpus = []
+    for index in range(count):
+        width, height = CORPUS_SIZES[index % len(CORPUS_SIZES)]
+        image_format, content_type = CORPUS_FORMATS[index % len(CORPUS_FORMATS)]
+
+        # 渐变背景
+        x = np.linspace(0, 255, width, dtype=np.float32)
+        y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+        background = np.stack([
+            np.broadcast_to(x, (height, width)),
+            np.broadcast_to(y, (height, width)),
+            np.full((height, width), rng.randint(0, 256), dtype=np.float32),
+        ], axis=-1).astype(np.uint8)
+        image = Image.fromarray(background)
+
+        # 主体
+        draw = ImageDraw.Draw(image)
+        cx, cy = rng.randint(width // 4, width * 3 // 4), rng.randint(height // 4, height * 3 // 4)
+        rx, ry = width // 5, height // 5
+        draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=tuple(int(v) for v in rng.randint(0, 256, 3)))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format)
+        corpus.append({
+            "name": f"synthetic_{index}_{width}x{height}.{image_format.lower()}",
+            "data": buffer.getvalue(),
+            "content_type": content_type,
+            "size": (width, height),
+        })
+    return corpus
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """计算百分位数，空列表返回None"""
+    if not values:
+        return None
+    return float(np.percentile(np.array(values), q))
+
+
+async def _send(client: httpx.AsyncClient, endpoint: str, item: Dict[str, Any]) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """发送一个请求，返回状态码和服务端指标"""
+    if endpoint == "file":
+        response = await client.post(
+            ENDPOINTS["file"],
+            files={"file": (item["name"], item["data"], item["content_type"])},
+            data={"bg_type": "transparent"},
+        )
+        return response.status_code, None
+
+    response = await client.post(
+        ENDPOINTS["base64"],
+        data={
+            "image_base64": base64.b64encode(item["data"]).decode(),
+            "bg_type": "transparent",
+            "output_type": "base64",
+        },
+    )
+    metrics = None
+    if response.status_code == 200:
+        metrics = response.json().get("metrics")
+    return response.status_code, metrics
+
+
+async def run_level(client: httpx.AsyncClient, corpus: List[Dict[str, Any]], endpoint: str,
+                    concurrency: int, total_requests: int) -> Dict[str, Any]:
+    """
+    以固定并发数发送指定数量的请求
+
+    参数:
+        client: HTTP客户端
+        corpus: 图片语料
+        endpoint: file 或 base64
+        concurrency: 并发数
+        total_requests: 请求总数
+
+    返回:
+        该并发级别的统计结果
+    """
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    errors = 0
+    stages: Dict[str, List[float]] = {field: [] for field in STAGE_FIELDS}
+    degradation_levels: Dict[int, int] = {}
+    counter = iter(range(total_requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for index in counter:
+            item = corpus[index % len(corpus)]
+            start = time.perf_counter()
+            try:
+                status, metrics = await _send(client, endpoint, item)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+            for field in STAGE_FIELDS:
+                if metrics and isinstance(metrics.get(field), (int, float)):
+                    stages[field].append(metrics[field])
+            if metrics and "degradation_level" in metrics:
+                level = metrics["degradation_level"]
+                degradation_levels[level] = degradation_levels.get(level, 0) + 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+
+    succeeded = sum(count for status, count in statuses.items() if 200 <= status < 300)
+    rejected = sum(count for status, count in statuses.items() if status in REJECTION_STATUS)
+    failed = total_requests - succeeded - rejected
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "elapsed": elapsed,
+        "throughput": succeeded / elapsed if elapsed > 0 else 0.0,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+        "error_rate": failed / total_requests if total_requests else 0.0,
+        "rejection_rate": rejected / total_requests if total_requests else 0.0,
+        "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+        "transport_errors": errors,
+        "stages": {field: sum(values) / len(values) for field, values in stages.items() if values},
+        "degradation_levels": {str(level): count for level, count in sorted(degradation_levels.items())},
+    }
+
+
+def _create_client(url: Optional[str], timeout: float) -> httpx.AsyncClient:
+    """创建HTTP客户端；未指定URL时直接调用进程内的应用"""
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    if url:
+        return httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits)
+
+    from app.main import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=timeout)
+
+
+async def run_load_test(concurrency_levels: List[int], requests_per_level: int,
+                        endpoint: str = "base64", url: Optional[str] = None,
+                        corpus_size: int = 15, timeout: float = 120.0,
+                        warmup: int = 2) -> Dict[str, Any]:
+    """
+    按并发级别依次压测
+
+    参数:
+        concurrency_levels: 并发数列表
+        requests_per_level: 每个并发级别的请求数
+        endpoint: file 或 base64
+        url: 服务地址，None表示进程内压测
+        corpus_size: 合成图片数量
+        timeout: 单个请求超时(秒)
+        warmup: 正式压测前的预热请求数
+
+    返回:
+        完整的压测报告
+    """
+    corpus = build_corpus(corpus_size)
+    report = {
+        "target": url or "in-process",
+        "endpoint": ENDPOINTS[endpoint],
+        "corpus": {
+            "images": len(corpus),
+            "sizes": sorted({f"{w}x{h}" for w, h in (item["size"] for item in corpus)}),
+            "formats": sorted({item["content_type"] for item in corpus}),
+        },
+        "levels": [],
+    }
+
+    async with _create_client(url, timeout) as client:
+        if warmup:
+            await run_level(client, corpus, endpoint, 1, warmup)
+        for concurrency in concurrency_levels:
+            report["levels"].append(await run_level(client, corpus, endpoint, concurrency, requests_per_level))
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """把压测报告格式化为表格"""
+    def ms(value: Optional[float]) -> str:
+        return f"{value * 1000:9.1f}" if value is not None else f"{'-':>9}"
+
+    lines = [
+        f"目标: {report['target']}  端点: {report['endpoint']}  语料: {report['corpus']['images']} 张",
+        f"{'并发':>6} {'吞吐(req/s)':>12} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'错误率':>8} {'拒绝率':>8}",
+    ]
+    for level in report["levels"]:
+        latency = level["latency"]
+        lines.append(
+            f"{level['concurrency']:>6} {level['throughput']:>12.2f} {ms(latency['p50'])} {ms(latency['p95'])} "
+            f"{ms(latency['p99'])} {level['error_rate']:>8.2%} {level['rejection_rate']:>8.2%}"
+        )
+
+    stage_levels = [level for level in report["levels"] if level["stages"]]
+    if stage_levels:
+        lines.append("")
+        lines.append("服务端各阶段平均耗时(ms):")
+        lines.append(f"{'并发':>6} " + " ".join(f"{field:>20}" for field in STAGE_FIELDS))
+        for level in stage_levels:
+            lines.append(f"{level['concurrency']:>6} " + " ".join(ms(level["stages"].get(field)).rjust(20)
+                                                               for field in STAGE_FIELDS))
+
+    degraded_levels = [level for level in report["levels"] if any(key != "0" for key in level["degradation_levels"])]
+    if degraded_levels:
+        lines.append("")
+        lines.append("各降级级别处理的请求数:")
+        for level in degraded_levels:
+            counts = "  ".join(f"L{key}: {count}" for key, count in level["degradation_levels"].items())
+            lines.append(f"{level['concurrency']:>6} {counts}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="RMBG服务压测工具")
+    parser.add_argument("--url", help="服务地址，不指定时在进程内压测 app.main:app")
+    parser.add_argument("--concurrency", default="1,4,16", help="逗号分隔的并发数列表")
+    parser.add_argument("--requests", type=int, default=64, help="每个并发级别的请求数")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="base64", help="压测的端点")
+    parser.add_argument("--corpus-size", type=int, default=15, help="合成图片数量")
+    parser.add_argument("--real-model", action="store_true", help="进程内压测时加载真实模型而不是替身模型")
+    parser.add_argument("--stand-in-delay-ms", type=float, help="替身模型的单张推理耗时")
+    parser.add_argument("--output", help="JSON报告输出路径")
+    args = parser.parse_args()
+
+    # 每个请求一行的客户端日志会淹没报告
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if not args.url:
+        from app import config
+        config.MODEL_STAND_IN = not args.real_model
+        if args.stand_in_delay_ms is not None:
+            config.MODEL_STAND_IN_DELAY_MS = args.stand_in_delay_ms
+
+    levels = [int(value) for value in args.concurrency.split(",") if value.strip()]
+    report = asyncio.run(run_load_test(levels, args.requests, args.endpoint, args.url, args.corpus_size))
+
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
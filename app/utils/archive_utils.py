@@ -0,0 +1,52 @@
+"""
+多文件响应打包工具
+"""
+
+import io
+import os
+import zipfile
+from typing import List, Tuple
+
+
+def build_zip(files: List[Tuple[str, bytes]]) -> bytes:
+    """
+    把多个文件打包成zip
+
+    PNG等图像已经压缩过，直接存储不再压缩
+
+    参数:
+        files: (文件名, 内容) 列表
+
+    返回:
+        zip文件字节
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def build_multipart(files: List[Tuple[str, bytes, str]]) -> Tuple[bytes, str]:
+    """
+    把多个文件组装成 multipart/mixed 消息体
+
+    参数:
+        files: (文件名, 内容, 内容类型) 列表
+
+    返回:
+        消息体字节和完整的Content-Type(包含boundary)
+    """
+    boundary = os.urandom(16).hex()
+    parts = []
+    for name, data, content_type in files:
+        parts.append(
+            f"--{boundary}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f'Content-Disposition: attachment; filename="{name}"\r\n'
+            f"Content-Length: {len(data)}\r\n\r\n".encode()
+        )
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/mixed; boundary={boundary}"
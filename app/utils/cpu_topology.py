@@ -0,0 +1,347 @@
+"""
+CPU拓扑与推理进程绑核
+
+从 /sys/devices/system 读取当前进程可用CPU的物理核和NUMA节点分布，把CPU划分为互不重叠的CPU集合(槽位)。
+每个推理进程(uvicorn worker、共享内存或TCP推理服务、离线批量处理的工作进程)启动时用文件锁领取一个
+空闲槽位，把整个进程绑定到该槽位的CPU上，ONNX Runtime的线程数取槽位内的物理核数，每个线程固定在一个核上。
+进程和线程不再跨核、跨NUMA节点迁移，绑核发生在加载模型之前，权重按首次访问分配在本节点的内存上。
+
+查看当前主机的划分:
+    python -m app.utils.cpu_topology --slots 4
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+from app import config
+
+logger = logging.getLogger(__name__)
+
+SYSFS_ROOT = "/sys/devices/system"
+
+# 已领取的槽位锁文件描述符，进程退出时由系统释放
+_slot_fd: Optional[int] = None
+_assignment: Optional[Dict[str, Any]] = None
+_pin_lock = threading.Lock()
+
+
+def parse_cpulist(text: str) -> List[int]:
+    """解析 0-3,8,10-11 形式的CPU列表"""
+    cpus: List[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    """把CPU编号格式化为 0-3,8 形式的CPU列表"""
+    ranges: List[List[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+def _read_int(path: str, default: int) -> int:
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_topology(sysfs_root: str = SYSFS_ROOT, allowed: Optional[Set[int]] = None) -> List[Dict[str, int]]:
+    """
+    读取CPU拓扑
+
+    参数:
+        sysfs_root: sysfs中system目录的路径
+        allowed: 参与划分的CPU，默认取当前进程可用的CPU(已受容器或taskset限制)
+
+    返回:
+        每个CPU的 cpu、core(物理核编号)、package(插槽)、node(NUMA节点)，按节点、插槽、物理核排序，
+        同一物理核的超线程相邻
+    """
+    if allowed is None:
+        allowed = os.sched_getaffinity(0)
+
+    node_of: Dict[int, int] = {}
+    node_dir = os.path.join(sysfs_root, "node")
+    if os.path.isdir(node_dir):
+        for name in os.listdir(node_dir):
+            if name.startswith("node") and name[4:].isdigit():
+                try:
+                    with open(os.path.join(node_dir, name, "cpulist"), "r") as f:
+                        for cpu in parse_cpulist(f.read()):
+                            node_of[cpu] = int(name[4:])
+                except OSError:
+                    continue
+
+    cpus = []
+    for cpu in allowed:
+        topology_dir = os.path.join(sysfs_root, "cpu", f"cpu{cpu}", "topology")
+        package = _read_int(os.path.join(topology_dir, "physical_package_id"), 0)
+        cpus.append({
+            "cpu": cpu,
+            "core": _read_int(os.path.join(topology_dir, "core_id"), cpu),
+            "package": package,
+            "node": node_of.get(cpu, 0),
+        })
+    cpus.sort(key=lambda item: (item["node"], item["package"], item["core"], item["cpu"]))
+    return cpus
+
+
+def _group(cpus: List[Dict[str, int]], key: str) -> List[List[Dict[str, int]]]:
+    """按字段把已排序的CPU分组，保持顺序"""
+    groups: List[List[Dict[str, int]]] = []
+    for item in cpus:
+        if groups and groups[-1][0][key] == item[key]:
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+    return groups
+
+
+def _physical_cores(cpus: List[Dict[str, int]]) -> List[List[Dict[str, int]]]:
+    """按物理核分组，同一物理核的超线程在一组"""
+    cores: Dict[Any, List[Dict[str, int]]] = {}
+    for item in cpus:
+        cores.setdefault((item["package"], item["core"]), []).append(item)
+    return list(cores.values())
+
+
+def _split(units: List[List[Dict[str, int]]], parts: int) -> List[List[Dict[str, int]]]:
+    """把单元列表按顺序尽量均匀地分成若干段，每段展开为CPU列表"""
+    result = []
+    start = 0
+    for index in range(parts):
+        size = len(units) // parts + (1 if index < len(units) % parts else 0)
+        result.append([item for unit in units[start:start + size] for item in unit])
+        start += size
+    return result
+
+
+def plan_cpu_sets(cpus: List[Dict[str, int]], slots: int) -> List[List[int]]:
+    """
+    把CPU划分为互不重叠的CPU集合
+
+    槽位数不超过NUMA节点数时每个槽位分到整数个节点；否则按各节点的物理核数分配槽位，
+    节点内按物理核连续划分，同一物理核的超线程分在同一槽位，槽位数超过物理核数时才拆开超线程
+
+    参数:
+        cpus: read_topology 返回的CPU列表
+        slots: 槽位数
+
+    返回:
+        每个槽位的CPU编号列表
+
+    异常:
+        ValueError: 槽位数超过可用CPU数
+    """
+    if slots < 1 or slots > len(cpus):
+        raise ValueError(f"槽位数 {slots} 超出可用CPU数 {len(cpus)}")
+
+    nodes = _group(cpus, "node")
+    if slots <= len(nodes):
+        sets: List[List[int]] = [[] for _ in range(slots)]
+        for index, node in enumerate(nodes):
+            sets[index % slots].extend(item["cpu"] for item in node)
+        return sets
+
+    total_cores = sum(len(_physical_cores(node)) for node in nodes)
+    if slots <= total_cores:
+        units = [_physical_cores(node) for node in nodes]
+    else:
+        units = [[[item] for item in node] for node in nodes]
+
+    # 每个节点至少一个槽位，其余按单元数的最大余数法分配
+    total = sum(len(node_units) for node_units in units)
+    counts = [1] * len(units)
+    shares = [(slots - len(units)) * len(node_units) / total for node_units in units]
+    for index, share in enumerate(shares):
+        counts[index] += int(share)
+    remainders = sorted(range(len(units)), key=lambda index: shares[index] - int(shares[index]), reverse=True)
+    for index in remainders[:slots - sum(counts)]:
+        counts[index] += 1
+    # 单元数少于槽位数的节点把多出的槽位让给其他节点
+    for index, node_units in enumerate(units):
+        while counts[index] > len(node_units):
+            counts[index] -= 1
+            spare = max(range(len(units)), key=lambda i: len(units[i]) - counts[i])
+            counts[spare] += 1
+
+    return [
+        [item["cpu"] for item in part]
+        for node_units, count in zip(units, counts)
+        for part in _split(node_units, count)
+    ]
+
+
+def describe_set(cpus: List[Dict[str, int]], cpu_set: List[int]) -> Dict[str, Any]:
+    """描述一个CPU集合: CPU列表、所在NUMA节点、物理核数(即推理线程数)和每个物理核的第一个CPU"""
+    members = [item for item in cpus if item["cpu"] in set(cpu_set)]
+    cores = _physical_cores(members)
+    return {
+        "cpus": format_cpulist(cpu_set),
+        "nodes": sorted({item["node"] for item in members}),
+        "threads": len(cores),
+        "core_cpus": [core[0]["cpu"] for core in cores],
+    }
+
+
+def get_slot_count(cpus: List[Dict[str, int]]) -> int:
+    """槽位数，未配置时每个NUMA节点一个槽位"""
+    if config.CPU_PINNING_SLOTS > 0:
+        return min(config.CPU_PINNING_SLOTS, len(cpus))
+    return len(_group(cpus, "node"))
+
+
+def claim_slot(slots: int, lock_dir: str) -> Optional[int]:
+    """
+    用文件锁领取一个空闲槽位
+
+    锁随进程退出释放，worker重启后可以重新领取同一个槽位
+
+    参数:
+        slots: 槽位数
+        lock_dir: 锁文件目录，同一主机上共用同一组槽位的进程必须使用相同的目录
+
+    返回:
+        槽位编号，所有槽位都已被占用时返回None
+    """
+    global _slot_fd
+    for slot in range(slots):
+        path = os.path.join(lock_dir, f"rmbg-cpu-slot-{slot}.lock")
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            continue
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        _slot_fd = fd
+        return slot
+    return None
+
+
+def _set_process_affinity(cpu_set: List[int]) -> None:
+    """
+    绑定当前进程的所有线程
+
+    Linux上 sched_setaffinity(0) 只作用于调用线程，已经存在的线程(如线程池)需要逐个设置
+    """
+    try:
+        tids = [int(tid) for tid in os.listdir("/proc/self/task")]
+    except OSError:
+        tids = []
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpu_set)
+        except OSError:
+            pass
+    os.sched_setaffinity(0, cpu_set)
+
+
+def pin_current_process() -> Optional[Dict[str, Any]]:
+    """
+    按 CPU_PINNING 配置领取槽位并绑定当前进程，同一进程只绑定一次
+
+    返回:
+        当前进程的绑核信息(槽位、CPU集合、NUMA节点、线程数)，未开启或没有空闲槽位时返回None
+    """
+    global _assignment
+    if config.CPU_PINNING != "worker":
+        return None
+
+    with _pin_lock:
+        if _assignment is not None:
+            return _assignment
+
+        try:
+            cpus = read_topology()
+            slots = get_slot_count(cpus)
+            plan = plan_cpu_sets(cpus, slots)
+            slot = claim_slot(slots, config.CPU_PINNING_LOCK_DIR)
+            if slot is None:
+                logger.warning(f"{slots} 个CPU槽位都已被占用，当前进程不绑核")
+                return None
+            _set_process_affinity(plan[slot])
+        except Exception as e:
+            logger.error(f"绑定CPU时出错: {str(e)}")
+            return None
+
+        _assignment = dict(describe_set(cpus, plan[slot]), slot=slot, slots=slots)
+        logger.info(f"进程 {os.getpid()} 绑定到槽位 {slot}: CPU {_assignment['cpus']}，"
+                    f"NUMA节点 {_assignment['nodes']}，{_assignment['threads']} 个推理线程")
+        return _assignment
+
+
+def current_assignment() -> Optional[Dict[str, Any]]:
+    """当前进程的绑核信息，未绑核时为None"""
+    return _assignment
+
+
+def apply_to_session_options(session_options: Any, assignment: Dict[str, Any]) -> None:
+    """
+    让ONNX Runtime会话的线程数与槽位的物理核数一致，并把每个线程固定在一个物理核上
+
+    参数:
+        session_options: onnxruntime.SessionOptions
+        assignment: pin_current_process 返回的绑核信息
+    """
+    threads = assignment["threads"]
+    session_options.intra_op_num_threads = threads
+    if threads > 1:
+        # 第一个线程是调用run的线程，只为其余线程指定亲和性；ONNX Runtime的处理器编号从1开始
+        affinities = ";".join(str(cpu + 1) for cpu in assignment["core_cpus"][1:threads])
+        session_options.add_session_config_entry("session.intra_op.thread_affinities", affinities)
+
+
+def describe_topology() -> Dict[str, Any]:
+    """
+    描述当前主机的CPU划分，供 /api/model-info 展示
+
+    返回:
+        绑核模式、各NUMA节点的CPU、所有槽位的CPU集合以及当前进程的槽位
+    """
+    cpus = read_topology()
+    nodes = {str(node[0]["node"]): format_cpulist([item["cpu"] for item in node]) for node in _group(cpus, "node")}
+    info: Dict[str, Any] = {
+        "mode": config.CPU_PINNING,
+        "cpus": len(cpus),
+        "nodes": nodes,
+        "assignment": _assignment,
+    }
+    if config.CPU_PINNING != "off":
+        slots = get_slot_count(cpus)
+        info["slots"] = [describe_set(cpus, cpu_set) for cpu_set in plan_cpu_sets(cpus, slots)]
+    return info
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="查看CPU拓扑和绑核划分")
+    parser.add_argument("--slots", type=int, default=0, help="槽位数，默认取 CPU_PINNING_SLOTS 或NUMA节点数")
+    args = parser.parse_args()
+
+    cpus = read_topology()
+    slots = min(args.slots, len(cpus)) if args.slots > 0 else get_slot_count(cpus)
+    plan = [describe_set(cpus, cpu_set) for cpu_set in plan_cpu_sets(cpus, slots)]
+    print(json.dumps({"cpus": cpus, "slots": plan}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
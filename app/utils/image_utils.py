@@ -4,13 +4,28 @@
 
 import base64
 import io
-from typing import Union, Tuple, Optional
+import math
+from typing import BinaryIO, Union, Tuple, Optional, List
 from typing import Dict, Any
+from app import config
+from app.services import degradation
 from app.services.segmentation import SegmentationService
+from app.utils import tracing
 from app.utils.color_utils import parse_color, get_color_info
 
 from PIL import Image
 
+# 处理前图片尺寸的上限，超过时等比缩小
+MAX_IMAGE_SIZE = (3000, 3000)
+
+
+def _save_options(format: str) -> Dict[str, Any]:
+    """当前降级级别对应的编码参数"""
+    compress_level = degradation.current_level().get("png_compress_level")
+    if format.upper() == "PNG" and compress_level is not None:
+        return {"compress_level": compress_level}
+    return {}
+
 
 def image_to_base64(img: Image.Image, format: str = "PNG") -> str:
     """
@@ -23,10 +38,41 @@ def image_to_base64(img: Image.Image, format: str = "PNG") -> str:
     返回:
         base64编码的图像字符串
     """
+    return image_to_base64_bytes(img, format).decode()
+
+
+def image_to_base64_bytes(img: Image.Image, format: str = "PNG") -> bytes:
+    """
+    将PIL图像对象编码为base64字节，不转换为字符串
+
+    参数:
+        img: PIL图像对象
+        format: 图像格式，默认为PNG
+
+    返回:
+        base64编码的字节
+    """
+    buffered = io.BytesIO()
+    img.save(buffered, format=format, **_save_options(format))
+    # 直接编码缓冲区内容，避免 getvalue 再复制一份编码后的图像
+    with buffered.getbuffer() as view:
+        return base64.b64encode(view)
+
+
+def image_to_bytes(img: Image.Image, format: str = "PNG") -> bytes:
+    """
+    将PIL图像对象编码为字节
+
+    参数:
+        img: PIL图像对象
+        format: 图像格式，默认为PNG
+
+    返回:
+        编码后的图像字节
+    """
     buffered = io.BytesIO()
-    img.save(buffered, format=format)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
+    img.save(buffered, format=format, **_save_options(format))
+    return buffered.getvalue()
 
 
 def base64_to_image(base64_str: str) -> Optional[Image.Image]:
@@ -82,6 +128,37 @@ def resize_image_to_limit(img: Image.Image, max_size: Tuple[int, int] = (1920, 1
     return img.resize((new_width, new_height), Image.LANCZOS)
 
 
+def decode_image(source: Union[bytes, BinaryIO], max_size: Tuple[int, int] = MAX_IMAGE_SIZE) -> Image.Image:
+    """
+    解码图片并限制尺寸
+
+    超过上限的原图在函数内缩小后即被释放；低内存模式下JPEG直接按目标尺寸缩小解码(DCT缩放)，
+    不生成完整尺寸的原图
+
+    参数:
+        source: 图片字节或文件对象
+        max_size: 最大尺寸(宽度, 高度)
+
+    返回:
+        已加载的PIL图像对象
+    """
+    image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    original_size = image.size
+
+    if config.LOW_MEMORY_MODE:
+        width, height = image.size
+        ratio = min(max_size[0] / width, max_size[1] / height)
+        if ratio < 1:
+            # draft只会按2的幂缩小到不小于目标尺寸，之后仍由LANCZOS缩放到最终尺寸
+            image.draft(image.mode, (int(width * ratio), int(height * ratio)))
+
+    image.load()
+    image = resize_image_to_limit(image, max_size)
+    # 客户端给出的坐标基于原图，记录原图尺寸以便换算
+    image.info["original_size"] = original_size
+    return image
+
+
 def get_image_format(img: Image.Image) -> str:
     """
     获取PIL图像对象的格式
@@ -97,26 +174,145 @@ def get_image_format(img: Image.Image) -> str:
         return format
     return "PNG"  # 默认格式
 
-def process_image(
+def parse_sizes(sizes_str: Optional[str]) -> List[int]:
+    """
+    解析逗号分隔的目标尺寸列表
+
+    参数:
+        sizes_str: 例如 "256,512,1024"，每个值是输出图像最长边的像素数
+
+    返回:
+        去重后从大到小排列的尺寸列表
+    """
+    if not sizes_str or not sizes_str.strip():
+        return []
+
+    sizes = set()
+    for value in sizes_str.split(","):
+        value = value.strip()
+        if not value:
+            continue
+        if not value.isdigit() or not 16 <= int(value) <= 4096:
+            raise ValueError(f"无效的输出尺寸: {value}，必须是16到4096之间的整数")
+        sizes.add(int(value))
+
+    if len(sizes) > config.MAX_OUTPUT_SIZES:
+        raise ValueError(f"输出尺寸最多{config.MAX_OUTPUT_SIZES}个")
+    return sorted(sizes, reverse=True)
+
+
+def parse_roi(roi_str: Optional[str]) -> Optional[Tuple[int, int, int, int]]:
+    """
+    解析逗号分隔的主体边界框
+
+    参数:
+        roi_str: 例如 "120,80,620,540"，依次为原图中的左、上、右、下像素坐标
+
+    返回:
+        (左, 上, 右, 下) 边界框，为空时返回None
+
+    异常:
+        ValueError: 格式无效
+    """
+    if not roi_str or not roi_str.strip():
+        return None
+
+    values = [value.strip() for value in roi_str.split(",")]
+    if len(values) != 4 or not all(value.isdigit() for value in values):
+        raise ValueError(f"无效的边界框: {roi_str}，必须是 左,上,右,下 四个非负整数")
+    left, top, right, bottom = (int(value) for value in values)
+    if right <= left or bottom <= top:
+        raise ValueError(f"无效的边界框: {roi_str}，右、下坐标必须大于左、上坐标")
+    return left, top, right, bottom
+
+
+def scale_roi(roi: Tuple[int, int, int, int], image: Image.Image) -> Tuple[int, int, int, int]:
+    """
+    把原图坐标的边界框换算到解码后缩小过的图像上
+
+    参数:
+        roi: 原图坐标的边界框
+        image: decode_image 返回的图像，没有记录原图尺寸时视为未缩放
+
+    返回:
+        图像坐标的边界框，向外取整
+    """
+    original_width, original_height = image.info.get("original_size", image.size)
+    scale_x = image.width / original_width
+    scale_y = image.height / original_height
+    if scale_x == 1 and scale_y == 1:
+        return roi
+    left, top, right, bottom = roi
+    return (int(left * scale_x), int(top * scale_y),
+            int(math.ceil(right * scale_x)), int(math.ceil(bottom * scale_y)))
+
+
+def make_size_variants(img: Image.Image, sizes: List[int]) -> Dict[int, Image.Image]:
+    """
+    按最长边生成多个尺寸的图像
+
+    从大到小依次缩放，较小的尺寸基于上一个缩放结果生成，不放大原图
+
+    参数:
+        img: PIL图像对象
+        sizes: 目标最长边像素数列表
+
+    返回:
+        尺寸到图像的映射
+    """
+    variants = {}
+    source = img
+    longest = max(img.size)
+    for size in sorted(sizes, reverse=True):
+        if size >= longest:
+            variants[size] = img
+            continue
+        ratio = size / longest
+        target = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+        source = source.resize(target, Image.LANCZOS, reducing_gap=2.0)
+        variants[size] = source
+    return variants
+
+
+def render_outputs(
     image: Image.Image,
     bg_type: str,
     bg_color: str,
     segmentation_service: SegmentationService,
+    crop: bool = False,
+    crop_padding: int = 0,
+    sizes: Optional[List[int]] = None,
+    backgrounds: Optional[List[Dict[str, Any]]] = None,
+    prediction: Optional[Tuple[Image.Image, Dict[str, Any]]] = None,
+    roi: Optional[Tuple[int, int, int, int]] = None,
 ) -> Dict[str, Any]:
     """
-    处理图像并移除背景
+    执行抠图并生成所有输出图像，不做编码
+
+    一次推理，多个背景共用同一个掩码合成，多个尺寸都由合成结果缩放得到
 
     参数:
         image: PIL图像对象
         bg_type: 背景类型 (transparent 或 color)
         bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
         segmentation_service: 分割服务依赖
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        sizes: 额外输出的尺寸(最长边像素数)
+        backgrounds: parse_backgrounds 返回的背景列表，指定时忽略bg_type和bg_color，
+            结果图为第一个背景的合成结果
+        prediction: predict_masks 对限制尺寸后的图像预先批量得到的掩码，None表示单独推理
+        roi: 原图坐标的主体边界框，只对其周围区域推理，区域外视为背景
 
     返回:
-        包含处理结果的字典
+        包含原图、结果图、各尺寸结果、各背景结果、性能指标和背景颜色信息的字典
     """
     # 限制图片大小，避免过大的图片导致处理过慢
-    image = resize_image_to_limit(image, (3000, 3000))
+    with tracing.span("resize_image_to_limit", original_size=list(image.size)):
+        image = resize_image_to_limit(image, MAX_IMAGE_SIZE)
+
+    if prediction is None and roi is not None:
+        prediction = segmentation_service.predict_mask(image, scale_roi(roi, image))
 
     # 处理背景颜色
     background_color = None
@@ -126,18 +322,118 @@ def process_image(
             raise ValueError("无效的背景颜色格式")
 
     # 使用服务进行抠图
-    result_image, metrics = segmentation_service.segment_image(image, bg_color if bg_type == "color" else None)
+    composites: Dict[str, Image.Image] = {}
+    if backgrounds:
+        with tracing.span("segment_image", backgrounds=len(backgrounds)):
+            composites, metrics = segmentation_service.segment_backgrounds(
+                image,
+                backgrounds,
+                crop=crop,
+                crop_padding=crop_padding,
+                prediction=prediction,
+            )
+        result_image = next(iter(composites.values()))
+    else:
+        with tracing.span("segment_image"):
+            result_image, metrics = segmentation_service.segment_image(
+                image,
+                bg_color if bg_type == "color" else None,
+                crop=crop,
+                crop_padding=crop_padding,
+                prediction=prediction,
+            )
+
+    # 生成多个尺寸
+    variants: Dict[int, Image.Image] = {}
+    background_variants: Dict[str, Dict[int, Image.Image]] = {}
+    if sizes:
+        with tracing.span("make_size_variants", sizes=list(sizes)):
+            variants = make_size_variants(result_image, sizes)
+            for key, composite in composites.items():
+                background_variants[key] = make_size_variants(composite, sizes)
 
-    # 将图像转换为base64编码
-    result_base64 = image_to_base64(result_image)
-    orig_base64 = image_to_base64(image)
+    return {
+        "original_image": image,
+        "result_image": result_image,
+        "variants": variants,
+        "backgrounds": composites,
+        "background_variants": background_variants,
+        "metrics": metrics,
+        "bg_color_info": get_color_info(background_color),
+    }
 
-    # 获取背景颜色信息
-    bg_color_info = get_color_info(background_color)
 
-    return {
+def process_image(
+    image: Image.Image,
+    bg_type: str,
+    bg_color: str,
+    segmentation_service: SegmentationService,
+    crop: bool = False,
+    crop_padding: int = 0,
+    sizes: Optional[List[int]] = None,
+    backgrounds: Optional[List[Dict[str, Any]]] = None,
+    roi: Optional[Tuple[int, int, int, int]] = None,
+) -> Dict[str, Any]:
+    """
+    处理图像并移除背景
+
+    参数:
+        image: PIL图像对象
+        bg_type: 背景类型 (transparent 或 color)
+        bg_color: 十六进制背景颜色值 (当bg_type=color时使用)
+        segmentation_service: 分割服务依赖
+        crop: 是否裁剪到主体的边界框
+        crop_padding: 裁剪时边界框四周保留的像素
+        sizes: 额外输出的尺寸(最长边像素数)
+        backgrounds: parse_backgrounds 返回的背景列表
+        roi: 原图坐标的主体边界框
+
+    返回:
+        包含处理结果的字典
+    """
+    outputs = render_outputs(image, bg_type, bg_color, segmentation_service, crop, crop_padding,
+                             sizes, backgrounds, roi=roi)
+    return encode_outputs(outputs)
+
+
+def encode_outputs(outputs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    把 render_outputs 生成的所有图像编码为Base64
+
+    参数:
+        outputs: render_outputs 的返回值，编码后的图像会从中移除
+
+    返回:
+        包含Base64结果图、原图、各尺寸和各背景结果、性能指标和背景颜色信息的字典
+    """
+    # 将图像转换为base64编码，编码后即释放对应的图像
+    with tracing.span("encode_result"):
+        result_base64 = image_to_base64(outputs.pop("result_image"))
+    with tracing.span("encode_original"):
+        orig_base64 = image_to_base64(outputs.pop("original_image"))
+
+    result = {
         "result_image": result_base64,
         "original_image": orig_base64,
-        "metrics": metrics,
-        "bg_color_info": bg_color_info,
-    }
\ No newline at end of file
+        "metrics": outputs["metrics"],
+        "bg_color_info": outputs["bg_color_info"],
+    }
+
+    if outputs["variants"]:
+        with tracing.span("encode_variants"):
+            result["variants"] = {
+                str(size): image_to_base64(variant) for size, variant in outputs["variants"].items()
+            }
+
+    if outputs["backgrounds"]:
+        with tracing.span("encode_backgrounds"):
+            result["backgrounds"] = {
+                key: image_to_base64(composite) for key, composite in outputs["backgrounds"].items()
+            }
+            if outputs["background_variants"]:
+                result["background_variants"] = {
+                    key: {str(size): image_to_base64(variant) for size, variant in variants.items()}
+                    for key, variants in outputs["background_variants"].items()
+                }
+
+    return result
@@ -0,0 +1,291 @@
+"""
+内存统计工具
+
+读取Linux的 /proc/<pid>/smaps_rollup，区分每个worker独占的内存(USS)和与其他进程共享的内存，
+用于衡量共享权重的效果；PeakMemoryTracker 统计单个请求处理期间的峰值内存。
+
+查看所有uvicorn worker的内存:
+    python -m app.utils.memory_utils --match uvicorn
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, Set
+
+from app import config
+
+_KB = 1024
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _parse_smaps_lines(lines: List[str], fields: Dict[str, int]) -> None:
+    """累加smaps格式中以kB为单位的字段"""
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == "kB":
+            key = parts[0].rstrip(":")
+            fields[key] = fields.get(key, 0) + int(parts[1]) * _KB
+
+
+def read_process_memory(pid: int, mapping_suffix: Optional[str] = None) -> Dict[str, int]:
+    """
+    读取进程的内存占用
+
+    参数:
+        pid: 进程ID
+        mapping_suffix: 额外统计路径以该后缀结尾的映射(例如共享权重文件)
+
+    返回:
+        以字节为单位的内存统计:
+            rss: 常驻内存
+            pss: 按共享进程数分摊后的内存
+            unique: 进程独占的内存(USS)
+            shared: 与其他进程共享的内存
+            mapping_rss / mapping_shared: 指定映射的常驻内存与共享部分
+    """
+    fields: Dict[str, int] = {}
+    rollup_path = f"/proc/{pid}/smaps_rollup"
+    if os.path.exists(rollup_path):
+        with open(rollup_path, "r") as f:
+            _parse_smaps_lines(f.readlines(), fields)
+    else:
+        with open(f"/proc/{pid}/smaps", "r") as f:
+            _parse_smaps_lines(f.readlines(), fields)
+
+    result = {
+        "pid": pid,
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "unique": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+    if mapping_suffix:
+        result.update(_read_mapping_memory(pid, mapping_suffix))
+
+    return result
+
+
+def _read_mapping_memory(pid: int, suffix: str) -> Dict[str, int]:
+    """统计进程中路径以指定后缀结尾的内存映射"""
+    fields: Dict[str, int] = {}
+    in_mapping = False
+    with open(f"/proc/{pid}/smaps", "r") as f:
+        for line in f:
+            first = line.split(maxsplit=1)[0]
+            if "-" in first and not first.endswith(":"):
+                # 新映射的表头行: 地址范围 权限 偏移 设备 inode 路径
+                in_mapping = line.rstrip().endswith(suffix)
+            elif in_mapping:
+                _parse_smaps_lines([line], fields)
+
+    return {
+        "mapping_rss": fields.get("Rss", 0),
+        "mapping_shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+
+def find_processes(pattern: str) -> List[int]:
+    """查找命令行包含指定字符串的进程"""
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) == os.getpid():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode(errors="ignore")
+        except OSError:
+            continue
+        if pattern in cmdline:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def read_rss(pid: Optional[int] = None) -> int:
+    """读取进程(默认当前进程)的常驻内存(字节)，不支持时返回0"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm", "r") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def read_peak_rss(pid: Optional[int] = None) -> int:
+    """读取进程(默认当前进程)的峰值常驻内存VmHWM(字节)，不支持时返回0"""
+    try:
+        with open(f"/proc/{pid or 'self'}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * _KB
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def reset_peak_rss(pid: Optional[int] = None) -> bool:
+    """重置进程(默认当前进程)的VmHWM，成功返回True(需要Linux 4.0以上)"""
+    try:
+        with open(f"/proc/{pid or 'self'}/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemoryTracker:
+    """
+    统计一段代码执行期间的峰值内存
+
+    rss模式由一个共享的采样线程定期读取进程常驻内存，所有活动的统计器共用采样结果；
+    进程内并发处理多个请求时，统计的是这段时间内整个进程的峰值，而不是单个请求独占的部分。
+    tracemalloc模式额外统计Python对象和NumPy数组的分配峰值(Pillow图像的像素内存不在其中)。
+
+    同一个统计器可以多次进入，后续进入继续累计峰值(例如流式响应在路由返回后继续编码)。
+
+    用法:
+        with PeakMemoryTracker() as memory:
+            ...
+        metrics["memory"] = memory.to_dict()
+    """
+
+    _active: Set["PeakMemoryTracker"] = set()
+    _lock = threading.Lock()
+    _sampler: Optional[threading.Thread] = None
+
+    def __init__(self, mode: Optional[str] = None):
+        """
+        参数:
+            mode: off、rss 或 tracemalloc，默认使用 MEMORY_ACCOUNTING 配置
+        """
+        self.mode = (mode or config.MEMORY_ACCOUNTING).lower()
+        self.start_rss = 0
+        self.peak_rss = 0
+        self.start_traced = 0
+        self.peak_traced: Optional[int] = None
+        self._started = False
+
+    def __enter__(self) -> "PeakMemoryTracker":
+        if self.mode == "off":
+            return self
+
+        if not self._started:
+            self.start_rss = self.peak_rss = read_rss()
+        if self.mode == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            if not self._started:
+                self.start_traced = tracemalloc.get_traced_memory()[0]
+        self._started = True
+
+        cls = type(self)
+        with cls._lock:
+            cls._active.add(self)
+            if cls._sampler is None:
+                cls._sampler = threading.Thread(target=cls._sample_loop, name="memory-sampler", daemon=True)
+                cls._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.mode == "off":
+            return
+
+        cls = type(self)
+        with cls._lock:
+            cls._active.discard(self)
+        self._update(read_rss())
+        if self.mode == "tracemalloc" and tracemalloc.is_tracing():
+            peak_traced = max(0, tracemalloc.get_traced_memory()[1] - self.start_traced)
+            self.peak_traced = max(self.peak_traced or 0, peak_traced)
+
+    def _update(self, rss: int) -> None:
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+
+    @classmethod
+    def _sample_loop(cls) -> None:
+        """有活动的统计器时持续采样，全部结束后退出"""
+        interval = max(0.0005, config.MEMORY_SAMPLE_MS / 1000.0)
+        while True:
+            rss = read_rss()
+            with cls._lock:
+                if not cls._active:
+                    cls._sampler = None
+                    return
+                for tracker in cls._active:
+                    tracker._update(rss)
+            time.sleep(interval)
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        """
+        获取统计结果，可以在统计结束前调用得到当前为止的峰值
+
+        返回:
+            peak_rss_bytes: 期间进程常驻内存的峰值
+            peak_rss_delta_bytes: 峰值相对开始时增加的常驻内存
+            peak_traced_bytes: tracemalloc统计的分配峰值(仅tracemalloc模式)
+            关闭统计时返回None
+        """
+        if self.mode == "off":
+            return None
+        result: Dict[str, Any] = {
+            "peak_rss_bytes": self.peak_rss,
+            "peak_rss_delta_bytes": max(0, self.peak_rss - self.start_rss),
+        }
+        if self.mode == "tracemalloc":
+            peak_traced = self.peak_traced
+            if peak_traced is None and tracemalloc.is_tracing():
+                peak_traced = max(0, tracemalloc.get_traced_memory()[1] - self.start_traced)
+            result["peak_traced_bytes"] = peak_traced
+        return result
+
+
+def format_memory_report(reports: List[Dict[str, int]]) -> str:
+    """把多个进程的内存统计格式化为表格"""
+    def mb(value: int) -> str:
+        return f"{value / _KB / _KB:10.1f}"
+
+    has_mapping = any("mapping_rss" in r for r in reports)
+    header = f"{'PID':>8} {'RSS(MB)':>10} {'PSS(MB)':>10} {'独占(MB)':>10} {'共享(MB)':>10}"
+    if has_mapping:
+        header += f" {'权重RSS(MB)':>12} {'权重共享(MB)':>12}"
+    lines = [header]
+
+    totals = {"rss": 0, "pss": 0, "unique": 0, "shared": 0}
+    for report in reports:
+        line = f"{report['pid']:>8} {mb(report['rss'])} {mb(report['pss'])} {mb(report['unique'])} {mb(report['shared'])}"
+        if has_mapping:
+            line += f"   {mb(report.get('mapping_rss', 0))}   {mb(report.get('mapping_shared', 0))}"
+        lines.append(line)
+        for key in totals:
+            totals[key] += report[key]
+
+    lines.append(f"{'合计':>8} {mb(totals['rss'])} {mb(totals['pss'])} {mb(totals['unique'])} {mb(totals['shared'])}")
+    lines.append(f"PSS合计即这些进程实际占用的物理内存: {totals['pss'] / _KB / _KB:.1f} MB")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="统计worker进程的独占与共享内存")
+    parser.add_argument("pids", nargs="*", type=int, help="进程ID")
+    parser.add_argument("--match", help="按命令行匹配进程，例如 uvicorn")
+    parser.add_argument("--mapping", default=".shared.bin", help="单独统计的内存映射文件后缀")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出")
+    args = parser.parse_args()
+
+    pids = list(args.pids)
+    if args.match:
+        pids.extend(find_processes(args.match))
+    if not pids:
+        parser.error("请指定进程ID或使用 --match")
+
+    reports = [read_process_memory(pid, args.mapping) for pid in pids]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_memory_report(reports))
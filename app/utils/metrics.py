@@ -0,0 +1,111 @@
+"""
+进程内指标注册表
+
+计数器和仪表按标签组合累计，以Prometheus文本格式通过 /api/metrics 导出，
+不依赖 prometheus_client。多进程部署时每个进程分别导出自己的指标。
+"""
+
+import threading
+from typing import Dict, List, Tuple
+
+_LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    """带标签的指标，每个标签组合一个数值"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[_LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> _LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"指标 {self.name} 的标签必须是 {self.label_names}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def get(self, **labels: object) -> float:
+        """读取一个标签组合的当前值"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def collect(self) -> List[Tuple[_LabelValues, float]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in self.collect():
+            if key:
+                labels = ",".join(f'{name}="{_escape(v)}"' for name, v in zip(self.label_names, key))
+                lines.append(f"{self.name}{{{labels}}} {value:g}")
+            else:
+                lines.append(f"{self.name} {value:g}")
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """可以任意设置的仪表"""
+
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class MetricsRegistry:
+    """指标注册表，同名指标只注册一次"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls: type, name: str, documentation: str, labels: Tuple[str, ...]) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labels)
+            elif not isinstance(metric, cls) or metric.label_names != tuple(labels):
+                raise ValueError(f"指标 {name} 已以不同的类型或标签注册")
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        """注册或获取计数器"""
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        """注册或获取仪表"""
+        return self._register(Gauge, name, documentation, labels)
+
+    def render(self) -> str:
+        """以Prometheus文本格式导出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,209 @@
+"""
+在线性能分析
+
+对运行中的工作进程按需采集若干秒的Python调用栈，支持两种模式:
+
+- sample: 后台线程定期读取所有线程的调用栈，输出折叠栈(collapsed stack)文本，
+  可直接交给 flamegraph.pl、speedscope 等工具生成火焰图。每条栈以所属路由开头。
+- cprofile: 对采集期间执行的路由处理函数和流水线阶段任务启用cProfile，输出pstats文件，
+  可用 python -m pstats 或 snakeviz 查看。
+
+没有采集时，路由处理函数和流水线阶段任务只额外记录当前线程服务的路由，开销可以忽略。
+同一时间只允许一个采集。
+"""
+
+import contextvars
+import cProfile
+import functools
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+MODES = ("sample", "cprofile")
+
+# 这些模块中的栈顶帧表示线程在等待，默认不计入采样
+_IDLE_MODULES = ("threading", "queue", "selectors", "asyncio.base_events", "concurrent.futures.thread")
+
+# 当前请求所属的路由，随上下文传到流水线阶段任务
+_route: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("profile_route", default=None)
+# 线程ID到该线程正在服务的路由，采样线程据此给调用栈分组
+_thread_routes: Dict[int, str] = {}
+
+_capture: Optional["Capture"] = None
+_capture_lock = threading.Lock()
+_local = threading.local()
+
+
+class CaptureBusy(RuntimeError):
+    """已有采集正在进行"""
+
+
+class Capture:
+    """一次采集，start 之后到 stop 之间的调用栈计入结果"""
+
+    def __init__(self, mode: str, interval: float, route: Optional[str] = None, include_idle: bool = False):
+        if mode not in MODES:
+            raise ValueError(f"无效的分析模式: {mode}，必须是{'或'.join(MODES)}")
+        self.mode = mode
+        self.interval = interval
+        self.route = route
+        self.include_idle = include_idle
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.stats: Optional[pstats.Stats] = None
+        self.profiled_calls = 0
+        self.started = 0.0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        开始采集
+
+        异常:
+            CaptureBusy: 已有采集正在进行
+        """
+        global _capture
+        with _capture_lock:
+            if _capture is not None:
+                raise CaptureBusy("已有性能分析正在进行")
+            _capture = self
+        self.started = time.perf_counter()
+        if self.mode == "sample":
+            self._sampler = threading.Thread(target=self._sample_loop, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        """停止采集，已经开始的cProfile调用在结束时仍会合并进结果"""
+        global _capture
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with _capture_lock:
+            if _capture is self:
+                _capture = None
+        self.duration = time.perf_counter() - self.started
+
+    def _sample_loop(self) -> None:
+        own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                route = _thread_routes.get(ident, "other")
+                if self.route is not None and route != self.route:
+                    continue
+                stack = _collapse(frame, self.include_idle)
+                if stack is not None:
+                    self.samples[f"{route};{stack}"] += 1
+            self.sample_count += 1
+
+    def run_profiled(self, fn: Callable[..., Any], args: Any, kwargs: Any) -> Any:
+        """在cProfile下执行一次调用，结束后合并到采集结果"""
+        profile = cProfile.Profile()
+        _local.profiling = True
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            _local.profiling = False
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+                self.profiled_calls += 1
+
+    def collapsed(self) -> str:
+        """折叠栈文本，每行为 "路由;外层帧;...;内层帧 次数" """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def pstats_bytes(self) -> bytes:
+        """与 pstats.Stats.dump_stats 相同格式的pstats文件内容"""
+        with self._lock:
+            return marshal.dumps(self.stats.stats if self.stats is not None else {})
+
+    def summary(self) -> Dict[str, Any]:
+        """采集概况"""
+        routes: Counter = Counter()
+        for stack, count in self.samples.items():
+            routes[stack.split(";", 1)[0]] += count
+        return {
+            "mode": self.mode,
+            "duration": round(self.duration, 3),
+            "route": self.route,
+            "samples": self.sample_count,
+            "routes": dict(routes),
+            "profiled_calls": self.profiled_calls,
+        }
+
+
+def _frame_name(frame: Any) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _collapse(frame: Any, include_idle: bool) -> Optional[str]:
+    """把线程的调用栈转换为从外到内以分号连接的帧名，线程在等待且不统计空闲时返回None"""
+    if not include_idle and frame.f_globals.get("__name__") in _IDLE_MODULES:
+        return None
+    names: List[str] = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def current() -> Optional[Capture]:
+    """正在进行的采集，没有时返回None"""
+    return _capture
+
+
+def call(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    执行函数并登记当前线程服务的路由；cProfile采集期间同时分析这次调用
+
+    路由来自调用方上下文中由 profiled 设置的值，同一线程内嵌套调用时只分析最外层
+    """
+    ident = threading.get_ident()
+    previous = _thread_routes.get(ident)
+    _thread_routes[ident] = _route.get() or "other"
+    try:
+        capture = _capture
+        if capture is None or capture.mode != "cprofile" or getattr(_local, "profiling", False):
+            return fn(*args, **kwargs)
+        if capture.route is not None and _thread_routes[ident] != capture.route:
+            return fn(*args, **kwargs)
+        return capture.run_profiled(fn, args, kwargs)
+    finally:
+        if previous is None:
+            _thread_routes.pop(ident, None)
+        else:
+            _thread_routes[ident] = previous
+
+
+def profiled(route: str) -> Callable[[F], F]:
+    """
+    装饰在线程池中执行的路由处理函数，把它的调用栈归到指定路由下
+
+    参数:
+        route: 路由名称，例如 /api/remove-background-base64
+    """
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            token = _route.set(route)
+            try:
+                return call(fn, *args, **kwargs)
+            finally:
+                _route.reset(token)
+        return wrapper  # type: ignore[return-value]
+    return decorator
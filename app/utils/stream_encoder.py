@@ -0,0 +1,216 @@
+"""
+流式图像编码
+
+按行带(band)编码PNG，每压缩完一个行带就交出一个IDAT块，响应可以在整张图编码完成前开始发送，
+编码缓冲区的大小由 STREAM_BAND_BYTES 决定，与图像高度无关。
+行过滤与PIL相同，每行在Sub、Up、Average、Paeth和不过滤中选择绝对值之和最小的一种。
+
+WebP由libwebp一次编码整张图，不能按行带输出；iter_webp 编码完成后按固定大小分块发送，
+省去复制整个编码结果，但峰值内存与整图编码相同。
+"""
+
+import base64
+import io
+import struct
+import time
+import zlib
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import numpy as np
+from PIL import Image
+
+from app import config
+from app.utils.metrics import registry
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PIL模式到PNG颜色类型和每像素字节数
+_COLOR_TYPES = {"L": (0, 1), "RGB": (2, 3), "LA": (4, 2), "RGBA": (6, 4)}
+
+# iter_webp 每次交出的字节数
+WEBP_CHUNK_BYTES = 256 * 1024
+
+_ttfb_seconds = registry.counter("rmbg_stream_ttfb_seconds_total",
+                                 "流式响应从开始处理请求到交出第一块数据的累计耗时", ("format",))
+_transfer_seconds = registry.counter("rmbg_stream_transfer_seconds_total",
+                                     "流式响应从第一块到最后一块数据发送完成的累计耗时", ("format",))
+_responses = registry.counter("rmbg_stream_responses_total", "发送完成的流式响应数", ("format",))
+_bytes_sent = registry.counter("rmbg_stream_bytes_total", "流式响应发送的字节数", ("format",))
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+
+def _paeth(left: np.ndarray, up: np.ndarray, up_left: np.ndarray) -> np.ndarray:
+    """Paeth预测值，参数为int16数组"""
+    estimate = left + up - up_left
+    distance_left = np.abs(estimate - left)
+    distance_up = np.abs(estimate - up)
+    distance_up_left = np.abs(estimate - up_left)
+    return np.where((distance_left <= distance_up) & (distance_left <= distance_up_left), left,
+                    np.where(distance_up <= distance_up_left, up, up_left))
+
+
+def _filter_rows(rows: np.ndarray, previous: np.ndarray, bpp: int) -> np.ndarray:
+    """
+    对一个行带做PNG行过滤
+
+    参数:
+        rows: (行数, 每行字节数) 的uint8原始数据
+        previous: 行带上方一行的原始数据，第一个行带为全0
+        bpp: 每像素字节数
+
+    返回:
+        (行数, 1 + 每行字节数) 的uint8数据，每行以过滤类型开头
+    """
+    raw = rows.astype(np.int16)
+    up = np.concatenate([previous[np.newaxis].astype(np.int16), raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    up_left = np.zeros_like(raw)
+    up_left[:, bpp:] = up[:, :-bpp]
+
+    candidates = np.stack([
+        raw,
+        raw - left,
+        raw - up,
+        raw - ((left + up) >> 1),
+        raw - _paeth(left, up, up_left),
+    ]).astype(np.uint8)
+    # 与libpng相同的启发式：把过滤结果看作有符号字节，选绝对值之和最小的过滤方式
+    costs = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    choice = costs.argmin(axis=0)
+
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = choice
+    filtered[:, 1:] = candidates[choice, np.arange(rows.shape[0])]
+    return filtered
+
+
+def iter_png(image: Image.Image, compress_level: Optional[int] = None,
+             band_bytes: Optional[int] = None) -> Iterator[bytes]:
+    """
+    按行带编码PNG并逐块生成
+
+    参数:
+        image: 要编码的图像，L、LA、RGB和RGBA以外的模式按行带转换为RGB或RGBA
+        compress_level: zlib压缩级别(0-9)，None为默认级别
+        band_bytes: 每个行带原始数据的字节数上限，None时使用 STREAM_BAND_BYTES
+
+    返回:
+        PNG文件的字节块，第一块包含文件头和第一个行带
+    """
+    mode = image.mode
+    if mode not in _COLOR_TYPES:
+        mode = "RGBA" if "A" in image.mode or "transparency" in image.info else "RGB"
+    color_type, bpp = _COLOR_TYPES[mode]
+    width, height = image.size
+
+    header = _PNG_SIGNATURE + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+    icc_profile = image.info.get("icc_profile")
+    if icc_profile:
+        header += _png_chunk(b"iCCP", b"ICC Profile\x00\x00" + zlib.compress(icc_profile))
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compress_level is None else compress_level)
+    previous = np.zeros(width * bpp, dtype=np.uint8)
+    # 每个行带的原始数据不超过 band_bytes，至少为一行
+    rows_per_band = max(1, (band_bytes or config.STREAM_BAND_BYTES) // max(1, width * bpp))
+    for top in range(0, height, rows_per_band):
+        band = image.crop((0, top, width, min(height, top + rows_per_band)))
+        if band.mode != mode:
+            band = band.convert(mode)
+        rows = np.frombuffer(band.tobytes(), dtype=np.uint8).reshape(band.height, width * bpp)
+        del band
+        filtered = _filter_rows(rows, previous, bpp)
+        previous = rows[-1]
+        # 每个行带同步刷新一次，压缩结果立即可以发送
+        data = compressor.compress(filtered) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        del filtered, rows
+        chunk = _png_chunk(b"IDAT", data)
+        if header:
+            chunk, header = header + chunk, b""
+        yield chunk
+
+    data = compressor.flush()
+    yield header + _png_chunk(b"IDAT", data) + _png_chunk(b"IEND", b"")
+
+
+def iter_webp(image: Image.Image, chunk_bytes: int = WEBP_CHUNK_BYTES, **options: Any) -> Iterator[bytes]:
+    """
+    编码WebP并分块生成；libwebp不能按行带输出，整张图编码完成后才交出第一块
+
+    参数:
+        image: 要编码的图像
+        chunk_bytes: 每块的字节数
+        options: 传给 Image.save 的WebP参数，例如 quality、lossless
+
+    返回:
+        WebP文件的字节块
+    """
+    buffered = io.BytesIO()
+    image.save(buffered, format="WEBP", **options)
+    with buffered.getbuffer() as view:
+        for offset in range(0, len(view), chunk_bytes):
+            yield bytes(view[offset:offset + chunk_bytes])
+
+
+def iter_base64(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """把字节块逐块编码为Base64，拼接结果与整体编码相同"""
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        cut = len(data) - len(data) % 3
+        pending = data[cut:]
+        if cut:
+            yield base64.b64encode(memoryview(data)[:cut])
+    if pending:
+        yield base64.b64encode(pending)
+
+
+class TransferTimer:
+    """记录流式响应的首字节时间(TTFB)和传输时间，发送完成后计入指标"""
+
+    def __init__(self, start: float, format: str):
+        """
+        参数:
+            start: 开始处理请求的 time.perf_counter() 值
+            format: 指标标签，例如 png、webp、json
+        """
+        self.start = start
+        self.format = format
+        self.first_byte: Optional[float] = None
+        self.last_byte: Optional[float] = None
+        self.bytes_sent = 0
+
+    def wrap(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        逐块转发并计时；生成器在上一块被服务器发送后才继续，最后一块返回时视为传输完成
+
+        参数:
+            chunks: 响应体的字节块
+        """
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if self.first_byte is None:
+                self.first_byte = time.perf_counter()
+            self.bytes_sent += len(chunk)
+            yield chunk
+            self.last_byte = time.perf_counter()
+        if self.first_byte is not None:
+            _ttfb_seconds.inc(self.first_byte - self.start, format=self.format)
+            _transfer_seconds.inc(self.last_byte - self.first_byte, format=self.format)
+            _responses.inc(format=self.format)
+            _bytes_sent.inc(self.bytes_sent, format=self.format)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """到目前为止的首字节时间和传输时间(秒)"""
+        if self.first_byte is None:
+            return {"ttfb": None, "transfer_time": None, "bytes": 0}
+        last_byte = self.last_byte if self.last_byte is not None else self.first_byte
+        return {
+            "ttfb": self.first_byte - self.start,
+            "transfer_time": last_byte - self.first_byte,
+            "bytes": self.bytes_sent,
+        }
@@ -0,0 +1,282 @@
+"""
+请求级分布式追踪
+
+每个HTTP请求创建一条追踪(trace)，路由、process_image 和 SegmentationService 中的各个阶段
+以嵌套的span记录耗时。追踪上下文通过W3C traceparent请求头传入和传出，
+较慢的追踪保存在有界环形缓冲区中，可以导出为Chrome Trace Event格式
+(chrome://tracing 或 Perfetto 可直接打开)。
+"""
+
+import contextvars
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from app import config
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id(bytes_count: int) -> str:
+    return os.urandom(bytes_count).hex()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    解析W3C traceparent请求头
+
+    参数:
+        header: traceparent请求头的值
+
+    返回:
+        (trace_id, parent_span_id)，格式无效时返回None
+    """
+    if not header:
+        return None
+    match = _TRACEPARENT_RE.match(header.strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2)
+
+
+def _is_sampled(header: str) -> bool:
+    """traceparent的trace-flags是否带有sampled标记"""
+    return bool(int(header.strip()[-2:], 16) & 0x01)
+
+
+class Span:
+    """追踪中的一个计时区间"""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start", "start_perf",
+                 "duration", "attributes", "thread_id")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str],
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.start_perf = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.thread_id = threading.get_ident()
+
+    def finish(self) -> None:
+        """结束计时"""
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start_perf
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """设置span属性"""
+        self.attributes[key] = value
+
+    def traceparent(self) -> str:
+        """生成以当前span为父节点的traceparent请求头"""
+        return f"00-{self.trace.trace_id}-{self.span_id}-{self.trace.flags}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """一次请求的完整追踪"""
+
+    def __init__(self, trace_id: Optional[str] = None, sampled: bool = True):
+        self.trace_id = trace_id or _new_id(16)
+        self.flags = "01" if sampled else "00"
+        self.spans: List[Span] = []
+        # ONNX Runtime算子级分析事件(Chrome Trace Event格式)
+        self.profile_events: List[Dict[str, Any]] = []
+        self.sampled = sampled
+        self.profile_inference = sampled and random.random() < config.TRACE_ORT_PROFILE_RATE
+        self._lock = threading.Lock()
+
+    def new_span(self, name: str, parent_id: Optional[str],
+                 attributes: Optional[Dict[str, Any]] = None) -> Span:
+        span = Span(self, name, parent_id, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration or 0.0
+
+    def add_profile_events(self, events: List[Dict[str, Any]], anchor: Span) -> None:
+        """
+        附加ONNX Runtime分析器输出的事件，时间轴对齐到指定span的开始时间
+
+        参数:
+            events: ONNX Runtime分析文件中的事件
+            anchor: 对应的推理span
+        """
+        runs = [e for e in events if e.get("name") == "model_run"] or events
+        if not runs:
+            return
+        origin = min(e.get("ts", 0) for e in runs)
+        offset = anchor.start * 1e6 - origin
+        with self._lock:
+            for event in events:
+                if event.get("ts", 0) < origin:
+                    # 跳过会话初始化阶段的事件
+                    continue
+                self.profile_events.append(dict(event, ts=event["ts"] + offset, pid="onnxruntime"))
+
+    def summary(self) -> Dict[str, Any]:
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "start": root.start,
+            "duration": self.duration,
+            "span_count": len(self.spans),
+            "attributes": root.attributes,
+            "ort_profile": bool(self.profile_events),
+        }
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """导出为Chrome Trace Event格式"""
+        thread_ids: Dict[int, int] = {}
+        events = []
+        for span in self.spans:
+            tid = thread_ids.setdefault(span.thread_id, len(thread_ids) + 1)
+            events.append({
+                "name": span.name,
+                "cat": "rmbg",
+                "ph": "X",
+                "ts": span.start * 1e6,
+                "dur": (span.duration or 0.0) * 1e6,
+                "pid": "rmbg",
+                "tid": tid,
+                "args": dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id),
+            })
+        events.extend(self.profile_events)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"trace_id": self.trace_id},
+        }
+
+
+class TraceStore:
+    """保存最近较慢追踪的有界环形缓冲区"""
+
+    def __init__(self, max_traces: int, slow_threshold: float):
+        """
+        参数:
+            max_traces: 最多保存的追踪数
+            slow_threshold: 超过该耗时(秒)的追踪才会保存
+        """
+        self.slow_threshold = slow_threshold
+        self._traces: Deque[Trace] = deque(maxlen=max(1, max_traces))
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace) -> None:
+        """保存结束的追踪；上游标记为不采样的追踪不保存，带有算子级分析数据的追踪总是保存"""
+        if not trace.sampled:
+            return
+        if trace.duration < self.slow_threshold and not trace.profile_events:
+            return
+        with self._lock:
+            self._traces.append(trace)
+
+    def list(self) -> List[Dict[str, Any]]:
+        """按时间倒序列出保存的追踪摘要"""
+        with self._lock:
+            traces = list(self._traces)
+        return [trace.summary() for trace in reversed(traces)]
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        with self._lock:
+            for trace in self._traces:
+                if trace.trace_id == trace_id:
+                    return trace
+        return None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._traces.clear()
+
+
+trace_store = TraceStore(config.TRACE_BUFFER_SIZE, config.TRACE_SLOW_MS / 1000.0)
+
+
+def start_trace(name: str, traceparent: Optional[str] = None,
+                **attributes: Any) -> Tuple[Span, contextvars.Token]:
+    """
+    开始一条追踪并把根span设为当前span
+
+    参数:
+        name: 根span名称
+        traceparent: 上游传入的traceparent请求头，trace-flags为00时照常传播追踪上下文但不保存追踪
+
+    返回:
+        根span和用于恢复上下文的token
+    """
+    parent = parse_traceparent(traceparent)
+    trace = Trace(trace_id=parent[0] if parent else None, sampled=parent is None or _is_sampled(traceparent))
+    root = trace.new_span(name, parent[1] if parent else None, attributes)
+    return root, _current_span.set(root)
+
+
+def finish_trace(root: Span, token: contextvars.Token) -> None:
+    """结束追踪，恢复上下文并按耗时决定是否保存"""
+    root.finish()
+    _current_span.reset(token)
+    trace_store.add(root.trace)
+
+
+def current_span() -> Optional[Span]:
+    """获取当前span，不在追踪中时返回None"""
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    """获取当前追踪ID"""
+    span = _current_span.get()
+    return span.trace.trace_id if span is not None else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    在当前追踪中记录一个子span；不在追踪中时不做任何事
+
+    参数:
+        name: span名称
+        attributes: span属性
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = parent.trace.new_span(name, parent.span_id, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.attributes["error"] = str(e)
+        raise
+    finally:
+        child.finish()
+        _current_span.reset(token)
@@ -5,6 +5,9 @@ document.addEventListener("DOMContentLoaded", function() {
 
     // 设置图片预览
     setupImagePreview();
+
+    // 设置渐进式结果
+    setupProgressiveSubmit();
 });
 
 // 初始化表单设置
@@ -123,4 +126,132 @@ function setupImagePreview() {
             }
         });
     }
-}
\ No newline at end of file
+}
+
+// 当前渐进式请求的取消控制器
+var progressiveController = null;
+
+// 提交表单时通过SSE接口先显示低分辨率预览，再显示最终结果；浏览器不支持流式读取时按原方式提交
+function setupProgressiveSubmit() {
+    const form = document.querySelector('.upload-form');
+    if (!form || !window.fetch || !window.AbortController || !window.ReadableStream || !window.TextDecoder) {
+        return;
+    }
+
+    form.addEventListener('submit', function(e) {
+        e.preventDefault();
+        cancelProgressive();
+
+        const container = document.getElementById('progressive-result');
+        const image = document.getElementById('progressive-image');
+        const download = document.getElementById('progressive-download');
+        container.style.display = 'block';
+        image.removeAttribute('src');
+        image.classList.add('preview-image');
+        download.style.display = 'none';
+        document.getElementById('progressive-cancel').style.display = 'inline-block';
+        document.getElementById('progressive-metrics').innerHTML = '';
+        setProgressiveStatus('正在生成预览...');
+
+        const controller = new AbortController();
+        progressiveController = controller;
+
+        fetch('/api/remove-background-stream', {
+            method: 'POST',
+            body: new FormData(form),
+            signal: controller.signal
+        }).then(function(response) {
+            if (!response.ok) {
+                return response.json().then(function(data) {
+                    throw new Error(data.detail || response.statusText);
+                });
+            }
+            return readEventStream(response.body, handleProgressiveEvent);
+        }).catch(function(error) {
+            if (error.name !== 'AbortError') {
+                setProgressiveStatus('处理失败: ' + error.message);
+            }
+        }).then(function() {
+            if (progressiveController === controller) {
+                progressiveController = null;
+                document.getElementById('progressive-cancel').style.display = 'none';
+            }
+        });
+    });
+}
+
+// 取消当前的渐进式请求，服务端会跳过尚未完成的阶段
+function cancelProgressive() {
+    if (progressiveController) {
+        progressiveController.abort();
+        progressiveController = null;
+        document.getElementById('progressive-cancel').style.display = 'none';
+        setProgressiveStatus('已取消');
+    }
+}
+
+// 逐块读取Server-Sent Events，每个完整事件调用一次回调
+function readEventStream(body, onEvent) {
+    const reader = body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    function pump() {
+        return reader.read().then(function(result) {
+            if (result.done) {
+                return;
+            }
+            buffer += decoder.decode(result.value, { stream: true });
+            let index;
+            while ((index = buffer.indexOf('\n\n')) >= 0) {
+                const block = buffer.slice(0, index);
+                buffer = buffer.slice(index + 2);
+                let event = 'message';
+                let data = '';
+                block.split('\n').forEach(function(line) {
+                    if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        data += line.slice(5).trim();
+                    }
+                });
+                onEvent(event, data ? JSON.parse(data) : null);
+            }
+            return pump();
+        });
+    }
+    return pump();
+}
+
+// 处理预览、最终结果和错误事件
+function handleProgressiveEvent(event, data) {
+    const image = document.getElementById('progressive-image');
+    if (event === 'preview') {
+        image.src = 'data:image/png;base64,' + data.image;
+        setProgressiveStatus('预览 (' + data.size[0] + 'x' + data.size[1] + ')，正在生成完整结果...');
+        showStageMetrics('预览', data.metrics);
+    } else if (event === 'final') {
+        image.src = 'data:image/png;base64,' + data.image;
+        image.classList.remove('preview-image');
+        const download = document.getElementById('progressive-download');
+        download.href = image.src;
+        download.setAttribute('download', '抠图结果_' + new Date().toISOString().replace(/[:.]/g, '-') + '.png');
+        download.style.display = 'inline-block';
+        setProgressiveStatus('完成 (' + data.size[0] + 'x' + data.size[1] + ')，背景设置: ' + data.bg_color_info);
+        showStageMetrics('最终结果', data.metrics);
+    } else if (event === 'error') {
+        setProgressiveStatus(data.detail);
+    }
+}
+
+function setProgressiveStatus(text) {
+    document.getElementById('progressive-status').textContent = text;
+}
+
+// 显示一个阶段的耗时
+function showStageMetrics(title, metrics) {
+    const p = document.createElement('p');
+    p.textContent = title + ': 到达 ' + metrics.elapsed.toFixed(2) + ' 秒，排队 ' + metrics.queue_wait.toFixed(2) +
+        ' 秒，推理 ' + metrics.inference_time.toFixed(2) + ' 秒，编码 ' + metrics.encode_time.toFixed(2) + ' 秒';
+    document.getElementById('progressive-metrics').appendChild(p);
+}
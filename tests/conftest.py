@@ -0,0 +1,60 @@
+"""
+测试公共夹具
+"""
+
+import numpy as np
+import pytest
+
+
+def build_standin_model(path: str, seed: int = 0, fixed_batch: bool = False) -> str:
+    """
+    构建一个与RMBG输入输出形状一致的小型ONNX模型
+
+    输入(批次, 3, 高, 宽)，输出(批次, 1, 高, 宽)，空间维度为动态，批次维度在 fixed_batch 时固定为1
+    """
+    onnx = pytest.importorskip("onnx")
+    from onnx import TensorProto, helper, numpy_helper
+
+    batch_dim = 1 if fixed_batch else "batch_size"
+    rng = np.random.RandomState(seed)
+    weights = [
+        numpy_helper.from_array((rng.randn(16, 3, 3, 3) * 0.3).astype(np.float32), "conv1.weight"),
+        numpy_helper.from_array((rng.randn(1, 16, 3, 3) * 0.3).astype(np.float32), "conv2.weight"),
+    ]
+    nodes = [
+        helper.make_node("Conv", ["input", "conv1.weight"], ["conv1"], pads=[1, 1, 1, 1]),
+        helper.make_node("Relu", ["conv1"], ["relu1"]),
+        helper.make_node("Conv", ["relu1", "conv2.weight"], ["conv2"], pads=[1, 1, 1, 1]),
+        helper.make_node("Sigmoid", ["conv2"], ["output"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "standin",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [batch_dim, 3, "height", "width"])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [batch_dim, 1, "height", "width"])],
+        weights,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+
+@pytest.fixture
+def standin_model_path(tmp_path):
+    """临时目录中的替身ONNX模型路径"""
+    return build_standin_model(str(tmp_path / "model.onnx"))
+
+
+@pytest.fixture
+def standin_model_manager(standin_model_path, tmp_path, monkeypatch):
+    """加载替身模型的ModelManager，测试结束后恢复单例"""
+    from app import config
+    from app.models.model_manager import ModelManager
+
+    monkeypatch.setattr(config, "MODEL_PATH", standin_model_path)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "ORT_PROFILE_PATH", str(tmp_path / "ort_profile.json"))
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    yield ModelManager()
+    ModelManager._instance = None
@@ -0,0 +1,96 @@
+"""
+多背景合成测试
+"""
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import config
+from app.services.backgrounds import BackgroundAssetCache, composite_backgrounds, parse_backgrounds
+from app.services.segmentation import SegmentationService
+
+
+@pytest.fixture
+def asset_cache(tmp_path, monkeypatch):
+    """指向临时资源目录的背景图缓存"""
+    Image.new("RGB", (400, 300), (10, 200, 30)).save(tmp_path / "studio.jpg")
+    Image.new("RGB", (300, 300), (200, 10, 30)).save(tmp_path / "brand.png")
+    monkeypatch.setattr(config, "BACKGROUND_ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(BackgroundAssetCache, "_instance", None)
+    yield BackgroundAssetCache()
+    BackgroundAssetCache._instance = None
+
+
+def test_parse_backgrounds():
+    """测试背景列表解析、去重和校验"""
+    backgrounds = parse_backgrounds("transparent, #FFF, image:studio, blur:5, #ffffff")
+    assert [b["key"] for b in backgrounds] == ["transparent", "color_ffffffff", "image_studio", "blur_5"]
+    assert backgrounds[1]["color"] == (255, 255, 255, 255)
+    assert parse_backgrounds("blur")[0]["radius"] == config.BACKGROUND_BLUR_RADIUS
+    assert parse_backgrounds("") == []
+
+    for invalid in ("#GGG", "image:../etc", "blur:0", "blur:x"):
+        with pytest.raises(ValueError):
+            parse_backgrounds(invalid)
+    with pytest.raises(ValueError):
+        parse_backgrounds(",".join(f"#{i:06x}" for i in range(config.MAX_BACKGROUNDS + 1)))
+
+
+def test_composite_matches_apply_mask(asset_cache):
+    """测试多背景合成与单背景 apply_mask 的结果逐像素一致"""
+    rng = np.random.RandomState(0)
+    image = Image.fromarray(rng.randint(0, 256, (60, 80, 3), dtype=np.uint8))
+    mask = Image.fromarray(rng.randint(0, 256, (60, 80), dtype=np.uint8))
+    service = SegmentationService.__new__(SegmentationService)
+
+    results = composite_backgrounds(image, mask, parse_backgrounds("transparent,#12345680,image:studio,blur"))
+
+    assert list(results) == ["transparent", "color_12345680", "image_studio", "blur_20"]
+    for key, color in (("transparent", None), ("color_12345680", (0x12, 0x34, 0x56, 0x80))):
+        expected = service.apply_mask(image, mask, color)
+        assert np.array_equal(np.asarray(results[key]), np.asarray(expected))
+    assert all(result.size == image.size and result.mode == "RGBA" for result in results.values())
+
+
+def test_asset_cache_resizes_once_and_evicts(asset_cache):
+    """测试背景图按尺寸缓存，超出容量时淘汰最久未使用的尺寸"""
+    assert asset_cache.list_assets() == ["brand", "studio"]
+    assert asset_cache.has_asset("studio") and not asset_cache.has_asset("missing")
+
+    first = asset_cache.get("studio", (100, 50))
+    assert first.size == (100, 50)
+    assert asset_cache.get("studio", (100, 50)) is first
+    assert asset_cache.get_stats()["hits"] == 1
+
+    asset_cache.max_bytes = 100 * 50 * 4 + 1
+    asset_cache.get("brand", (100, 50))
+    stats = asset_cache.get_stats()
+    assert stats["resized"] == 1 and stats["resized_bytes"] == 100 * 50 * 4
+
+    with pytest.raises(ValueError):
+        asset_cache.get("missing", (10, 10))
+
+
+def test_asset_cache_limits_originals_and_decodes_outside_lock(asset_cache, monkeypatch):
+    """测试原始背景图按最近使用淘汰，解码时不持有缓存锁"""
+    asset_cache.max_originals = 1
+    decode = asset_cache._decode_original
+    locked_while_decoding = []
+
+    def checked_decode(name):
+        locked_while_decoding.append(asset_cache._lock.locked())
+        return decode(name)
+
+    monkeypatch.setattr(asset_cache, "_decode_original", checked_decode)
+
+    asset_cache.get("studio", (100, 50))
+    asset_cache.get("studio", (60, 60))
+    assert locked_while_decoding == [False]
+    asset_cache.get("brand", (100, 50))
+    assert list(asset_cache._originals) == ["brand"]
+    assert asset_cache.get_stats()["originals"] == 1
+    # 被淘汰的背景图再次使用时重新解码
+    asset_cache.get("studio", (80, 80))
+    assert locked_while_decoding == [False, False, False]
+    assert list(asset_cache._originals) == ["studio"]
@@ -0,0 +1,96 @@
+"""
+批量处理命令行工具测试
+"""
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import cli, config
+from app.models.model_manager import ModelManager
+from app.services.segmentation import SegmentationService
+
+ROOT_DIR = Path(__file__).parent.parent
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    """使用替身模型，测试结束后恢复单例"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    yield
+    ModelManager._instance = None
+
+
+def test_cli_import_is_quiet_and_skips_web_stack():
+    """测试导入命令行工具时不加载FastAPI，也不向stdout打印"""
+    code = (
+        "import sys, app.cli; "
+        "loaded = [m for m in sys.modules if m.split('.')[0] in ('fastapi', 'starlette', 'jinja2')]; "
+        "sys.stderr.write(repr(loaded))"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=str(ROOT_DIR), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == ""
+    assert result.stderr.strip() == "[]"
+
+
+def test_predict_masks_batch_matches_single(stand_in):
+    """测试批量推理与逐张推理得到相同的掩码"""
+    rng = np.random.RandomState(0)
+    images = [Image.fromarray(rng.randint(0, 256, (h, w, 3), dtype=np.uint8))
+              for w, h in ((80, 60), (50, 90), (64, 64))]
+    service = SegmentationService()
+
+    batched = service.predict_masks(images, batch_size=2)
+    assert len(batched) == 3
+    for image, (mask, metrics) in zip(images, batched):
+        single_mask, _ = service.predict_mask(image)
+        assert mask.size == image.size
+        assert np.array_equal(np.asarray(mask), np.asarray(single_mask))
+        assert metrics["inference_time"] >= 0
+
+
+def test_run_writes_outputs_and_resumes(stand_in, tmp_path):
+    """测试批量处理的输出文件、清单和重新运行时跳过已完成的文件"""
+    input_dir = tmp_path / "in"
+    (input_dir / "sub").mkdir(parents=True)
+    Image.new("RGB", (120, 80), (200, 30, 30)).save(input_dir / "a.jpg")
+    Image.new("RGB", (60, 90), (30, 200, 30)).save(input_dir / "sub" / "b.png")
+    (input_dir / "broken.jpg").write_bytes(b"not an image")
+    (input_dir / "notes.txt").write_text("ignored")
+
+    inputs = cli.collect_inputs([str(input_dir)])
+    assert sorted(relative for _, relative in inputs) == ["a.jpg", "broken.jpg", os.path.join("sub", "b.png")]
+
+    output_dir = str(tmp_path / "out")
+    settings = {
+        "bg_type": "transparent", "bg_color": "#00000000", "crop": False, "crop_padding": 0,
+        "sizes": [32], "backgrounds": [], "batch_size": 2,
+    }
+    stats = cli.run(inputs, output_dir, settings, workers=1, progress=False)
+    assert (stats["succeeded"], stats["failed"], stats["skipped"]) == (2, 1, 0)
+    assert Image.open(os.path.join(output_dir, "a.png")).size == (120, 80)
+    assert max(Image.open(os.path.join(output_dir, "sub", "b_32.png")).size) == 32
+
+    # 重新运行只重试失败的文件
+    stats = cli.run(inputs, output_dir, settings, workers=1, progress=False)
+    assert (stats["succeeded"], stats["failed"], stats["skipped"]) == (0, 1, 2)
+
+    # 输出设置变化后重新处理
+    stats = cli.run(inputs, output_dir, dict(settings, sizes=[]), workers=1, progress=False)
+    assert (stats["succeeded"], stats["skipped"]) == (2, 0)
+
+    with open(stats["manifest"], "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == 7
+    assert all("error" in entry for entry in entries if entry["status"] == "error")
@@ -0,0 +1,248 @@
+"""
+相同请求合并测试
+"""
+
+import base64
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services import coalescing, pipeline
+from app.services.coalescing import SingleFlight
+from app.services.degradation import Admission, DegradationController
+from app.services.segmentation import SegmentationService
+
+
+def _wait_for_waiters(flight, key, count):
+    while True:
+        with flight._lock:
+            call = flight._calls.get(key)
+            if call is not None and call.waiters >= count:
+                return
+        threading.Event().wait(0.005)
+
+
+def test_single_flight_shares_one_call():
+    """测试相同键同时进行的计算只执行一次，等待者得到同一结果并计入合并数"""
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return "mask", {"inference_time": 0.1}
+
+    before = flight.get_stats()["coalesced"]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("same", compute))) for _ in range(4)]
+    threads[0].start()
+    _wait_for_waiters(flight, "same", 0)
+    for thread in threads[1:]:
+        thread.start()
+    _wait_for_waiters(flight, "same", 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    assert all(result == ("mask", {"inference_time": 0.1}) for result, _ in results)
+    assert flight.get_stats()["coalesced"] - before == 3
+    assert flight.get_stats()["in_flight"] == 0
+
+    # 完成后不缓存结果
+    assert flight.do("same", lambda: ("again", {})) == (("again", {}), False)
+
+
+def test_single_flight_propagates_errors():
+    """测试执行计算的请求失败时，等待的请求得到同一异常，之后的请求重新计算"""
+    flight = SingleFlight()
+    release = threading.Event()
+    errors = []
+
+    def failing():
+        release.wait(5)
+        raise RuntimeError("推理出错")
+
+    def run():
+        try:
+            flight.do("broken", failing)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    threads[0].start()
+    _wait_for_waiters(flight, "broken", 0)
+    threads[1].start()
+    _wait_for_waiters(flight, "broken", 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors == ["推理出错", "推理出错"]
+    assert flight.do("broken", lambda: ("ok", {}))[0] == ("ok", {})
+
+
+def test_group_member_infers_with_slot_when_keys_differ(monkeypatch):
+    """测试组内第一个请求的合并键不同或没有推理时，等待的请求占用处理名额自己推理"""
+    monkeypatch.setattr(config, "PROCESSING_CONCURRENCY", 1)
+    monkeypatch.setattr(DegradationController, "_instance", None)
+    flight = SingleFlight()
+    slots = []
+
+    def compute():
+        slots.append(DegradationController()._slots._free)
+        return "own", {}
+
+    group, leader = flight.join("digest")
+    member_group, member_leader = flight.join("digest")
+    assert leader and not member_leader and member_group is group
+    flight.settle("digest", group, "digest:roi", result=("leader", {}))
+    assert flight.share(group, "digest:other-roi", compute) == (("own", {}), False)
+    # 推理期间占用唯一的名额，完成后归还
+    assert slots == [0] and DegradationController()._slots._free == 1
+
+    group, _ = flight.join("digest")
+    flight.settle("digest", group)
+    assert flight.share(group, "digest:roi", compute) == (("own", {}), False)
+    DegradationController._instance = None
+
+
+def _upload(color=(20, 200, 40)):
+    image = Image.new("RGB", (120, 90), (200, 40, 40))
+    image.paste(color, (30, 20, 90, 70))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    buffer.seek(0)
+    digest = coalescing.hash_stream(buffer)
+    decoded = Image.open(buffer)
+    decoded.load()
+    decoded.info["content_hash"] = digest
+    return decoded
+
+
+@pytest.mark.parametrize("pipeline_enabled", [False, True])
+def test_identical_uploads_share_mask(standin_model_manager, monkeypatch, pipeline_enabled):
+    """测试同一图片的并发请求共用一次推理，各自按自己的背景合成；内容不同的图片不合并"""
+    monkeypatch.setattr(config, "PIPELINE_ENABLED", pipeline_enabled)
+    monkeypatch.setattr(pipeline.Pipeline, "_instance", None)
+    service = SegmentationService()
+    release = threading.Event()
+    inferred = []
+    infer = service.infer
+
+    def slow_infer(batch):
+        inferred.append(batch.shape)
+        release.wait(5)
+        return infer(batch)
+
+    monkeypatch.setattr(service, "infer", slow_infer)
+
+    requests = [("color", "#FFFFFF", _upload()), ("color", "#0000FF", _upload()),
+                ("transparent", "#00000000", _upload()), ("color", "#FFFFFF", _upload((10, 10, 240)))]
+    results = [None] * len(requests)
+
+    def run(index, bg_type, bg_color, image):
+        results[index] = pipeline.render(image, bg_type, bg_color, service)
+
+    threads = [threading.Thread(target=run, args=(index, *request)) for index, request in enumerate(requests)]
+    threads[0].start()
+    while not inferred:
+        threading.Event().wait(0.005)
+    for thread in threads[1:3]:
+        thread.start()
+    _wait_for_waiters(SingleFlight(), next(iter(SingleFlight()._calls)), 2)
+    release.set()
+    threads[3].start()
+    for thread in threads:
+        thread.join(10)
+    if pipeline_enabled:
+        pipeline.Pipeline().close()
+        pipeline.Pipeline._instance = None
+
+    # 相同内容一次推理，不同内容单独推理
+    assert len(inferred) == 2
+    assert [bool(result["metrics"].get("coalesced")) for result in results[:3]].count(True) == 2
+    assert not results[3]["metrics"].get("coalesced")
+    # 等待的请求不报告执行推理的请求的耗时，也不作为降级控制器的推理样本
+    for result in results[:3]:
+        metrics = result["metrics"]
+        if metrics.get("coalesced"):
+            assert metrics["inference_time"] == 0.0 and metrics["coalesced_wait"] > 0
+            admission = Admission(None, {"level": 0, "name": "full"}, 0.0)
+            admission.record(dict(metrics))
+            assert admission.inference_time is None
+        else:
+            assert metrics["inference_time"] > 0
+    # 各自按自己的背景合成，结果与不合并时相同
+    monkeypatch.setattr(config, "COALESCING_ENABLED", False)
+    monkeypatch.setattr(config, "PIPELINE_ENABLED", False)
+    for result, (bg_type, bg_color, image) in zip(results[:3], requests):
+        expected = pipeline.render(image, bg_type, bg_color, service)["result_image"]
+        assert result["result_image"].mode == expected.mode
+        assert result["result_image"].tobytes() == expected.tobytes()
+    assert results[0]["result_image"].tobytes() != results[1]["result_image"].tobytes()
+
+
+@pytest.mark.parametrize("route", ["/api/remove-background", "/api/remove-background-base64"])
+def test_identical_requests_coalesce_with_one_slot(monkeypatch, route):
+    """测试只有一个处理名额时，通过路由同时上传的相同图片只推理一次，等待的请求不占用名额"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(config, "PROCESSING_CONCURRENCY", 1)
+    monkeypatch.setattr(config, "COALESCING_ENABLED", True)
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    monkeypatch.setattr(DegradationController, "_instance", None)
+
+    release = threading.Event()
+    inferred = []
+    run_inference = SegmentationService.run_inference
+
+    def slow_run_inference(self, batch):
+        inferred.append(batch.shape)
+        release.wait(5)
+        return run_inference(self, batch)
+
+    monkeypatch.setattr(SegmentationService, "run_inference", slow_run_inference)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (120, 90), (200, 40, 40)).save(buffer, format="PNG")
+    if route == "/api/remove-background":
+        request = {"files": {"file": ("same.png", buffer.getvalue(), "image/png")}}
+    else:
+        request = {"data": {"image_base64": base64.b64encode(buffer.getvalue()).decode(), "output_type": "base64"}}
+
+    from app.main import app
+    flight = SingleFlight()
+    before = flight.get_stats()["coalesced"]
+    with TestClient(app) as client, ThreadPoolExecutor(max_workers=3) as executor:
+        first = executor.submit(client.post, route, **request)
+        while not inferred:
+            threading.Event().wait(0.005)
+        others = [executor.submit(client.post, route, **request) for _ in range(2)]
+        # 等待的请求没有排队等待唯一的名额，而是加入了正在推理的请求的组
+        while sum(group.members for group in list(flight._groups.values())) < 2:
+            threading.Event().wait(0.005)
+        assert DegradationController().get_stats()["waiting"] == 0
+        release.set()
+        responses = [first.result(10)] + [future.result(10) for future in others]
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    assert len(inferred) == 1
+    assert flight.get_stats()["coalesced"] - before == 2
+    assert flight._groups == {}
+    if route == "/api/remove-background-base64":
+        coalesced = [bool(response.json()["metrics"].get("coalesced")) for response in responses]
+        assert coalesced == [False, True, True]
+        assert all(response.json()["metrics"]["queue_wait"] == 0.0 for response in responses[1:])
+    ModelManager._instance = None
+    DegradationController._instance = None
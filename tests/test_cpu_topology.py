@@ -0,0 +1,71 @@
+"""
+CPU拓扑与绑核测试
+"""
+
+import os
+
+import onnxruntime as ort
+import pytest
+
+from app.utils import cpu_topology
+from app.utils.cpu_topology import claim_slot, plan_cpu_sets, read_topology
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    """模拟两个NUMA节点、每节点4个物理核、每核2个超线程的sysfs，CPU i 与 i+8 是同一物理核"""
+    for node, cpulist in ((0, "0-3,8-11"), (1, "4-7,12-15")):
+        node_dir = tmp_path / "node" / f"node{node}"
+        node_dir.mkdir(parents=True)
+        (node_dir / "cpulist").write_text(cpulist + "\n")
+    for cpu in range(16):
+        topology_dir = tmp_path / "cpu" / f"cpu{cpu}" / "topology"
+        topology_dir.mkdir(parents=True)
+        (topology_dir / "core_id").write_text(str(cpu % 8 % 4))
+        (topology_dir / "physical_package_id").write_text(str(cpu % 8 // 4))
+    return read_topology(str(tmp_path), allowed=set(range(16)))
+
+
+def test_read_topology(sysfs):
+    """测试按节点和物理核排序，超线程相邻"""
+    assert [cpu["cpu"] for cpu in sysfs[:4]] == [0, 8, 1, 9]
+    assert {cpu["node"] for cpu in sysfs if cpu["cpu"] in (4, 12)} == {1}
+    assert cpu_topology.parse_cpulist("0-2,5") == [0, 1, 2, 5]
+    assert cpu_topology.format_cpulist([5, 0, 1, 2]) == "0-2,5"
+
+
+@pytest.mark.parametrize("slots", [1, 2, 3, 4, 8, 16])
+def test_plan_cpu_sets_is_disjoint_and_numa_local(sysfs, slots):
+    """测试CPU集合互不重叠、覆盖所有CPU，槽位数不少于节点数时每个集合只在一个节点内"""
+    plan = plan_cpu_sets(sysfs, slots)
+
+    assert len(plan) == slots
+    assert sorted(cpu for cpu_set in plan for cpu in cpu_set) == list(range(16))
+    node_of = {cpu["cpu"]: cpu["node"] for cpu in sysfs}
+    if slots >= 2:
+        assert all(len({node_of[cpu] for cpu in cpu_set}) == 1 for cpu_set in plan)
+    if slots <= 8:
+        # 超线程与其物理核分在同一集合
+        assert all((cpu + 8) % 16 in cpu_set for cpu_set in plan for cpu in cpu_set)
+
+    assert plan_cpu_sets(sysfs, 4)[0] == [0, 8, 1, 9]
+    assert cpu_topology.describe_set(sysfs, [0, 8, 1, 9])["threads"] == 2
+    with pytest.raises(ValueError):
+        plan_cpu_sets(sysfs, 17)
+
+
+def test_claim_slot_is_exclusive(tmp_path):
+    """测试每个槽位只能被一个持有者领取"""
+    assert claim_slot(2, str(tmp_path)) == 0
+    assert claim_slot(2, str(tmp_path)) == 1
+    assert claim_slot(2, str(tmp_path)) is None
+    assert (tmp_path / "rmbg-cpu-slot-0.lock").read_text() == str(os.getpid())
+
+
+def test_session_threads_follow_assignment():
+    """测试推理线程数取物理核数，调用线程之外的线程按从1开始的处理器编号固定"""
+    session_options = ort.SessionOptions()
+    cpu_topology.apply_to_session_options(session_options, {"threads": 3, "core_cpus": [4, 5, 6]})
+
+    assert session_options.intra_op_num_threads == 3
+    assert session_options.get_session_config_entry("session.intra_op.thread_affinities") == "6;7"
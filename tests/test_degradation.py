@@ -0,0 +1,156 @@
+"""
+自适应降级与指标导出测试
+"""
+
+import asyncio
+import base64
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services import degradation
+from app.services.degradation import DegradationController
+from app.services.segmentation import SegmentationService
+from app.utils.metrics import MetricsRegistry
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    """立即响应压力变化的降级控制器"""
+    monkeypatch.setattr(config, "DEGRADATION_ENABLED", True)
+    monkeypatch.setattr(config, "SLO_QUEUE_WAIT_MS", 100.0)
+    monkeypatch.setattr(config, "SLO_INFERENCE_MS", 1000.0)
+    monkeypatch.setattr(config, "DEGRADATION_MIN_SAMPLES", 2)
+    monkeypatch.setattr(config, "DEGRADATION_COOLDOWN_S", 0.0)
+    monkeypatch.setattr(DegradationController, "_instance", None)
+    yield DegradationController()
+    DegradationController._instance = None
+
+
+def test_controller_steps_down_and_recovers(controller):
+    """测试超过SLO时逐级降级，压力消除后逐级恢复"""
+    transitions = degradation._transitions.get(from_level=0, to_level=1)
+
+    for expected in (1, 2, 3):
+        controller.observe(0.5, 0.2)
+        controller.observe(0.5, 0.2)
+        assert controller.level == expected
+    assert degradation._transitions.get(from_level=0, to_level=1) == transitions + 1
+
+    for expected in (2, 1, 0):
+        controller.observe(0.0, 0.1)
+        controller.observe(0.0, 0.1)
+        assert controller.level == expected
+    assert [t["to_level"] for t in controller.get_stats()["transitions"]] == [1, 2, 3, 2, 1, 0]
+
+
+def test_select_level_respects_request_and_support(controller):
+    """测试不允许降级的请求不降级，部署不支持的降级方式被去掉"""
+    controller.level = 3
+    assert controller.select_level(allow_degraded=False)["level"] == 0
+    assert controller.select_level(support={"dynamic_input": True, "model_variants": ["quantized"]})["level"] == 3
+
+    # 固定输入尺寸且没有量化模型时，第1、2级没有效果，第3级只保留快速缩放和编码
+    controller.level = 2
+    assert controller.select_level(support={})["level"] == 0
+    controller.level = 3
+    level = controller.select_level(support={})
+    assert level["level"] == 3 and "input_scale" not in level and level["png_compress_level"] == 1
+
+
+def test_admission_records_level_and_queue_wait(controller):
+    """测试处理名额内使用所选级别，并把级别和排队耗时写入指标"""
+    controller.level = 1
+    with controller.admit(support={"dynamic_input": True}) as admission:
+        assert degradation.current_level()["name"] == "reduced_input"
+        metrics = admission.record({"inference_time": 0.01})
+    assert degradation.current_level()["level"] == 0
+    assert metrics["degradation_level"] == 1 and metrics["queue_wait"] >= 0
+
+
+def test_reserve_queues_on_event_loop(controller):
+    """测试在事件循环中排队的请求不占用线程、全部计入排队数，按到达顺序获得名额，取消的请求让出位置"""
+    controller._slots = degradation._Slots(1)
+    order = []
+
+    async def request(index, hold):
+        async with controller.reserve() as queue_wait:
+            assert queue_wait >= 0
+            order.append(index)
+            await hold.wait()
+
+    async def main():
+        hold = asyncio.Event()
+        # 超过线程池的默认线程数(40)
+        tasks = [asyncio.create_task(request(index, hold)) for index in range(50)]
+        while controller.get_stats()["waiting"] < 49:
+            await asyncio.sleep(0.001)
+        waiting = controller.get_stats()["waiting"]
+        tasks[10].cancel()
+        hold.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return waiting
+
+    assert asyncio.run(main()) == 49
+    assert order == [index for index in range(50) if index != 10]
+    assert controller.get_stats()["waiting"] == 0
+    # 名额全部归还，线程中的同步排队立即获得名额
+    with controller.admit() as admission:
+        assert admission.queue_wait < 1
+
+
+def test_metrics_registry_render():
+    """测试Prometheus文本格式导出"""
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "测试计数", ("kind",))
+    counter.inc(kind="a")
+    counter.inc(2, kind='b"')
+    registry.gauge("test_level", "测试仪表").set(3)
+
+    text = registry.render()
+    assert '# TYPE test_total counter' in text
+    assert 'test_total{kind="a"} 1' in text and 'test_total{kind="b\\""} 2' in text
+    assert "test_level 3" in text
+    assert registry.counter("test_total", "测试计数", ("kind",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("test_total", "测试计数")
+
+
+def test_degraded_response_metrics(controller, monkeypatch):
+    """测试响应的metrics记录降级级别，降级时使用更小的模型输入"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [128, 128])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    buffer = io.BytesIO()
+    Image.new("RGB", (120, 90), (200, 40, 40)).save(buffer, format="PNG")
+    data = {"image_base64": base64.b64encode(buffer.getvalue()).decode(), "output_type": "base64"}
+
+    input_sizes = []
+    run_inference = SegmentationService.run_inference
+
+    def recording_run_inference(self, batch):
+        input_sizes.append(batch.shape[2:])
+        return run_inference(self, batch)
+
+    monkeypatch.setattr(SegmentationService, "run_inference", recording_run_inference)
+
+    from app.main import app
+    with TestClient(app) as client:
+        controller.level = 3
+        degraded = client.post("/api/remove-background-base64", data=data).json()["metrics"]
+        full = client.post("/api/remove-background-base64", data=dict(data, allow_degraded="false")).json()["metrics"]
+        metrics_text = client.get("/api/metrics").text
+
+    assert degraded["degradation_level"] == 3 and degraded["degradation"] == "fast"
+    assert full["degradation_level"] == 0
+    # 第3级把模型输入缩小一半
+    assert input_sizes == [(64, 64), (128, 128)]
+    assert "rmbg_requests_served_total" in metrics_text and "rmbg_degradation_level" in metrics_text
+    assert ModelManager().variant_sessions.keys() == {"quantized"}
+    ModelManager._instance = None
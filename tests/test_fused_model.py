@@ -0,0 +1,92 @@
+"""
+包含前后处理的包装模型测试
+"""
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw, ImageFilter
+
+from app import config
+from app.services.segmentation import SegmentationService
+from app.tools import compile_model
+
+
+def _use_fused_engine(monkeypatch, fused_path):
+    monkeypatch.setattr(config, "MODEL_FUSED_PATH", fused_path)
+    monkeypatch.setattr(config, "MODEL_ENGINE", "fused")
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+
+
+@pytest.fixture
+def fused_model_path(standin_model_path, tmp_path, monkeypatch):
+    """由替身模型编译的包装模型，并启用 MODEL_ENGINE=fused"""
+    fused_path = str(tmp_path / "model_fused.onnx")
+    compile_model.main(["--model", standin_model_path, "--output", fused_path])
+    _use_fused_engine(monkeypatch, fused_path)
+    return fused_path
+
+
+@pytest.fixture
+def missing_fused_model_path(tmp_path, monkeypatch):
+    """启用 MODEL_ENGINE=fused，但包装模型不存在"""
+    fused_path = str(tmp_path / "missing.onnx")
+    _use_fused_engine(monkeypatch, fused_path)
+    return fused_path
+
+
+@pytest.fixture
+def fused_service(fused_model_path, standin_model_manager):
+    """同时加载原模型和包装模型的分割服务"""
+    return SegmentationService()
+
+
+def _test_image(size, seed=0):
+    rng = np.random.RandomState(seed)
+    image = Image.fromarray((rng.rand(size[1], size[0], 3) * 255).astype(np.uint8)).filter(
+        ImageFilter.GaussianBlur(3))
+    width, height = size
+    ImageDraw.Draw(image).ellipse((width // 4, height // 4, width * 3 // 4, height * 3 // 4),
+                                  fill=(250, 250, 250))
+    return image
+
+
+def _python_path(service, image, roi=None):
+    fused_session = service.model_manager.fused_session
+    service.model_manager.fused_session = None
+    try:
+        return service.predict_mask(image, roi)
+    finally:
+        service.model_manager.fused_session = fused_session
+
+
+@pytest.mark.parametrize("size", [(300, 200), (1000, 700), (48, 40)])
+def test_fused_engine_matches_python_path(fused_service, size):
+    """测试包装模型的掩码与NumPy/PIL前后处理的结果一致(允许插值取整的差异)"""
+    image = _test_image(size)
+    fused_mask, metrics = fused_service.predict_mask(image)
+    python_mask, _ = _python_path(fused_service, image)
+
+    assert metrics["engine"] == "fused"
+    assert fused_mask.size == python_mask.size == size and fused_mask.mode == "L"
+    diff = np.abs(np.asarray(fused_mask, dtype=np.int16) - np.asarray(python_mask, dtype=np.int16))
+    assert diff.mean() < 1.0
+    assert diff.max() <= 16
+
+
+def test_fused_engine_with_roi_and_variant(fused_service):
+    """测试包装模型支持感兴趣区域，降级使用模型变体时退回Python前后处理"""
+    image = _test_image((400, 300), seed=1)
+    fused_mask, metrics = fused_service.predict_mask(image, (100, 75, 300, 225))
+    python_mask, _ = _python_path(fused_service, image, (100, 75, 300, 225))
+
+    assert metrics["roi"] == [80, 55, 320, 245]
+    assert np.asarray(fused_mask)[:55].max() == 0
+    assert np.abs(np.asarray(fused_mask, dtype=np.int16) - np.asarray(python_mask, dtype=np.int16)).mean() < 1.0
+    assert fused_service.model_manager.get_model_info()["engine"] == "fused"
+
+
+def test_missing_fused_model_falls_back(missing_fused_model_path, standin_model_manager):
+    """测试包装模型不存在时使用Python前后处理"""
+    service = SegmentationService()
+    assert not service.uses_fused_engine()
+    assert "engine" not in service.predict_mask(_test_image((64, 48)))[1]
@@ -0,0 +1,37 @@
+"""
+压测工具测试
+"""
+
+import asyncio
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.tools import loadtest
+
+
+def test_build_corpus_mixes_sizes_and_formats():
+    """测试合成语料包含不同尺寸和格式"""
+    corpus = loadtest.build_corpus(6)
+    assert len({item["size"] for item in corpus}) > 1
+    assert len({item["content_type"] for item in corpus}) == 3
+    assert all(item["data"] for item in corpus)
+
+
+def test_in_process_load_test_with_stand_in_model(monkeypatch):
+    """测试使用替身模型的进程内压测"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    monkeypatch.setattr(loadtest, "CORPUS_SIZES", [(64, 48), (96, 64)])
+
+    report = asyncio.run(loadtest.run_load_test([1, 2], 4, corpus_size=3, warmup=0))
+
+    assert [level["concurrency"] for level in report["levels"]] == [1, 2]
+    for level in report["levels"]:
+        assert level["error_rate"] == 0.0
+        assert level["status_codes"] == {"200": 4}
+        assert level["latency"]["p99"] >= level["latency"]["p50"]
+        assert "inference_time" in level["stages"]
+    assert "并发" in loadtest.format_report(report)
+    ModelManager._instance = None
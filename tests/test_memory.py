@@ -0,0 +1,108 @@
+"""
+低内存模式与峰值内存统计测试
+"""
+
+import base64
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services.segmentation import SegmentationService
+from app.utils.image_utils import decode_image
+from app.utils.memory_utils import PeakMemoryTracker
+
+
+@pytest.fixture
+def stand_in_client(monkeypatch):
+    """使用替身模型的低内存模式测试客户端"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(config, "LOW_MEMORY_MODE", True)
+    monkeypatch.setattr(config, "MEMORY_ACCOUNTING", "rss")
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+    ModelManager._instance = None
+
+
+def test_tracker_reports_peak():
+    """测试统计器报告峰值，关闭时不报告"""
+    with PeakMemoryTracker("off") as memory:
+        pass
+    assert memory.to_dict() is None
+
+    with PeakMemoryTracker("tracemalloc") as memory:
+        data = np.ones(4 * 1024 * 1024, dtype=np.uint8)
+        del data
+    report = memory.to_dict()
+    assert report["peak_rss_delta_bytes"] >= 0
+    assert report["peak_traced_bytes"] >= 4 * 1024 * 1024
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+@pytest.mark.parametrize("bg_color", [None, (255, 255, 255, 255), (20, 40, 200, 128)])
+def test_low_memory_apply_mask_matches(monkeypatch, mode, bg_color):
+    """测试低内存模式的合成与常规合成逐像素一致，仍输出RGBA"""
+    rng = np.random.RandomState(0)
+    image = Image.fromarray(rng.randint(0, 256, (60, 80, 4), dtype=np.uint8)).convert(mode)
+    mask = Image.fromarray(rng.randint(0, 256, (60, 80), dtype=np.uint8))
+    service = SegmentationService.__new__(SegmentationService)
+
+    expected = service.apply_mask(image, mask, bg_color)
+    monkeypatch.setattr(config, "LOW_MEMORY_MODE", True)
+    result = service.apply_mask(image, mask, bg_color)
+
+    assert result.mode == "RGBA"
+    assert np.array_equal(np.asarray(result), np.asarray(expected))
+
+
+def test_normalize_mask_keeps_input_unless_in_place():
+    """测试掩码标准化默认不修改传入的数组"""
+    mask = np.linspace(-1, 3, 12, dtype=np.float32).reshape(3, 4)
+    original = mask.copy()
+
+    normalized = SegmentationService._normalize_mask(mask)
+    assert np.array_equal(mask, original)
+    assert normalized.dtype == np.uint8 and normalized.min() == 0 and normalized.max() == 255
+    assert np.array_equal(SegmentationService._normalize_mask(mask, in_place=True), normalized)
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_decode_image_limits_size(monkeypatch, low_memory):
+    """测试解码时限制尺寸，低内存模式下JPEG缩小解码"""
+    monkeypatch.setattr(config, "LOW_MEMORY_MODE", low_memory)
+    buffer = io.BytesIO()
+    Image.new("RGB", (1600, 800), (120, 30, 200)).save(buffer, format="JPEG")
+
+    image = decode_image(buffer.getvalue(), max_size=(400, 400))
+
+    assert image.size == (400, 200)
+    assert decode_image(io.BytesIO(buffer.getvalue()), max_size=(2000, 2000)).size == (1600, 800)
+
+
+def test_low_memory_base64_streaming_response(stand_in_client):
+    """测试低内存模式下流式生成的JSON响应与常规响应结构一致，并包含内存统计"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (120, 90), (200, 40, 40)).save(buffer, format="PNG")
+
+    response = stand_in_client.post("/api/remove-background-base64", data={
+        "image_base64": base64.b64encode(buffer.getvalue()).decode(),
+        "bg_type": "transparent",
+        "sizes": "64",
+        "output_type": "base64",
+    })
+
+    assert response.status_code == 200
+    data = response.json()
+    assert {"result_image", "original_image", "metrics", "bg_color_info", "variants"} <= set(data)
+    assert Image.open(io.BytesIO(base64.b64decode(data["result_image"]))).size == (120, 90)
+    assert Image.open(io.BytesIO(base64.b64decode(data["variants"]["64"]))).size == (64, 48)
+    assert data["metrics"]["memory"]["peak_rss_delta_bytes"] >= 0
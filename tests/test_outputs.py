@@ -0,0 +1,103 @@
+"""
+裁剪与多尺寸输出测试
+"""
+
+import base64
+import io
+import zipfile
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageDraw
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services.segmentation import SegmentationService
+from app.utils.archive_utils import build_multipart, build_zip
+from app.utils.image_utils import make_size_variants, parse_sizes, render_outputs
+
+
+@pytest.fixture
+def stand_in_service(monkeypatch):
+    """使用替身模型的分割服务"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    yield SegmentationService()
+    ModelManager._instance = None
+
+
+def test_parse_sizes():
+    """测试尺寸参数解析、去重和校验"""
+    assert parse_sizes("") == []
+    assert parse_sizes(None) == []
+    assert parse_sizes("256, 1024,256,512") == [1024, 512, 256]
+    for invalid in ("abc", "8", "5000", ",".join(str(16 + i) for i in range(config.MAX_OUTPUT_SIZES + 1))):
+        with pytest.raises(ValueError):
+            parse_sizes(invalid)
+
+
+def test_make_size_variants_never_upscales():
+    """测试多尺寸输出保持宽高比且不放大"""
+    image = Image.new("RGBA", (400, 200), (255, 0, 0, 255))
+    variants = make_size_variants(image, [800, 200, 100])
+
+    assert variants[800].size == (400, 200)
+    assert variants[200].size == (200, 100)
+    assert variants[100].size == (100, 50)
+
+
+def test_get_crop_box(stand_in_service):
+    """测试按掩码计算主体边界框，并按图像边界截断留白"""
+    mask = np.zeros((100, 200), dtype=np.uint8)
+    mask[20:40, 50:90] = 255
+    mask_image = Image.fromarray(mask)
+
+    assert stand_in_service.get_crop_box(mask_image) == (50, 20, 90, 40)
+    assert stand_in_service.get_crop_box(mask_image, padding=30) == (20, 0, 120, 70)
+    assert stand_in_service.get_crop_box(Image.new("L", (10, 10), 0)) is None
+
+
+def test_render_outputs_crop_and_sizes(stand_in_service):
+    """测试一次推理同时得到裁剪结果和多个尺寸"""
+    image = Image.new("RGB", (600, 400), (0, 0, 0))
+    ImageDraw.Draw(image).rectangle((200, 100, 350, 300), fill=(255, 255, 255))
+
+    outputs = render_outputs(image, "transparent", None, stand_in_service,
+                             crop=True, crop_padding=0, sizes=[128, 64])
+
+    left, top, right, bottom = outputs["metrics"]["crop_box"]
+    assert outputs["result_image"].size == (right - left, bottom - top)
+    assert outputs["result_image"].width < image.width
+    assert sorted(outputs["variants"]) == [64, 128]
+    assert max(outputs["variants"][64].size) == 64
+
+
+def test_archive_builders():
+    """测试zip和multipart打包"""
+    files = [("result.png", b"png-bytes", "image/png"), ("metrics.json", b"{}", "application/json")]
+
+    archive = zipfile.ZipFile(io.BytesIO(build_zip([(name, data) for name, data, _ in files])))
+    assert archive.namelist() == ["result.png", "metrics.json"]
+    assert archive.read("result.png") == b"png-bytes"
+
+    body, content_type = build_multipart(files)
+    boundary = content_type.split("boundary=")[1]
+    assert body.count(f"--{boundary}\r\n".encode()) == 2
+    assert body.endswith(f"--{boundary}--\r\n".encode())
+    assert b'filename="metrics.json"' in body
+
+
+def test_file_output_rejects_sizes(stand_in_service):
+    """测试output_type=file不能同时指定额外尺寸"""
+    from app.main import app
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), (200, 40, 40)).save(buffer, format="PNG")
+    response = TestClient(app).post("/api/remove-background-base64", data={
+        "image_base64": base64.b64encode(buffer.getvalue()).decode(), "output_type": "file", "sizes": "16",
+    })
+    assert response.status_code == 400
+    assert "output_type=file" in response.json()["detail"]
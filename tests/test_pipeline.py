@@ -0,0 +1,160 @@
+"""
+分阶段流水线测试
+"""
+
+import base64
+import contextvars
+import io
+import threading
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services import pipeline
+from app.services.pipeline import Pipeline
+
+_request_name: "contextvars.ContextVar[str]" = contextvars.ContextVar("request_name", default="")
+
+
+@pytest.fixture
+def fresh_pipeline(monkeypatch):
+    """每个阶段一个线程、队列长度为1的新流水线"""
+    monkeypatch.setattr(config, "PIPELINE_ENABLED", True)
+    for key in ("DECODE", "PREPROCESS", "INFERENCE", "POSTPROCESS", "ENCODE"):
+        monkeypatch.setattr(config, f"PIPELINE_{key}_WORKERS", 1)
+    monkeypatch.setattr(config, "PIPELINE_QUEUE_SIZE", 1)
+    monkeypatch.setattr(Pipeline, "_instance", None)
+    instance = Pipeline()
+    yield instance
+    instance.close()
+    Pipeline._instance = None
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_stages_overlap_across_requests(fresh_pipeline):
+    """测试一个请求占用推理阶段时，其他请求的解码和编码照常执行，阶段状态反映占用情况"""
+    release = threading.Event()
+    entered = threading.Event()
+
+    def slow_inference():
+        entered.set()
+        release.wait(5)
+        return "mask"
+
+    results = {}
+    worker = _start(lambda: results.setdefault("inference", fresh_pipeline.run("inference", slow_inference)))
+    assert entered.wait(5)
+
+    assert fresh_pipeline.run("decode", lambda: "decoded") == "decoded"
+    assert fresh_pipeline.run("encode", lambda: "encoded") == "encoded"
+    stats = fresh_pipeline.get_stats()["stages"]
+    assert stats["inference"]["busy"] == 1 and stats["decode"]["busy"] == 0
+    assert stats["decode"]["items"] == 1
+
+    release.set()
+    worker.join(5)
+    assert results["inference"] == "mask"
+    assert fresh_pipeline.get_stats()["stages"]["inference"]["busy_seconds"] > 0
+
+
+def test_full_queue_blocks_upstream(fresh_pipeline):
+    """测试阶段线程忙碌且队列已满时，新的提交阻塞直到有空位"""
+    release = threading.Event()
+    entered = threading.Event()
+
+    def blocked():
+        entered.set()
+        release.wait(5)
+
+    first = _start(fresh_pipeline.run, "encode", blocked)
+    assert entered.wait(5)
+    queued = _start(fresh_pipeline.run, "encode", lambda: None)
+    while fresh_pipeline.get_stats()["stages"]["encode"]["queue_length"] < 1:
+        threading.Event().wait(0.01)
+    blocked_submit = _start(fresh_pipeline.run, "encode", lambda: None)
+
+    blocked_submit.join(0.2)
+    assert blocked_submit.is_alive()
+    assert fresh_pipeline.get_stats()["stages"]["encode"]["queue_length"] == 1
+
+    release.set()
+    for thread in (first, queued, blocked_submit):
+        thread.join(5)
+        assert not thread.is_alive()
+
+
+def test_context_errors_and_timings(fresh_pipeline):
+    """测试阶段任务看到调用方的上下文、异常原样抛出，并记录请求在各阶段的耗时"""
+    _request_name.set("request-1")
+    with pipeline.track_request() as timings:
+        assert pipeline.stage("preprocess", _request_name.get) == "request-1"
+        with pytest.raises(ValueError, match="bad"):
+            pipeline.stage("decode", lambda: (_ for _ in ()).throw(ValueError("bad")))
+
+    assert set(timings) == {"preprocess", "decode"}
+    assert timings["preprocess"]["run_time"] >= 0
+    assert pipeline.total_queue_wait(timings) >= 0
+
+
+def test_inference_output_is_copied():
+    """测试推理阶段交出的掩码不是推理线程复用的缓冲区"""
+    buffer = np.zeros((1, 1, 4, 4), dtype=np.float32)
+
+    class ReusingService:
+        def infer(self, tensor):
+            buffer[:] = tensor.mean()
+            return buffer, 0.0
+
+    first, _ = pipeline._infer(ReusingService(), np.full((1, 3, 4, 4), 1.0, dtype=np.float32))
+    pipeline._infer(ReusingService(), np.full((1, 3, 4, 4), 2.0, dtype=np.float32))
+    assert np.all(first == 1.0)
+
+
+@pytest.fixture
+def stand_in_client(monkeypatch):
+    """使用替身模型的测试客户端"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+    ModelManager._instance = None
+
+
+def _post_base64(client):
+    buffer = io.BytesIO()
+    image = Image.new("RGB", (160, 120), (200, 40, 40))
+    image.paste((20, 200, 40), (40, 30, 120, 90))
+    image.save(buffer, format="PNG")
+    return client.post("/api/remove-background-base64", data={
+        "image_base64": base64.b64encode(buffer.getvalue()).decode(),
+        "output_type": "base64", "bg_type": "color", "bg_color": "#FFFFFF", "sizes": "64",
+    })
+
+
+def test_pipelined_route_matches_sequential(stand_in_client, fresh_pipeline, monkeypatch):
+    """测试经流水线处理的结果与顺序处理一致，并报告各阶段的耗时和状态"""
+    piped = _post_base64(stand_in_client)
+    monkeypatch.setattr(config, "PIPELINE_ENABLED", False)
+    sequential = _post_base64(stand_in_client)
+
+    assert piped.status_code == sequential.status_code == 200
+    assert piped.json()["result_image"] == sequential.json()["result_image"]
+    assert piped.json()["variants"] == sequential.json()["variants"]
+    assert set(piped.json()["metrics"]["pipeline"]) == set(pipeline.STAGES)
+    assert "pipeline" not in sequential.json()["metrics"]
+
+    stats = stand_in_client.get("/api/pipeline").json()
+    assert all(stats["stages"][name]["items"] >= 1 for name in pipeline.STAGES)
@@ -0,0 +1,99 @@
+"""
+在线性能分析测试
+"""
+
+import json
+import pstats
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import config
+from app.utils import profiling
+from app.utils.profiling import Capture, CaptureBusy
+
+
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+@profiling.profiled("/api/test")
+def handle_test(seconds):
+    _spin(seconds)
+
+
+@profiling.profiled("/api/other")
+def handle_other(seconds):
+    _spin(seconds)
+
+
+def test_sampling_groups_stacks_by_route():
+    """测试采样结果以路由开头，包含处理函数的调用栈，且同一时间只允许一个采集"""
+    capture = Capture("sample", 0.002)
+    capture.start()
+    try:
+        with pytest.raises(CaptureBusy):
+            Capture("sample", 0.002).start()
+        worker = threading.Thread(target=handle_test, args=(0.3,))
+        worker.start()
+        worker.join()
+    finally:
+        capture.stop()
+
+    lines = capture.collapsed().splitlines()
+    assert any(line.startswith("/api/test;") and "test_profiling.handle_test;" in line for line in lines)
+    assert capture.summary()["routes"]["/api/test"] > 0
+    assert profiling.current() is None
+    assert not profiling._thread_routes
+
+
+def test_cprofile_filters_by_route(tmp_path):
+    """测试cProfile只分析指定路由的调用，结果可以用pstats读取"""
+    capture = Capture("cprofile", 0.0, route="/api/test")
+    capture.start()
+    try:
+        handle_test(0.05)
+        handle_other(0.05)
+    finally:
+        capture.stop()
+
+    path = tmp_path / "profile.pstats"
+    path.write_bytes(capture.pstats_bytes())
+    functions = {name for _, _, name in pstats.Stats(str(path)).stats}
+    assert "_spin" in functions and "handle_test" in functions
+    assert "handle_other" not in functions
+    assert capture.summary()["profiled_calls"] == 1
+
+    # 没有采集时直接执行
+    handle_test(0.0)
+    assert capture.summary()["profiled_calls"] == 1
+
+
+def test_profile_endpoint_requires_token(monkeypatch):
+    """测试接口需要令牌，采集期间的路由调用出现在结果中"""
+    from app.main import app
+    client = TestClient(app)
+
+    monkeypatch.setattr(config, "DEBUG_TOKEN", "")
+    assert client.post("/api/debug/profile?seconds=0.1").status_code == 404
+
+    monkeypatch.setattr(config, "DEBUG_TOKEN", "secret")
+    assert client.post("/api/debug/profile?seconds=0.1").status_code == 401
+    assert client.post("/api/debug/profile?seconds=0.1", headers={"X-Debug-Token": "wrong"}).status_code == 401
+    assert client.post(f"/api/debug/profile?seconds={config.PROFILE_MAX_SECONDS + 1}",
+                       headers={"X-Debug-Token": "secret"}).status_code == 400
+
+    worker = threading.Thread(target=lambda: (time.sleep(0.05), handle_test(0.2)))
+    worker.start()
+    response = client.post("/api/debug/profile?seconds=0.4&interval_ms=2",
+                           headers={"Authorization": "Bearer secret"})
+    worker.join()
+
+    assert response.status_code == 200
+    assert response.headers["content-disposition"].endswith('.folded"')
+    assert json.loads(response.headers["x-profile-summary"])["routes"]["/api/test"] > 0
+    assert "/api/test;" in response.text
@@ -0,0 +1,166 @@
+"""
+渐进式返回测试
+"""
+
+import asyncio
+import base64
+import io
+import json
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services import progressive
+from app.services.degradation import RequestCancelled
+from app.services.segmentation import SegmentationService
+
+
+@pytest.fixture
+def stand_in_client(monkeypatch):
+    """使用替身模型的测试客户端"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(config, "PREVIEW_MAX_SIZE", 100)
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+    ModelManager._instance = None
+
+
+def _parse_events(text):
+    """把text/event-stream响应体解析为(事件名, 数据)列表"""
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def _post_stream(client, size=(400, 300)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 40)).save(buffer, format="PNG")
+    return client.post("/api/remove-background-stream",
+                       files={"file": ("test.png", buffer.getvalue(), "image/png")},
+                       data={"bg_type": "transparent"})
+
+
+def test_stream_sends_preview_then_final(stand_in_client):
+    """测试先推送缩小的预览，再推送完整分辨率的结果"""
+    response = _post_stream(stand_in_client)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _parse_events(response.text)
+    assert [name for name, _ in events] == ["preview", "final"]
+
+    preview, final = events[0][1], events[1][1]
+    assert preview["size"] == [100, 75]
+    assert Image.open(io.BytesIO(base64.b64decode(preview["image"]))).size == (100, 75)
+    assert preview["metrics"]["stage"] == "preview"
+    assert final["size"] == [400, 300]
+    assert final["metrics"]["stage"] == "final"
+    assert final["metrics"]["elapsed"] >= preview["metrics"]["elapsed"]
+
+
+def test_stream_rejects_undecodable_image(stand_in_client):
+    """测试无法解码的图片在开始推送事件之前返回400"""
+    response = stand_in_client.post("/api/remove-background-stream",
+                                    files={"file": ("test.png", b"not an image", "image/png")})
+    assert response.status_code == 400
+
+
+def test_fixed_input_final_reuses_preview_mask(stand_in_client, monkeypatch):
+    """测试模型输入尺寸固定时最终阶段复用预览阶段的掩码，取消时跳过最终阶段"""
+    service = SegmentationService()
+    monkeypatch.setattr(service, "degradation_support", lambda: {"dynamic_input": False, "model_variants": []})
+    image = Image.new("RGB", (200, 150), (10, 120, 30))
+
+    event, prediction = progressive.render_preview(image, "transparent", "#00000000", service)
+    assert prediction is not None and prediction[0].size == (200, 150)
+    final = progressive.render_final(image, "transparent", "#00000000", service, prediction=prediction)
+    assert final["metrics"]["reused_preview_mask"] is True
+    assert final["size"] == [200, 150]
+
+    skipped = progressive._stages.get(stage="final", outcome="skipped")
+    with pytest.raises(RequestCancelled):
+        progressive.render_final(image, "transparent", "#00000000", service, is_cancelled=lambda: True)
+    assert progressive._stages.get(stage="final", outcome="skipped") == skipped + 1
+
+
+def test_disconnect_after_preview_skips_final_inference(stand_in_client, monkeypatch):
+    """测试客户端看到预览后断开时，经Starlette的断开处理取消响应，最终阶段不再推理"""
+    from app.api import routes
+    from app.main import app
+
+    predicted = []
+    predict_mask = SegmentationService.predict_mask
+
+    def recording_predict_mask(self, image, roi=None):
+        predicted.append(image.size)
+        return predict_mask(self, image, roi)
+
+    monkeypatch.setattr(SegmentationService, "predict_mask", recording_predict_mask)
+
+    # 断开消息送达后再开始最终阶段，此时Starlette已经取消了响应任务
+    disconnected = threading.Event()
+    render_final = routes._render_final
+
+    def delayed_render_final(*args):
+        disconnected.wait(5)
+        time.sleep(0.1)
+        return render_final(*args)
+
+    monkeypatch.setattr(routes, "_render_final", delayed_render_final)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (400, 300), (200, 40, 40)).save(buffer, format="PNG")
+    boundary = "rmbg-test-boundary"
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="test.png"\r\n'
+            f"Content-Type: image/png\r\n\r\n").encode() + buffer.getvalue() + f"\r\n--{boundary}--\r\n".encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/api/remove-background-stream",
+        "raw_path": b"/api/remove-background-stream", "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"testserver"), (b"content-length", str(len(body)).encode()),
+                    (b"content-type", f"multipart/form-data; boundary={boundary}".encode())],
+        "client": ("testclient", 50000), "server": ("testserver", 80),
+    }
+    sent = []
+
+    async def run():
+        preview_sent = asyncio.Event()
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await preview_sent.wait()
+            if not disconnected.is_set():
+                disconnected.set()
+                return {"type": "http.disconnect"}
+            # 断开消息只送达一次
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+            if b"event: preview" in message.get("body", b""):
+                preview_sent.set()
+
+        await app(scope, receive, send)
+
+    skipped = progressive._stages.get(stage="final", outcome="skipped")
+    asyncio.run(run())
+
+    body_sent = b"".join(message.get("body", b"") for message in sent)
+    assert b"event: preview" in body_sent and b"event: final" not in body_sent
+    # 只有预览阶段推理过
+    assert predicted == [(100, 75)]
+    assert progressive._stages.get(stage="final", outcome="skipped") == skipped + 1
@@ -0,0 +1,267 @@
+"""
+TCP推理服务与负载均衡客户端测试
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import config
+from app.models import remote
+from app.models.batching import BatchQueue, PendingWork
+from app.models.remote import RemoteInferenceClient, RemoteInferenceServer
+from app.services.segmentation import SegmentationService
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fake_run_batch(batch, variant=None):
+    """模拟模型：掩码为各通道均值，量化变体取反以便区分"""
+    mask = batch.mean(axis=1, keepdims=True)
+    return -mask if variant == "quantized" else mask
+
+
+def _use_backends(monkeypatch, addresses, **settings):
+    monkeypatch.setattr(config, "REMOTE_BACKENDS", addresses)
+    monkeypatch.setattr(config, "REMOTE_RETRY_S", 60.0)
+    for key, value in settings.items():
+        monkeypatch.setattr(config, key, value)
+    monkeypatch.setattr(RemoteInferenceClient, "_instance", None)
+    return RemoteInferenceClient()
+
+
+@pytest.fixture
+def remote_server():
+    """在后台线程中启动TCP推理服务"""
+    calls = []
+
+    def run_batch(batch, variant):
+        calls.append(batch.shape[0])
+        return fake_run_batch(batch, variant)
+
+    server = RemoteInferenceServer(("127.0.0.1", 0), run_batch, max_batch=4, batch_wait=0.02,
+                                   model_info=lambda: {"status": "loaded", "input_size": [32, 24]})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{server.server_address[1]}", calls
+    server.shutdown()
+    server.server_close()
+
+
+def test_remote_round_trip(remote_server, monkeypatch):
+    """测试张量经TCP往返后结果正确，模型变体和float16传输生效"""
+    address, _ = remote_server
+    client = _use_backends(monkeypatch, [address])
+    batch = np.random.rand(2, 3, 24, 32).astype(np.float32)
+
+    output = client.run(batch)
+    assert output.shape == (2, 1, 24, 32) and output.dtype == np.float32
+    np.testing.assert_allclose(output, fake_run_batch(batch), rtol=1e-6)
+    np.testing.assert_allclose(client.run(batch, "quantized"), fake_run_batch(batch, "quantized"), rtol=1e-6)
+    assert client.get_input_size() == [32, 24]
+    assert client.get_model_info()["backends"][0]["healthy"] is True
+
+    client = _use_backends(monkeypatch, [address], REMOTE_TENSOR_DTYPE="float16")
+    np.testing.assert_allclose(client.run(batch), fake_run_batch(batch), atol=1e-3)
+
+
+def test_remote_concurrent_requests_are_batched(remote_server, monkeypatch):
+    """测试并发请求各自拿到自己的掩码，并在服务端合并成批次"""
+    address, calls = remote_server
+    client = _use_backends(monkeypatch, [address])
+    inputs = [np.full((1, 3, 24, 32), i, dtype=np.float32) for i in range(8)]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(client.run, inputs))
+
+    for i, output in enumerate(outputs):
+        assert np.all(output == i)
+    assert sum(calls) == 8
+    assert max(calls) > 1
+
+
+def test_remote_fails_over_to_healthy_backend(remote_server, monkeypatch):
+    """测试连接失败的服务被摘除，请求改发到健康的服务"""
+    address, _ = remote_server
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        dead = f"127.0.0.1:{sock.getsockname()[1]}"
+    client = _use_backends(monkeypatch, [dead, address])
+
+    for _ in range(4):
+        assert client.run(np.ones((1, 3, 24, 32), dtype=np.float32)).shape == (1, 1, 24, 32)
+
+    # 摘除期间不再尝试连接失败的服务
+    dead_stats, live_stats = (backend.get_stats() for backend in client.backends)
+    assert dead_stats["healthy"] is False and dead_stats["failures"] == 1
+    assert live_stats["healthy"] is True
+    assert remote._requests.get(backend=dead, outcome="ok") == 0
+
+
+def test_model_info_reports_cached_health(remote_server, monkeypatch):
+    """测试模型信息接口报告记录的健康状态，不再连接已摘除或正常的服务"""
+    address, _ = remote_server
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        dead = f"127.0.0.1:{sock.getsockname()[1]}"
+    client = _use_backends(monkeypatch, [dead, address])
+    client.run(np.ones((1, 3, 24, 32), dtype=np.float32))
+    client.get_model_info()
+
+    calls = []
+    original_call = remote.RemoteBackend.call
+
+    def counting_call(backend, *args, **kwargs):
+        calls.append(backend.address)
+        return original_call(backend, *args, **kwargs)
+
+    monkeypatch.setattr(remote.RemoteBackend, "call", counting_call)
+    for _ in range(3):
+        info = client.get_model_info()
+    assert calls == []
+    assert info["input_size"] == [32, 24]
+    assert [stats["healthy"] for stats in info["backends"]] == [False, True]
+
+
+def test_remote_timeouts_mark_down_only_when_repeated(remote_server, monkeypatch):
+    """测试读写超时不改发到其他服务，单次超时不摘除，连续超时达到上限才摘除，成功后清零"""
+    fast_address, fast_calls = remote_server
+    slow = threading.Event()
+
+    def run_batch(batch, variant):
+        if slow.is_set():
+            time.sleep(0.5)
+        return fake_run_batch(batch, variant)
+
+    server = RemoteInferenceServer(("127.0.0.1", 0), run_batch, max_batch=1, batch_wait=0.0,
+                                   model_info=lambda: {"status": "loaded", "input_size": [32, 24]})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = _use_backends(monkeypatch, [f"127.0.0.1:{server.server_address[1]}", fast_address],
+                               REMOTE_TIMEOUT_S=0.2, REMOTE_MAX_TIMEOUTS=2)
+        backend, fast = client.backends
+        # 让请求总是先选中慢的服务
+        fast.server_active = 100
+        batch = np.ones((1, 3, 24, 32), dtype=np.float32)
+
+        slow.set()
+        start = time.monotonic()
+        with pytest.raises(socket.timeout):
+            client.run(batch)
+        assert time.monotonic() - start < 0.4
+        assert fast_calls == []
+        assert backend.get_stats()["healthy"] is True and backend.get_stats()["timeouts"] == 1
+
+        # 超时后恢复正常，计数清零；先等服务端处理完超时的请求
+        slow.clear()
+        time.sleep(0.4)
+        assert client.run(batch).shape == (1, 1, 24, 32)
+        assert backend.get_stats()["timeouts"] == 0
+        fast.server_active = 100
+
+        slow.set()
+        for _ in range(2):
+            with pytest.raises(socket.timeout):
+                client.run(batch)
+        stats = backend.get_stats()
+        assert stats["healthy"] is False and stats["failures"] == 1 and stats["timeouts"] == 2
+        assert fast_calls == []
+        # 摘除后请求发往另一个服务
+        assert client.run(batch).shape == (1, 1, 24, 32)
+        assert fast_calls == [1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batch_queue_keeps_arrival_order():
+    """测试放不下的请求作为下一批的开头，不会排到后到的请求之后"""
+    release = threading.Event()
+    batches = []
+
+    def run_batch(batch):
+        if batch[0].key == "block":
+            release.wait(5)
+        batches.append([pending.name for pending in batch])
+
+    batch_queue = BatchQueue(run_batch, max_batch=4, batch_wait=0.05)
+    try:
+        blocker = PendingWork("block")
+        batch_queue.submit(blocker)
+        items = []
+        for name, key in (("a1", "a"), ("b1", "b"), ("a2", "a")):
+            pending = PendingWork(key)
+            pending.name = name
+            items.append(pending)
+            batch_queue.submit(pending)
+        blocker.name = "block"
+        release.set()
+        for pending in items:
+            assert pending.done.wait(5)
+    finally:
+        batch_queue.close()
+
+    assert batches[1:] == [["a1"], ["b1"], ["a2"]]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server_process(port: int) -> subprocess.Popen:
+    """以替身模型启动一个独立的推理服务进程，等待端口可以连接"""
+    env = dict(os.environ, MODEL_STAND_IN="true", MODEL_STAND_IN_DELAY_MS="20", MODEL_INPUT_SIZE="64,64",
+               PYTHONPATH=ROOT_DIR)
+    process = subprocess.Popen([sys.executable, "-m", "app.models.remote", "--host", "127.0.0.1",
+                                "--port", str(port)], cwd=ROOT_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("推理服务进程没有启动")
+
+
+def test_load_balancing_across_processes(monkeypatch):
+    """测试分割服务通过多个推理服务进程推理，请求分散到各进程，一个进程退出后由其余进程处理"""
+    ports = [_free_port(), _free_port()]
+    processes = [_start_server_process(port) for port in ports]
+    try:
+        addresses = [f"127.0.0.1:{port}" for port in ports]
+        _use_backends(monkeypatch, addresses, INFERENCE_BACKEND="remote")
+        service = SegmentationService()
+        assert service.model_manager is None
+        assert service.get_input_size() == [64, 64]
+        assert service.degradation_support()["model_variants"] == ["quantized"]
+
+        served = [remote._requests.get(backend=address, outcome="ok") for address in addresses]
+        image = Image.new("RGB", (120, 90), (200, 40, 40))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            masks = list(executor.map(lambda _: service.predict_mask(image)[0], range(16)))
+        assert all(mask.size == (120, 90) for mask in masks)
+        for address, before in zip(addresses, served):
+            assert remote._requests.get(backend=address, outcome="ok") > before
+
+        processes[0].terminate()
+        processes[0].wait(timeout=10)
+        for _ in range(4):
+            assert service.predict_mask(image)[0].size == (120, 90)
+        assert service.backend.get_model_info()["backends"][0]["healthy"] is False
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait(timeout=10)
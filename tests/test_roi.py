@@ -0,0 +1,103 @@
+"""
+感兴趣区域推理测试
+"""
+
+import base64
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageDraw
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.services.segmentation import SegmentationService
+from app.utils.image_utils import decode_image, parse_roi, render_outputs, scale_roi
+
+
+@pytest.fixture
+def stand_in_service(monkeypatch):
+    """使用替身模型的分割服务"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(config, "ROI_PADDING", 0.1)
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    yield SegmentationService()
+    ModelManager._instance = None
+
+
+def _scene():
+    """黑色背景上的主体和远处的干扰物"""
+    image = Image.new("RGB", (600, 400), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 100, 199, 199), fill=(255, 255, 255))
+    draw.rectangle((480, 280, 559, 359), fill=(255, 255, 255))
+    return image
+
+
+def test_parse_and_scale_roi():
+    """测试边界框解析、校验和按解码缩放换算"""
+    assert parse_roi("") is None
+    assert parse_roi(" 10, 20,110,220 ") == (10, 20, 110, 220)
+    for invalid in ("1,2,3", "a,b,c,d", "10,10,5,20", "-1,0,10,10"):
+        with pytest.raises(ValueError):
+            parse_roi(invalid)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (800, 400)).save(buffer, format="PNG")
+    image = decode_image(buffer, max_size=(400, 400))
+    assert scale_roi((100, 50, 301, 201), image) == (50, 25, 151, 101)
+
+
+def test_roi_masks_outside_as_background(stand_in_service):
+    """测试只对扩展后的区域推理，区域外的干扰物被当作背景"""
+    image = _scene()
+    mask, metrics = stand_in_service.predict_mask(image, (100, 100, 200, 200))
+    mask = np.array(mask)
+
+    assert metrics["roi"] == [90, 90, 210, 210]
+    assert mask.shape == (400, 600)
+    assert mask[150, 150] > 128
+    assert mask[:90].max() == 0 and mask[:, 210:].max() == 0
+    # 不给边界框时干扰物同样被识别为前景
+    assert np.array(stand_in_service.predict_mask(image)[0])[320, 520] > 128
+
+    # 边界框区域用满模型输入分辨率
+    tensor, _ = stand_in_service.prepare_input(image, (90, 90, 210, 210))
+    expected, _ = stand_in_service.prepare_input(image.crop((90, 90, 210, 210)))
+    np.testing.assert_array_equal(tensor, expected)
+
+    with pytest.raises(ValueError):
+        stand_in_service.expand_roi((700, 500, 800, 600), image.size)
+
+
+def test_render_outputs_with_roi(stand_in_service):
+    """测试边界框与裁剪到主体同时使用"""
+    outputs = render_outputs(_scene(), "transparent", None, stand_in_service,
+                             crop=True, roi=(100, 100, 200, 200))
+
+    left, top, right, bottom = outputs["metrics"]["crop_box"]
+    assert 90 <= left and 90 <= top and right <= 210 and bottom <= 210
+
+
+def test_roi_route_validation(stand_in_service):
+    """测试接口接受边界框，格式无效或超出图像时返回400"""
+    from app.main import app
+    buffer = io.BytesIO()
+    _scene().save(buffer, format="PNG")
+    image_base64 = base64.b64encode(buffer.getvalue()).decode()
+
+    with TestClient(app) as client:
+        def post(roi):
+            return client.post("/api/remove-background-base64", data={
+                "image_base64": image_base64, "output_type": "base64", "roi": roi,
+            })
+
+        response = post("100,100,200,200")
+        assert response.status_code == 200
+        assert response.json()["metrics"]["roi"] == [90, 90, 210, 210]
+        assert post("100,100,50,200").status_code == 400
+        assert post("600,0,700,100").status_code == 400
@@ -0,0 +1,105 @@
+"""
+共享内存推理通道测试
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from app import config
+from app.models.shared_memory import InferenceServer, SharedMemoryClient
+
+INPUT_SIZE = [32, 24]  # 宽度, 高度
+
+
+def fake_run_batch(batch: np.ndarray) -> np.ndarray:
+    """模拟模型：掩码为各通道均值"""
+    return batch.mean(axis=1, keepdims=True)
+
+
+@pytest.fixture
+def shm_server(tmp_path, monkeypatch):
+    """在后台线程中启动共享内存推理服务"""
+    socket_path = str(tmp_path / "inference.sock")
+    calls = []
+
+    def run_batch(batch):
+        calls.append(batch.shape[0])
+        return fake_run_batch(batch)
+
+    server = InferenceServer(socket_path, run_batch, INPUT_SIZE, slots=4, max_batch=4, batch_wait=0.02)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(config, "SHM_SOCKET_PATH", socket_path)
+    monkeypatch.setattr(config, "SHM_CLIENT_CONNECTIONS", 4)
+    monkeypatch.setattr(SharedMemoryClient, "_instance", None)
+    client = SharedMemoryClient()
+
+    yield client, calls
+
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_shared_memory_round_trip(shm_server):
+    """测试张量经共享内存往返后结果正确"""
+    client, _ = shm_server
+    batch = np.random.rand(1, 3, 24, 32).astype(np.float32)
+
+    output = client.run(batch)
+
+    assert output.shape == (1, 1, 24, 32)
+    np.testing.assert_allclose(output, fake_run_batch(batch), rtol=1e-6)
+    assert client.get_input_size() == INPUT_SIZE
+    assert client.get_model_info()["backend"] == "shm"
+
+
+def test_shared_memory_concurrent_requests_are_batched(shm_server):
+    """测试并发请求各自拿到自己的掩码，并被合并成批次"""
+    client, calls = shm_server
+    inputs = [np.full((1, 3, 24, 32), i, dtype=np.float32) for i in range(8)]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(client.run, inputs))
+
+    for i, output in enumerate(outputs):
+        assert np.all(output == i)
+    assert sum(calls) == 8
+    assert max(calls) > 1
+
+
+def test_shared_memory_rejects_oversized_tensor(shm_server):
+    """测试超出槽位容量的张量被拒绝"""
+    client, _ = shm_server
+    with pytest.raises(ValueError):
+        client.run(np.zeros((1, 3, 48, 32), dtype=np.float32))
+
+
+def test_broken_connection_frees_slot_for_waiters(shm_server, monkeypatch):
+    """测试连接断开后等待中的请求能拿到新连接，连接用尽时等待超时"""
+    client, _ = shm_server
+    client.close()
+    monkeypatch.setattr(config, "SHM_CLIENT_CONNECTIONS", 1)
+    monkeypatch.setattr(config, "SHM_ACQUIRE_TIMEOUT_S", 0.1)
+    monkeypatch.setattr(SharedMemoryClient, "_instance", None)
+    client = SharedMemoryClient()
+
+    conn = client._acquire()
+    with pytest.raises(RuntimeError, match="超时"):
+        client._acquire()
+
+    client.acquire_timeout = 5
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(client._acquire()))
+    waiter.start()
+    client._release(conn, broken=True)
+    waiter.join(5)
+
+    assert acquired and acquired[0] is not conn
+    client._release(acquired[0])
+    client.close()
+
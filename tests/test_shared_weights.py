@@ -0,0 +1,90 @@
+"""
+共享权重测试
+"""
+
+import os
+
+import numpy as np
+import onnxruntime as ort
+import pytest
+
+from app import config
+from app.models import model_manager as model_manager_module
+from app.models.shared_weights import SharedWeights, export_shared_weights, has_shared_weights
+from app.utils.memory_utils import read_process_memory
+
+
+def test_shared_weights_match_original_model(standin_model_path):
+    """测试使用共享权重的会话与原模型输出一致"""
+    paths = export_shared_weights(standin_model_path)
+    assert has_shared_weights(standin_model_path)
+    assert os.path.getsize(paths["data"]) > 0
+
+    shared = SharedWeights(standin_model_path)
+    options = ort.SessionOptions()
+    shared.apply(options)
+    shared_session = ort.InferenceSession(shared.model_path, sess_options=options,
+                                         disabled_optimizers=shared.disabled_optimizers)
+    original_session = ort.InferenceSession(standin_model_path)
+
+    batch = np.random.rand(1, 3, 32, 32).astype(np.float32)
+    expected = original_session.run(None, {"input": batch})[0]
+    actual = shared_session.run(None, {"input": batch})[0]
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_session_uses_mapped_weights(standin_model_path):
+    """测试会话的权重来自内存映射：映射页面常驻，不注册共享权重时模型只能读到占位的0"""
+    export_shared_weights(standin_model_path)
+    shared = SharedWeights(standin_model_path)
+    batch = np.random.rand(1, 3, 32, 32).astype(np.float32)
+    expected = ort.InferenceSession(standin_model_path).run(None, {"input": batch})[0]
+
+    options = ort.SessionOptions()
+    shared.apply(options)
+    session = ort.InferenceSession(shared.model_path, sess_options=options,
+                                   disabled_optimizers=shared.disabled_optimizers)
+    np.testing.assert_allclose(session.run(None, {"input": batch})[0], expected, rtol=1e-5, atol=1e-6)
+    assert read_process_memory(os.getpid(), ".shared.bin")["mapping_rss"] > 0
+
+    placeholder_only = ort.InferenceSession(shared.model_path, disabled_optimizers=shared.disabled_optimizers)
+    assert not np.allclose(placeholder_only.run(None, {"input": batch})[0], expected, atol=1e-3)
+
+
+@pytest.fixture
+def shared_model_manager(standin_model_path, monkeypatch, request):
+    """使用共享权重加载替身模型的ModelManager"""
+    export_shared_weights(standin_model_path)
+    monkeypatch.setattr(config, "MODEL_SHARED_WEIGHTS", True)
+    return request.getfixturevalue("standin_model_manager")
+
+
+def test_profiled_session_uses_shared_weights(shared_model_manager, monkeypatch):
+    """测试分析会话与主模型一样使用共享权重，同一时间只创建一个"""
+    manager = shared_model_manager
+    assert manager.shared_weights is not None
+    created = []
+    original_session = ort.InferenceSession
+
+    def recording_session(path, *args, **kwargs):
+        created.append((path, kwargs.get("disabled_optimizers")))
+        return original_session(path, *args, **kwargs)
+
+    monkeypatch.setattr(model_manager_module.ort, "InferenceSession", recording_session)
+    batch = np.random.rand(1, 3, 64, 64).astype(np.float32)
+    output, events = manager.run_profiled(batch)
+    np.testing.assert_allclose(output, manager.run(batch), rtol=1e-5, atol=1e-6)
+    assert any(event.get("cat") == "Node" for event in events)
+    assert created == [(manager.shared_weights.model_path, manager.shared_weights.disabled_optimizers)]
+
+    # 已有抽样请求在分析时，其他请求直接用主模型会话推理
+    with manager._profiling_lock:
+        output, events = manager.run_profiled(batch)
+    assert events == [] and len(created) == 1
+
+
+def test_read_process_memory():
+    """测试读取当前进程的内存统计"""
+    report = read_process_memory(os.getpid())
+    assert report["rss"] > 0
+    assert report["unique"] + report["shared"] <= report["rss"] + 4096
@@ -0,0 +1,100 @@
+"""
+流式编码测试
+"""
+
+import base64
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageFilter
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.utils import stream_encoder
+from app.utils.stream_encoder import iter_base64, iter_png
+
+
+def _test_image(width, height, mode="RGBA", seed=0):
+    rng = np.random.RandomState(seed)
+    image = Image.fromarray((rng.rand(height, width, 4) * 255).astype(np.uint8), "RGBA")
+    return image.filter(ImageFilter.GaussianBlur(2)).convert(mode)
+
+
+@pytest.mark.parametrize("mode", ["RGBA", "RGB", "LA", "L", "P"])
+def test_png_round_trip(mode):
+    """测试按行带编码的PNG解码后与原图一致，不支持的模式转换为RGB"""
+    image = _test_image(97, 61, mode)
+    decoded = Image.open(io.BytesIO(b"".join(iter_png(image, band_bytes=1000))))
+    decoded.load()
+    expected = image.convert("RGB") if mode == "P" else image
+    assert decoded.mode == expected.mode
+    assert np.array_equal(np.asarray(decoded), np.asarray(expected))
+
+
+def test_chunk_size_independent_of_height():
+    """测试每块的大小由行带大小决定，不随图像高度增长；Base64逐块编码与整体编码相同"""
+    band_bytes = 16 * 1024
+    short = list(iter_png(_test_image(128, 64), band_bytes=band_bytes))
+    tall = list(iter_png(_test_image(128, 2048), band_bytes=band_bytes))
+
+    assert len(tall) > len(short) * 20
+    assert max(map(len, tall)) <= band_bytes * 1.1 + 1024
+    assert b"".join(iter_base64(tall)) == base64.b64encode(b"".join(tall))
+
+
+@pytest.fixture
+def stand_in_client(monkeypatch):
+    """使用替身模型的测试客户端"""
+    monkeypatch.setattr(config, "MODEL_STAND_IN", True)
+    monkeypatch.setattr(config, "MODEL_STAND_IN_DELAY_MS", 0.0)
+    monkeypatch.setattr(config, "MODEL_INPUT_SIZE_LIST", [64, 64])
+    monkeypatch.setattr(config, "INFERENCE_BACKEND", "local")
+    monkeypatch.setattr(config, "STREAM_BAND_BYTES", 4096)
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    from app.main import app
+    with TestClient(app) as client:
+        yield client
+    ModelManager._instance = None
+
+
+def _post(client, **data):
+    buffer = io.BytesIO()
+    _test_image(160, 120, "RGB").save(buffer, format="PNG")
+    return client.post("/api/remove-background-base64", data={
+        "image_base64": base64.b64encode(buffer.getvalue()).decode(), "bg_type": "transparent", **data,
+    })
+
+
+def _pixels(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image.format, np.asarray(image)
+
+
+def test_streamed_responses_match_buffered(stand_in_client, monkeypatch):
+    """测试流式编码的文件和JSON响应与整体编码的像素一致，JSON响应报告首字节时间和传输时间"""
+    buffered_file = _post(stand_in_client, output_type="file")
+    buffered_json = _post(stand_in_client, output_type="base64")
+    monkeypatch.setattr(config, "STREAM_ENCODING", True)
+    responses = stream_encoder._responses.get(format="png")
+    streamed_file = _post(stand_in_client, output_type="file")
+    streamed_json = _post(stand_in_client, output_type="base64")
+
+    assert streamed_file.status_code == streamed_json.status_code == 200
+    assert streamed_file.headers["content-type"] == "image/png"
+    assert np.array_equal(_pixels(streamed_file.content)[1], _pixels(buffered_file.content)[1])
+    assert stream_encoder._responses.get(format="png") == responses + 1
+
+    body = streamed_json.json()
+    for key in ("result_image", "original_image"):
+        assert np.array_equal(_pixels(base64.b64decode(body[key]))[1],
+                              _pixels(base64.b64decode(buffered_json.json()[key]))[1])
+    stream = body["metrics"]["stream"]
+    assert 0 <= stream["ttfb"] and stream["transfer_time"] >= 0 and stream["bytes"] > 0
+    assert "stream" not in buffered_json.json()["metrics"]
+
+    webp = _post(stand_in_client, output_type="file", output_format="webp")
+    assert webp.headers["content-type"] == "image/webp"
+    assert _pixels(webp.content)[0] == "WEBP"
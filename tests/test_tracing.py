@@ -0,0 +1,88 @@
+"""
+请求追踪测试
+"""
+
+from app.utils import tracing
+from app.utils.tracing import TraceStore, parse_traceparent
+
+
+def test_parse_traceparent():
+    """测试W3C traceparent解析"""
+    header = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    assert parse_traceparent(header) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331")
+    assert parse_traceparent("invalid") is None
+    assert parse_traceparent("00-" + "0" * 32 + "-b7ad6b7169203331-01") is None
+    assert parse_traceparent(None) is None
+
+
+def test_spans_are_nested_and_propagated():
+    """测试span嵌套关系和追踪ID继承"""
+    header = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    root, token = tracing.start_trace("request", header)
+    with tracing.span("segment_image") as outer:
+        with tracing.span("inference") as inner:
+            assert tracing.current_span() is inner
+    tracing.finish_trace(root, token)
+
+    assert root.trace.trace_id == "0af7651916cd43dd8448eb211c80319c"
+    assert root.parent_id == "b7ad6b7169203331"
+    assert outer.parent_id == root.span_id
+    assert inner.parent_id == outer.span_id
+    assert all(span.duration is not None for span in root.trace.spans)
+    assert tracing.current_span() is None
+    assert root.traceparent().startswith("00-0af7651916cd43dd8448eb211c80319c-")
+
+
+def test_span_outside_trace_is_noop():
+    """测试不在追踪中时span不做任何记录"""
+    with tracing.span("orphan") as span:
+        assert span is None
+
+
+def test_trace_store_keeps_slow_traces_only():
+    """测试环形缓冲区只保存慢请求并限制数量"""
+    store = TraceStore(max_traces=2, slow_threshold=0.5)
+    traces = []
+    for duration in (0.1, 0.6, 0.7, 0.8):
+        root, token = tracing.start_trace("request")
+        tracing.finish_trace(root, token)
+        root.duration = duration
+        store.add(root.trace)
+        traces.append(root.trace)
+
+    summaries = store.list()
+    assert [s["trace_id"] for s in summaries] == [traces[3].trace_id, traces[2].trace_id]
+    assert store.get(traces[0].trace_id) is None
+
+    exported = traces[3].to_chrome_trace()
+    assert exported["traceEvents"][0]["ph"] == "X"
+    assert exported["traceEvents"][0]["name"] == "request"
+
+
+def test_unsampled_traces_are_propagated_but_not_stored():
+    """测试上游trace-flags为00时照常传播追踪上下文，但不保存追踪"""
+    store = TraceStore(max_traces=2, slow_threshold=0.0)
+    root, token = tracing.start_trace("request", "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00")
+    tracing.finish_trace(root, token)
+    store.add(root.trace)
+
+    assert root.traceparent().endswith("-00")
+    assert not root.trace.profile_inference
+    assert store.list() == []
+
+
+def test_trace_endpoints_require_token(monkeypatch):
+    """测试追踪接口需要调试令牌"""
+    from fastapi.testclient import TestClient
+
+    from app import config
+    from app.main import app
+    client = TestClient(app)
+
+    monkeypatch.setattr(config, "DEBUG_TOKEN", "")
+    assert client.get("/api/debug/traces").status_code == 404
+    monkeypatch.setattr(config, "DEBUG_TOKEN", "secret")
+    assert client.get("/api/debug/traces").status_code == 401
+    assert client.get("/api/debug/traces/missing", headers={"X-Debug-Token": "wrong"}).status_code == 401
+    assert client.get("/api/debug/traces", headers={"Authorization": "Bearer secret"}).status_code == 200
+    assert client.get("/api/debug/traces/missing", headers={"X-Debug-Token": "secret"}).status_code == 404
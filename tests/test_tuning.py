@@ -0,0 +1,91 @@
+"""
+ONNX Runtime 调优与IOBinding测试
+"""
+
+import numpy as np
+
+from app import config
+from app.models.model_manager import ModelManager
+from app.models.tuning import (
+    DEFAULT_PROFILE,
+    build_session_options,
+    get_host_key,
+    load_profile,
+    save_profile,
+    tune,
+)
+from tests.conftest import build_standin_model
+
+
+def test_tune_and_save_profile(standin_model_path, tmp_path):
+    """测试调优结果按主机类型保存并能重新读取"""
+    candidates = [
+        dict(DEFAULT_PROFILE, intra_op_num_threads=1),
+        dict(DEFAULT_PROFILE, intra_op_num_threads=1, execution_mode="parallel", inter_op_num_threads=1),
+    ]
+    result = tune(standin_model_path, [32, 32], runs=2, batch_sizes=[1, 2], candidates=candidates)
+    assert result["host"] == get_host_key()
+    assert result["profile"]["batch_size"] in (1, 2)
+
+    profile_path = str(tmp_path / "ort_profile.json")
+    save_profile(profile_path, result)
+    assert load_profile(profile_path) == result["profile"]
+    assert load_profile(profile_path, "other-host") is None
+
+
+def test_build_session_options():
+    """测试调优配置应用到会话选项"""
+    options = build_session_options(dict(DEFAULT_PROFILE, intra_op_num_threads=2, enable_mem_pattern=False))
+    assert options.intra_op_num_threads == 2
+    assert options.enable_mem_pattern is False
+
+
+def test_iobinding_matches_session_run(standin_model_manager):
+    """测试IOBinding推理与普通推理结果一致，并复用输出缓冲区"""
+    manager = standin_model_manager
+    assert manager.use_iobinding
+    batch = np.random.rand(2, 3, 64, 64).astype(np.float32)
+
+    session = manager.get_session()
+    expected = session.run(None, {session.get_inputs()[0].name: batch})[0]
+    first = manager.run(batch)
+    np.testing.assert_allclose(first, expected, rtol=1e-5, atol=1e-6)
+
+    second = manager.run(batch)
+    assert second is first
+    assert manager.use_iobinding
+
+
+def test_fixed_batch_model_returns_each_mask(standin_model_manager, tmp_path, monkeypatch):
+    """测试批次固定为1的模型逐张推理时，每张图得到自己的掩码而不是共用缓冲区中最后一张的结果"""
+    model_path = build_standin_model(str(tmp_path / "fixed.onnx"), fixed_batch=True)
+    monkeypatch.setattr(config, "MODEL_PATH", model_path)
+    monkeypatch.setattr(ModelManager, "_instance", None)
+    manager = ModelManager()
+    assert manager.use_iobinding and not manager.supports_batching()
+
+    batch = np.stack([np.full((3, 32, 32), value, dtype=np.float32) for value in (-1.0, 0.0, 1.0)])
+    session = manager.get_session()
+    expected = np.concatenate([session.run(None, {"input": batch[i:i + 1]})[0] for i in range(3)])
+    output = manager.run(batch)
+
+    np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+    assert not np.allclose(output[0], output[1]) and not np.allclose(output[1], output[2])
+
+
+def test_iobinding_error_falls_back_for_one_call(standin_model_manager, monkeypatch):
+    """测试IOBinding的偶发错误只让这一次推理退回普通推理"""
+    manager = standin_model_manager
+    batch = np.random.rand(1, 3, 32, 32).astype(np.float32)
+    calls = []
+
+    def failing_once(session, input_name, tensor):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("绑定失败")
+        return session.run(None, {input_name: tensor})[0]
+
+    monkeypatch.setattr(manager, "_run_with_iobinding", failing_once)
+    manager.run(batch)
+    manager.run(batch)
+    assert len(calls) == 2 and manager.use_iobinding